@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+'''Measure SavingsAnalytics against looping over the transactions in the store.
+
+Fills a TransactionStore in memory with `--count` transactions on one
+account, over `--days` days, and times:
+
+  loop      weekly and monthly totals from store.history(), summing the
+            Decimal amounts of SbankenTransactions, like we would without analytics
+  load      the first summary from SavingsAnalytics, which reads the columns from the store
+  summary   the next summaries, from the running totals
+  add       adding a sync of `--batch` new transactions, and the summary after it
+  rolling   30 day rolling sums for every day of the last year
+
+Rolling sums use numpy if it is installed, run with --python to leave it
+out. Compare with an earlier run:
+
+    python bench/bench_analytics.py --out analytics.json
+    python bench/bench_analytics.py --baseline analytics.json
+
+'''
+import sys
+import os.path
+import time
+import json
+import random
+import socket
+import datetime
+import platform
+import statistics
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from SbankenClient import SbankenTransaction
+from transactionstore import TransactionStore
+import analytics
+
+ACCOUNT = '97104133219'
+
+def transactions(count:int, days:int, today:datetime.date, prefix:str='') -> list:
+    'make count SbankenTransactions on ACCOUNT, spread over the days up to today'
+    random.seed(count)
+    return [SbankenTransaction({'accountNumber': ACCOUNT,
+                                'accountingDate': (today - datetime.timedelta(days=random.randrange(days))).isoformat() + 'T00:00:00+01:00',
+                                'amount': random.choice((5, 10, 2.5, -49.9, 20)),
+                                'text': 'Tannpuss ({:08x})'.format(i),
+                                'transactionId': '{}{}'.format(prefix, i),
+                                'transactionType': 'OVFNETTB'}) for i in range(count)]
+
+def loop(store:TransactionStore) -> tuple:
+    'weekly and monthly net, the slow way'
+    weekly, monthly = {}, {}
+    for t in store.history(ACCOUNT):
+        day = t.accountingDate.date()
+        week = day - datetime.timedelta(days=day.weekday())
+        weekly[week] = weekly.get(week, 0) + t.amount
+        monthly[day.replace(day=1)] = monthly.get(day.replace(day=1), 0) + t.amount
+    return weekly, monthly
+
+def median(fn, runs:int) -> float:
+    'median seconds of fn()'
+    samples = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - started)
+    return statistics.median(samples)
+
+def measure(count:int, days:int, batch:int, runs:int) -> dict:
+    today = datetime.date.today()
+    store = TransactionStore(':memory:')
+    store.add(transactions(count, days, today))
+    ms = lambda seconds: round(seconds * 1000, 3)
+    result = {'count': count, 'days': days, 'batch': batch, 'numpy': analytics.numpy() is not None}
+    result['loop'] = ms(median(lambda: loop(store), runs))
+
+    def load():
+        a = analytics.SavingsAnalytics(store)
+        a.summary(ACCOUNT, today=today)
+        return a
+    result['load'] = ms(median(load, runs))
+    a = load()
+    store.addListener(a.add)
+    result['summary'] = ms(median(lambda: a.summary(ACCOUNT, today=today), runs))
+    batches = iter([transactions(batch, 7, today, prefix='new{}-'.format(i)) for i in range(runs)])
+    result['add'] = ms(median(lambda: (store.add(next(batches)), a.summary(ACCOUNT, today=today)), runs))
+    result['rolling'] = ms(median(lambda: a.rolling(ACCOUNT, 30, 365, today), runs))
+    return result
+
+def report(result:dict, baseline:dict=None):
+    baseline = baseline or {}
+    print('{} transactions over {} days, numpy: {}'.format(result['count'], result['days'], result['numpy']))
+    for step in ('loop', 'load', 'summary', 'add', 'rolling'):
+        line = '  {:10} {:10.3f} ms'.format(step, result[step])
+        if baseline.get(step):
+            line += '   {:+.0%}'.format((result[step] - baseline[step]) / baseline[step])
+        print(line)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time savings statistics, with and without SavingsAnalytics')
+    parser.add_argument('--count', type=int, default=20000, help='transactions in the store')
+    parser.add_argument('--days', type=int, default=730, help='spread them over this many days')
+    parser.add_argument('--batch', type=int, default=5, help='new transactions in each sync')
+    parser.add_argument('--runs', type=int, default=5, help='take the median of this many runs')
+    parser.add_argument('--python', action='store_true', help="don't use numpy, even if it is installed")
+    parser.add_argument('--out', help='save the results as json to this file')
+    parser.add_argument('--baseline', help='compare with results saved with --out')
+    args = parser.parse_args()
+
+    if args.python:
+        analytics._numpy = False
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    result = measure(args.count, args.days, args.batch, args.runs)
+    report(result, baseline)
+
+    if args.out:
+        result.update({'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'), 'host': socket.gethostname(),
+                       'python': platform.python_version(), 'machine': platform.machine()})
+        with open(args.out, 'w') as f:
+            json.dump(result, f, indent=2)
+        print('Saved to', args.out)
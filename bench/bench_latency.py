@@ -0,0 +1,297 @@
+#!/usr/bin/env python
+'''Measure how long a card scan takes until the new balance is shown.
+
+Runs the whole scan-to-balance pipeline of the kiosk against the fake
+Sbanken api (src/fakesbanken.py) with injected network latency: the
+scripted card reader, the handoff to the ui loop, the reward outbox, the
+transfer, the balance update, and the handoff of the new balance back to
+the ui loop. Kivy is not needed, a plain thread stands in for its loop.
+
+Each kid is a kiosk that scans a card, waits until the new balance is
+shown, and scans again, so the number of kids is the concurrency. Reports
+p50/p95/p99 per stage, for each scenario:
+
+    python bench/bench_latency.py --kids 1 4 --scans 50 --latency 0.05 --out latency.json
+    python bench/bench_latency.py --kids 1 4 --baseline latency.json
+
+The client rate limits are off, unless given like `--rateLimit transfer=5,10`.
+
+Stages, in ms:
+  read      the reader thread sees the card, until the ui loop gets it
+  queue     the ui loop queues the reward, until the outbox starts sending it
+  transfer  the transfer at the bank
+  update    getting the new balance from the bank
+  display   the new balance is known, until the ui loop gets it
+  total     from the scan, until the new balance is on the ui loop
+
+'''
+import sys
+import os.path
+import time
+import json
+import queue
+import socket
+import tempfile
+import threading
+import platform
+import logging
+import argparse
+from decimal import Decimal
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from fakesbanken import FakeSbanken
+from cards import Card
+from ledger import rewardKey
+import backends
+import bank
+
+STAGES = ('read', 'queue', 'transfer', 'update', 'display', 'total')
+
+def percentile(values:list, p:float) -> float:
+    'the p-th percentile of sorted values, by nearest rank'
+    if not values:
+        return None
+    rank = max(int(round(p / 100.0 * len(values) + 0.5)) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+def summary(samples:list) -> dict:
+    'count, mean, p50/p95/p99 and max of samples in seconds, as ms'
+    values = sorted(samples)
+    if not values:
+        return {'count': 0}
+    ms = lambda s: round(s * 1000, 3)
+    return {'count': len(values), 'mean': ms(sum(values) / len(values)),
+            'p50': ms(percentile(values, 50)), 'p95': ms(percentile(values, 95)),
+            'p99': ms(percentile(values, 99)), 'max': ms(values[-1])}
+
+class UILoop:
+    'Runs callbacks in one thread, in order, like Clock.schedule_once on the kivy loop'
+    def __init__(self):
+        self.calls = queue.Queue()
+        self._thread = threading.Thread(target=self.run, name='ui', daemon=True)
+        self._thread.start()
+
+    def schedule(self, fn):
+        self.calls.put(fn)
+
+    def run(self):
+        while True:
+            fn = self.calls.get()
+            if fn is None:
+                return
+            fn()
+
+    def stop(self):
+        self.calls.put(None)
+        self._thread.join()
+
+class Scan:
+    'The timestamps of one scan, as it goes through the pipeline'
+    __slots__ = ('kid', 'hex', 'key', 'scanned', 'read', 'queued', 'sending', 'sent', 'updated', 'known', 'shown', 'done')
+
+    def __init__(self, kid:str, hex:str):
+        self.kid = kid
+        self.hex = hex
+        self.key = None
+        self.scanned = self.read = self.queued = self.sending = self.sent = None
+        self.updated = self.known = self.shown = None
+        self.done = threading.Event()
+
+    def stages(self) -> dict:
+        return {'read': self.read - self.scanned,
+                'queue': self.sending - self.queued,
+                'transfer': self.sent - self.sending,
+                'update': self.updated - self.sent,
+                'display': self.shown - self.known,
+                'total': self.shown - self.scanned}
+
+class Pipeline:
+    '''A kiosk for each kid, on one GriseBank, with timing on every step.
+
+    The steps are wrapped on the instances, the code under test is the same
+    as in the kiosk.'''
+    def __init__(self, griseBank:'bank.GriseBank', kids:list):
+        self.bank = griseBank
+        self.ui = UILoop()
+        self.cards = {} # hex -> Card
+        self.scans = {} # hex -> Scan
+        self.byKey = {} # reward key -> Scan
+        self.local = threading.local() # the scans the outbox thread is sending right now
+        self.readers = {}
+        for kid in kids:
+            reader = backends.ScriptedCardReader(lambda card: self.ui.schedule(lambda: self.on_rfid_card(card)),
+                                                 duplicate_window=0)
+            reader.start()
+            self.readers[kid] = reader
+        griseBank.addListener(self.on_balance_changed)
+
+        send = griseBank.outbox.send
+        def timedSend(entries):
+            scans = [self.byKey[e.key] for e in entries]
+            now = time.perf_counter()
+            for s in scans:
+                s.sending = now
+            self.local.scans = scans
+            try:
+                return send(entries)
+            finally:
+                self.local.scans = []
+        griseBank.outbox.send = timedSend
+
+        reward = griseBank.reward
+        def timedReward(receiver, amount, message=None):
+            result = reward(receiver, amount, message)
+            now = time.perf_counter()
+            for s in self.local.scans:
+                s.sent = now
+            return result
+        griseBank.reward = timedReward
+
+        for user in griseBank.users:
+            self._timeUpdate(user)
+
+    def _timeUpdate(self, user):
+        update = user.update
+        def timedUpdate():
+            update()
+            now = time.perf_counter()
+            for s in getattr(self.local, 'scans', []):
+                s.updated = now
+        user.update = timedUpdate
+
+    def scan(self, kid:str, n:int) -> Scan:
+        'put a new card on the reader of kid, and return its Scan'
+        hex = '{:08X}{:02X}'.format(n, sorted(self.readers).index(kid))
+        self.cards[hex] = Card(hex, 'Bench', Decimal(1))
+        s = self.scans[hex] = Scan(kid, hex)
+        s.scanned = time.perf_counter()
+        self.readers[kid].scan(hex)
+        return s
+
+    def on_rfid_card(self, card):
+        'like GriseBankApp.on_rfid_card, on the ui loop'
+        s = self.scans[card.hex]
+        s.read = time.perf_counter()
+        known = self.cards.get(card.hex)
+        user = self.bank.user(s.kid)
+        s.key = rewardKey(card.hex, user.details.accountNumber, bucket=self.bank.outbox.dedupWindow)
+        self.byKey[s.key] = s
+        s.queued = time.perf_counter()
+        self.bank.outbox.put(user, known.reward, known.name, key=s.key)
+
+    def on_balance_changed(self, user):
+        'like GriseBankApp.on_balance_changed, from the outbox thread'
+        now = time.perf_counter()
+        scans = [s for s in getattr(self.local, 'scans', []) if s.known is None]
+        for s in scans:
+            s.known = now
+        def show():
+            shown = time.perf_counter()
+            for s in scans:
+                s.shown = shown
+                s.done.set()
+        self.ui.schedule(show)
+
+    def stop(self):
+        for reader in self.readers.values():
+            reader.on_stop()
+        self.ui.stop()
+
+def runScenario(kids:int, scans:int, latency:float, jitter:float, mergeWindow:float, timeout:float, rateLimits:dict=None) -> dict:
+    'run one scenario against a new fake bank, and return its results'
+    names = ['Kid{}'.format(i) for i in range(1, kids + 1)]
+    accounts = {'BASE': '90000000000'}
+    accounts.update({name:'8{:010d}'.format(i) for i, name in enumerate(names, 1)})
+    fake = FakeSbanken({number:(1000000 if name == 'BASE' else 0) for name, number in accounts.items()},
+                       latency=latency, jitter=jitter).start()
+    config = fake.config(accounts)
+    config.add_section('storage')
+    config.set('storage', 'dir', tempfile.mkdtemp(prefix='grisebank-bench-'))
+    config.add_section('outbox')
+    config.set('outbox', 'mergeWindow', str(mergeWindow))
+    config.add_section('ratelimit')
+    for kind in ('transfer', 'balance', 'history'):
+        config.set('ratelimit', kind, (rateLimits or {}).get(kind, '0'))
+    griseBank = bank.GriseBank(config)
+    pipeline = Pipeline(griseBank, names)
+    griseBank.outbox.start()
+
+    done = []
+    timeouts = []
+    def kiosk(kid):
+        for n in range(scans):
+            s = pipeline.scan(kid, n)
+            if s.done.wait(timeout):
+                done.append(s)
+            else:
+                timeouts.append(s)
+    started = time.perf_counter()
+    threads = [threading.Thread(target=kiosk, args=(kid,), name=kid) for kid in names]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - started
+    pipeline.stop()
+    griseBank.outbox.stop()
+    griseBank.client.close()
+    fake.stop()
+
+    stages = {stage:[] for stage in STAGES}
+    for s in done:
+        for stage, value in s.stages().items():
+            stages[stage].append(value)
+    return {'kids': kids, 'scans': len(done), 'timeouts': len(timeouts),
+            'latency': latency, 'jitter': jitter, 'mergeWindow': mergeWindow, 'rateLimits': rateLimits or {},
+            'seconds': round(elapsed, 3), 'scansPerSecond': round(len(done) / elapsed, 2) if elapsed else None,
+            'requests': dict(fake.requests),
+            'stages': {stage:summary(values) for stage, values in stages.items()}}
+
+def report(result:dict, baseline:dict=None):
+    print('{} kid(s), {} scans, {} timeouts, {:.1f} scans/s, latency {} s'.format(
+        result['kids'], result['scans'], result['timeouts'], result['scansPerSecond'] or 0, result['latency']))
+    print('  {:9} {:>9} {:>9} {:>9} {:>9} {:>9}'.format('stage ms', 'mean', 'p50', 'p95', 'p99', 'max'))
+    for stage in STAGES:
+        s = result['stages'][stage]
+        if not s['count']:
+            continue
+        line = '  {:9} {:9.1f} {:9.1f} {:9.1f} {:9.1f} {:9.1f}'.format(stage, s['mean'], s['p50'], s['p95'], s['p99'], s['max'])
+        if baseline is not None and baseline['stages'][stage]['count']:
+            before = baseline['stages'][stage]['p95']
+            line += '   p95 {:+.1f} ms ({:+.0%})'.format(s['p95'] - before, (s['p95'] - before) / before if before else 0)
+        print(line)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Latency from card scan to new balance, against a fake bank')
+    parser.add_argument('--kids', type=int, nargs='+', default=[1, 4], help='kiosks scanning at the same time, one scenario each')
+    parser.add_argument('--scans', type=int, default=20, help='scans per kid')
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds the fake bank waits before each reply')
+    parser.add_argument('--jitter', type=float, default=0.0, help='up to this many seconds more')
+    parser.add_argument('--mergeWindow', type=float, default=0, help='[outbox] mergeWindow, in seconds')
+    parser.add_argument('--timeout', type=float, default=30, help='give up on a scan after this many seconds')
+    parser.add_argument('--rateLimit', nargs='*', default=[], metavar='CLASS=RATE,BURST',
+                        help='[ratelimit] of the client, like transfer=5,10. off for the classes not given')
+    parser.add_argument('--out', help='save the results as json to this file')
+    parser.add_argument('--baseline', help='compare p95 with results saved with --out')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = {r['kids']:r for r in json.load(f)['scenarios']}
+
+    results = []
+    for kids in args.kids:
+        result = runScenario(kids, args.scans, args.latency, args.jitter, args.mergeWindow, args.timeout,
+                             dict(limit.split('=', 1) for limit in args.rateLimit))
+        report(result, baseline.get(kids))
+        results.append(result)
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump({'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'), 'host': socket.gethostname(),
+                       'python': platform.python_version(), 'machine': platform.machine(),
+                       'scenarios': results}, f, indent=2)
+        print('Saved to', args.out)
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+'''Compare speed and memory of the Sbanken model classes with the old jsonobject ones.
+
+Builds a lot of SbankenTransactions from api-like dicts, and reports time per
+object and memory held by the objects. The jsonobject versions are defined
+here, as they were before we dropped them. Install jsonobject to compare:
+
+    pip install jsonobject
+    python bench/bench_models.py --count 10000
+
+'''
+import sys
+import os.path
+import time
+import tracemalloc
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from SbankenClient import SbankenTransaction
+
+def transactions(count:int) -> list:
+    'make count api-like transaction dicts'
+    return [{'accountNumber': '97104133219',
+             'accountingDate': '2018-01-%02dT00:00:00+01:00' % (i % 28 + 1),
+             'amount': float(i % 500) + 0.5,
+             'customerId': '01010112345',
+             'interestDate': '2018-01-%02dT00:00:00+01:00' % (i % 28 + 1),
+             'otherAccountNumber': None,
+             'registrationDate': None,
+             'text': 'Rewarded by Grisebank %i' % i,
+             'transactionId': str(1000000 + i),
+             'transactionType': 'OVF'} for i in range(count)]
+
+def jsonobjectTransaction():
+    'return the old jsonobject based SbankenTransaction, or None if jsonobject is not installed'
+    try:
+        import jsonobject
+    except ImportError:
+        return None
+
+    class JsonObjectTransaction(jsonobject.JsonObject):
+        accountNumber = jsonobject.StringProperty()
+        accountingDate = jsonobject.DefaultProperty()
+        amount = jsonobject.FloatProperty()
+        customerId = jsonobject.StringProperty()
+        interestDate = jsonobject.DefaultProperty()
+        otherAccountNumber = jsonobject.StringProperty()
+        registrationDate = jsonobject.DefaultProperty()
+        text = jsonobject.StringProperty()
+        transactionId = jsonobject.StringProperty()
+        transactionType = jsonobject.StringProperty()
+    return JsonObjectTransaction
+
+def measure(name:str, build, data:list) -> dict:
+    'time building all objects, then measure the memory they hold'
+    start = time.perf_counter()
+    objects = [build(d) for d in data]
+    elapsed = time.perf_counter() - start
+    total = sum(o.amount for o in objects) # touch the objects, like a real caller would
+    del objects
+    tracemalloc.start()
+    objects = [build(d) for d in data]
+    memory, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del objects
+    return {'name': name,
+            'us_per_object': elapsed / len(data) * 1e6,
+            'bytes_per_object': memory / len(data),
+            'checksum': float(total)}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark Sbanken model classes')
+    parser.add_argument('--count', type=int, default=10000)
+    args = parser.parse_args()
+
+    data = transactions(args.count)
+    results = [measure('SbankenTransaction.from_json', SbankenTransaction.from_json, data)]
+    old = jsonobjectTransaction()
+    if old is None:
+        print('jsonobject is not installed, skipping the comparison')
+    else:
+        results.append(measure('jsonobject.JsonObject', old, data))
+
+    print('{:32} {:>14} {:>16}'.format('model', 'us/object', 'bytes/object'))
+    for r in results:
+        print('{name:32} {us_per_object:14.2f} {bytes_per_object:16.0f}'.format(**r))
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+'''Measure how long the kiosk takes to start, without kivy.
+
+Two parts:
+
+  imports   what each of our modules costs to import in a new python, from
+            `python -X importtime`, with the slowest modules it pulls in
+  startup   against the fake Sbanken api (src/fakesbanken.py) with injected
+            network latency: CachedBank from the snapshot of the last run,
+            which is what the kiosk shows first, and GriseBank, which logs
+            in and lists the accounts, in the background
+
+Run it before and after a change, and compare:
+
+    python bench/bench_startup.py --runs 5 --out startup.json
+    python bench/bench_startup.py --runs 5 --baseline startup.json
+
+On a kiosk, `python src/gris.py config.ini --profile FILE` saves the real
+startup, first frame included.
+
+'''
+import sys
+import os.path
+import time
+import json
+import socket
+import tempfile
+import platform
+import subprocess
+import statistics
+import logging
+import argparse
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+sys.path.insert(0, SRC)
+
+# what gris.py imports before the first frame, and what it imports in the background
+KIOSK = ('ledger', 'cards', 'buttons', 'snapshot', 'startup', 'backends')
+MODULES = KIOSK + ('bank', 'service')
+
+def importTimes(module:str) -> dict:
+    'Import module in a new python, and return {module: cumulative seconds} for everything it imported'
+    r = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+                       cwd=SRC, capture_output=True, text=True, check=True)
+    times = {}
+    for line in r.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        if name.strip() == 'site':
+            times = {} # what python imports before our code runs
+            continue
+        times[name.strip()] = int(cumulative) / 1e6
+    return times
+
+def measureImports(modules:tuple, runs:int, top:int) -> dict:
+    'median import seconds of each module, over runs new pythons, with the slowest top modules it pulls in'
+    results = {}
+    for module in modules + ('+'.join(KIOSK),):
+        samples = [importTimes(module.replace('+', ', ')) for _ in range(runs)]
+        if '+' in module:
+            total = [sum(s.get(m, 0) for m in KIOSK) for s in samples]
+            results['kiosk'] = {'ms': round(statistics.median(total) * 1000, 1)}
+            continue
+        deps = {name:statistics.median(s.get(name, 0) for s in samples) for name in samples[0] if name != module}
+        slowest = sorted(deps.items(), key=lambda item: -item[1])[:top]
+        results[module] = {'ms': round(statistics.median(s[module] for s in samples) * 1000, 1),
+                           'slowest': {name:round(seconds * 1000, 1) for name, seconds in slowest}}
+    return results
+
+def measureStartup(runs:int, latency:float) -> dict:
+    'median seconds to a CachedBank, and to a logged in GriseBank, against a new fake bank'
+    from fakesbanken import FakeSbanken
+    from snapshot import CachedBank
+    import bank
+
+    accounts = {'BASE': '90000000000', 'Kid1': '80000000001', 'Kid2': '80000000002'}
+    fake = FakeSbanken({number:1000 for number in accounts.values()}, latency=latency).start()
+    config = fake.config(accounts)
+    config.add_section('storage')
+    config.set('storage', 'dir', tempfile.mkdtemp(prefix='grisebank-bench-'))
+    cached, opened = [], []
+    for _ in range(runs):
+        config.remove_option('login', 'tokenCache') # log in every time, like a cold start
+        started = time.perf_counter()
+        griseBank = bank.GriseBank(config)
+        opened.append(time.perf_counter() - started)
+        griseBank.client.close()
+        started = time.perf_counter()
+        CachedBank.fromConfig(config)
+        cached.append(time.perf_counter() - started)
+    fake.stop()
+    ms = lambda samples: round(statistics.median(samples) * 1000, 3)
+    return {'latency': latency, 'cached': ms(cached), 'bank': ms(opened), 'requests': dict(fake.requests)}
+
+def report(result:dict, baseline:dict=None):
+    baseline = baseline or {}
+    def compare(now, before):
+        if before is None:
+            return ''
+        return '   {:+.1f} ms ({:+.0%})'.format(now - before, (now - before) / before if before else 0)
+    print('imports, ms')
+    for module, r in result['imports'].items():
+        before = baseline.get('imports', {}).get(module, {}).get('ms')
+        print('  {:10} {:8.1f}{}'.format(module, r['ms'], compare(r['ms'], before)))
+        if r.get('slowest'):
+            print('  {:10} {}'.format('', ', '.join('{} {:.0f}'.format(name, ms) for name, ms in r['slowest'].items())))
+    startup = result['startup']
+    print('startup, ms, latency {} s'.format(startup['latency']))
+    for step in ('cached', 'bank'):
+        before = baseline.get('startup', {}).get(step)
+        print('  {:10} {:8.1f}{}'.format(step, startup[step], compare(startup[step], before)))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Import times and startup of the kiosk, against a fake bank')
+    parser.add_argument('--runs', type=int, default=3, help='take the median of this many runs')
+    parser.add_argument('--latency', type=float, default=0.1, help='seconds the fake bank waits before each reply')
+    parser.add_argument('--top', type=int, default=5, help='show this many of the slowest imports of each module')
+    parser.add_argument('--out', help='save the results as json to this file')
+    parser.add_argument('--baseline', help='compare with results saved with --out')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    result = {'imports': measureImports(MODULES, args.runs, args.top),
+              'startup': measureStartup(args.runs, args.latency)}
+    report(result, baseline)
+
+    if args.out:
+        result.update({'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'), 'host': socket.gethostname(),
+                       'python': platform.python_version(), 'machine': platform.machine()})
+        with open(args.out, 'w') as f:
+            json.dump(result, f, indent=2)
+        print('Saved to', args.out)
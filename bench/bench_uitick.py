@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+'''Measure the CPU cost of a no-op Kivy Clock tick, like the 60 Hz GriseBank.update we used to have.
+
+Runs a small kivy app with the grisebank layout twice, in separate processes:
+once with a no-op callback scheduled every 1/60 s, and once without it, and
+reports the CPU time (user + system) each run used. Run it on the Pi, with
+the app on the PiTFT, and read a USB power meter during each run to get the
+power side of the comparison:
+
+    python bench/bench_uitick.py --seconds 60
+
+'''
+import sys
+import os.path
+import subprocess
+import resource
+import time
+import json
+import argparse
+
+def run(seconds:float, tick:bool) -> dict:
+    'run the kivy app in this process, for `seconds`, and return the cpu time it used'
+    from kivy.app import App
+    from kivy.clock import Clock
+    from kivy.lang import Builder
+    from kivy.uix.widget import Widget
+    from kivy.properties import NumericProperty, StringProperty
+
+    class GriseBank(Widget):
+        accountName = StringProperty("Ingen")
+        accountValue = NumericProperty(0.0)
+        status = StringProperty("Velg konto...")
+        updated = StringProperty("") # grisebank.kv shows it under the balance
+
+    Builder.load_file(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'grisebank.kv'))
+
+    class BenchApp(App):
+        def build(self):
+            widget = GriseBank()
+            if tick:
+                Clock.schedule_interval(lambda dt: None, 1.0/60.0)
+            Clock.schedule_once(self.done, seconds)
+            return widget
+
+        def on_start(self):
+            self.started = (time.monotonic(), resource.getrusage(resource.RUSAGE_SELF))
+
+        def done(self, dt):
+            wall0, usage0 = self.started
+            usage = resource.getrusage(resource.RUSAGE_SELF)
+            cpu = (usage.ru_utime - usage0.ru_utime) + (usage.ru_stime - usage0.ru_stime)
+            self.result = {'tick': tick, 'seconds': time.monotonic() - wall0, 'cpu_seconds': cpu}
+            self.stop()
+
+    app = BenchApp()
+    app.run()
+    return app.result
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare CPU use with and without a 60 Hz no-op ui tick')
+    parser.add_argument('--seconds', type=float, default=30)
+    parser.add_argument('--child', choices=['tick', 'notick'], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(run(args.seconds, args.child == 'tick')))
+        sys.exit(0)
+
+    results = []
+    for mode in ('tick', 'notick'):
+        input('Starting the {} run for {:.0f} s, note your power meter and press enter '.format(mode, args.seconds))
+        out = subprocess.run([sys.executable, __file__, '--seconds', str(args.seconds), '--child', mode],
+                             check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+        results.append(json.loads(out.strip().splitlines()[-1]))
+
+    print('{:8} {:>10} {:>10}'.format('mode', 'cpu s', 'cpu %'))
+    for r in results:
+        print('{:8} {:10.2f} {:10.1f}'.format('tick' if r['tick'] else 'no tick', r['cpu_seconds'],
+                                               100 * r['cpu_seconds'] / r['seconds']))
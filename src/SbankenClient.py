@@ -4,65 +4,205 @@ Import into your project and start doing banking from your
 code. 
 
 '''
-import jsonobject # pip install jsonobject
 import requests   # pip install requests
 from requests.auth import HTTPBasicAuth
-from oauthlib.oauth2 import BackendApplicationClient
+from requests.adapters import HTTPAdapter
+from oauthlib.oauth2 import BackendApplicationClient, TokenExpiredError, OAuth2Error
 from requests_oauthlib import OAuth2Session
 from urllib.parse import quote
 import logging
 import configparser
-logging.basicConfig(level=logging.DEBUG)
+import asyncio
+import threading
+import time
+import json
+import os
+import os.path
+import fcntl
+import tempfile
+import random
+import datetime
+from decimal import Decimal
+from collections import OrderedDict, deque
+import concurrent.futures
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import Metrics
 
 class SbankenError(Exception):
-    pass
+    '''Something went wrong talking to the bank.
+
+    `status` is the http status code, if we got that far, and `reply` the
+    error reply from the api, if it sent one. Catch one of the subclasses
+    to react to a kind of error.'''
+    def __init__(self, *args, status:int=None, reply:dict=None):
+        super().__init__(*args)
+        self.status = status
+        self.reply = reply
+
+class SbankenAuthError(SbankenError):
+    'The bank did not accept our credentials or token'
+
+class SbankenRateLimitError(SbankenError):
+    'The bank wants us to slow down. Wait `retryAfter` seconds (if it said) before trying again'
+    retryAfter = None
+
+class SbankenValidationError(SbankenError):
+    'The bank refused the request as it is, e.g. a transfer without enough money. Trying again will not help'
+
+class SbankenServerError(SbankenError):
+    'The bank failed to handle the request. Trying again later may help'
+
+class SbankenUnavailableError(SbankenError):
+    'We could not reach the bank (network error or timeout), or gave up on it for a while, see CircuitBreaker'
+
+def parseDate(value):
+    'Parse a timestamp from the api, like 2018-01-22T00:00:00+01:00, to datetime'
+    if value is None or isinstance(value, datetime.datetime):
+        return value
+    if value.endswith('Z'):
+        value = value[:-1] + '+00:00'
+    return datetime.datetime.fromisoformat(value)
+
+def parseDecimal(value) -> Decimal:
+    'Parse an amount from the api to Decimal, without float rounding noise'
+    return value if isinstance(value, Decimal) else Decimal(str(value))
+
+class LazyDate:
+    '''A date field on a SbankenObject.
+
+    The raw string from the api is kept in the slot `_<name>`, and parsed to
+    datetime the first time it is read.'''
+    def __init__(self):
+        self.slot = None
+
+    def __set_name__(self, owner, name):
+        self.slot = '_' + name
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        value = getattr(obj, self.slot)
+        if isinstance(value, str):
+            value = parseDate(value)
+            setattr(obj, self.slot, value)
+        return value
+
+    def __set__(self, obj, value):
+        setattr(obj, self.slot, value)
+
+class SbankenObject:
+    '''Base class for the json structs from the api.
+
+    Subclasses list their fields in __slots__ (dates as `_<name>`, with a
+    LazyDate on the class), and name the fields that hold Decimal amounts or
+    nested objects. Use `from_json()` to build one from an api dict, and
+    `to_json()` to get a dict back.
+    '''
+    __slots__ = ()
+    _decimals = ()  # fields with amounts
+    _objects = {}   # field -> SbankenObject subclass, for nested objects
+    _lists = {}     # field -> SbankenObject subclass, for lists of nested objects
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # precompute (slot, json key, converter) for from_json
+        parsers = []
+        for slot in cls.__slots__:
+            key = slot.lstrip('_')
+            if key in cls._decimals:
+                convert = parseDecimal
+            elif key in cls._objects:
+                convert = cls._objects[key].from_json
+            elif key in cls._lists:
+                convert = lambda items, itemcls=cls._lists[key]: [itemcls.from_json(i) for i in items]
+            else:
+                convert = None # strings, booleans, and raw dates that LazyDate will parse
+            parsers.append((slot, key, convert))
+        cls._parsers = tuple(parsers)
+
+    def __init__(self, data:dict=None, **kwargs):
+        self._load(dict(data or {}, **kwargs) if kwargs else (data or {}))
+
+    @classmethod
+    def from_json(cls, data:dict) -> 'SbankenObject':
+        'Build an object from an api dict'
+        obj = cls.__new__(cls)
+        obj._load(data)
+        return obj
 
-class SbankenAccount(jsonobject.JsonObject):
+    def _load(self, data:dict):
+        get = data.get
+        for slot, key, convert in self._parsers:
+            value = get(key)
+            if value is not None and convert is not None:
+                value = convert(value)
+            setattr(self, slot, value)
+
+    def to_json(self) -> dict:
+        'Return a dict like the one we got from the api'
+        r = {}
+        for slot, key, _ in self._parsers:
+            value = getattr(self, slot)
+            if isinstance(value, SbankenObject):
+                value = value.to_json()
+            elif isinstance(value, list):
+                value = [v.to_json() for v in value]
+            elif isinstance(value, Decimal):
+                value = float(value)
+            elif isinstance(value, datetime.datetime):
+                value = value.isoformat()
+            r[key] = value
+        return r
+
+    def __eq__(self, other) -> bool:
+        if type(other) is not type(self):
+            return NotImplemented
+        return self.to_json() == other.to_json()
+
+    def __repr__(self) -> str:
+        return '{}({})'.format(type(self).__name__,
+                               ', '.join('{}={!r}'.format(key, getattr(self, key)) for _, key, _ in self._parsers))
+
+class SbankenAccount(SbankenObject):
     'Objectify Sbanken account'
     # properties defined in Sbanken json structs
     # {'accountNumber': '', # str
     # 'accountType': 'Standard account',
-    # 'available': 0.01, # float
-    # 'balance': 0.01, # float
+    # 'available': 0.01, # Decimal
+    # 'balance': 0.01, # Decimal
     # 'creditLimit': 0.0,
     # 'customerId': '', # str, norwegian ssn
     # 'defaultAccount': False, # boolean
     # 'name': '', # str
     # 'ownerCustomerId': '' # str, norwegian ssn}
-    accountNumber = jsonobject.StringProperty()
-    accountType = jsonobject.StringProperty()
-    available = jsonobject.FloatProperty()
-    balance = jsonobject.FloatProperty()
-    creditLimit = jsonobject.FloatProperty()
-    customerId = jsonobject.StringProperty()
-    defaultAccount = jsonobject.BooleanProperty()
-    name = jsonobject.StringProperty()
-    ownerCustomerId = jsonobject.StringProperty()
+    __slots__ = ('accountNumber', 'accountType', 'available', 'balance', 'creditLimit',
+                 'customerId', 'defaultAccount', 'name', 'ownerCustomerId')
+    _decimals = ('available', 'balance', 'creditLimit')
 
 class Account:
     def __init__(self, client:'SbankenClient', accountData:dict):
         'Init the object with a SbankenClient object and a json dict '
         self.client = client
-        self.details = SbankenAccount(accountData)
+        self.details = accountData if isinstance(accountData, SbankenAccount) else SbankenAccount(accountData)
 
     def __str__(self) -> str:
         return '<Account: {}, account # {}>'.format(self.details.name, self.details.accountNumber)
 
-    def update(self) -> None:
-        'Get new details from server about balance etc'
-        self.details  = self.client.accountDetails(self.details.accountNumber)
+    def update(self, stale:bool=True) -> None:
+        'Get new details from server about balance etc. See AsyncSbankenClient._request() for `stale`'
+        self.details  = self.client.accountDetails(self.details.accountNumber, stale=stale)
 
-    def latest(self) -> list:
-        'Return last transactions on the account'
-        return self.client.transactions(self.details.accountNumber)
+    def latest(self, limit:int=None, startDate=None, endDate=None) -> list:
+        'Return last transactions on the account, at most `limit` of them, optionally between two dates'
+        return self.client.transactions(self.details.accountNumber, startDate=startDate, endDate=endDate, limit=limit)
 
-class SbankenPhoneNumber(jsonobject.JsonObject):
+class SbankenPhoneNumber(SbankenObject):
     'Sbanken Phone Number object'
     #                 {'countryCode': '', 'number': ''}], 
-    countryCode = jsonobject.StringProperty()
-    number = jsonobject.StringProperty()
+    __slots__ = ('countryCode', 'number')
 
-class SbankenAddress(jsonobject.JsonObject):
+class SbankenAddress(SbankenObject):
     'Sbanken Address object'
     #{'addressLine1': '',
     #                 'addressLine2': '',
@@ -71,15 +211,9 @@ class SbankenAddress(jsonobject.JsonObject):
     #                 'city': None,
     #                 'country': '',
     #                 'zipCode': None},
-    addressLine1 = jsonobject.StringProperty()
-    addressLine2 = jsonobject.StringProperty()
-    addressLine3 = jsonobject.StringProperty()
-    addressLine4 = jsonobject.StringProperty()
-    city = jsonobject.StringProperty()
-    country = jsonobject.StringProperty()
-    zipCode = jsonobject.StringProperty()
-
-class SbankenUser(jsonobject.JsonObject):
+    __slots__ = ('addressLine1', 'addressLine2', 'addressLine3', 'addressLine4', 'city', 'country', 'zipCode')
+
+class SbankenUser(SbankenObject):
     'Objectify Sbanken User'
     # properties defined in Sbanken json structs
     # {'customerId': '', # str, norwegian ssn
@@ -103,21 +237,18 @@ class SbankenUser(jsonobject.JsonObject):
     #                 'city': '',
     #                 'country': None,
     #                 'zipCode': ''}
-    customerId = jsonobject.StringProperty()
-    dateOfBirth = jsonobject.DefaultProperty() # TODO: use DateTimeProperty()
-    emailAddress = jsonobject.StringProperty()
-    firstName = jsonobject.StringProperty()
-    lastName = jsonobject.StringProperty()
-    phoneNumbers = jsonobject.ListProperty(SbankenPhoneNumber)
-    postalAddress = jsonobject.ObjectProperty(SbankenAddress)
-    streetAddress = jsonobject.ObjectProperty(SbankenAddress)
-
-class SbankenTransaction(jsonobject.JsonObject):
+    __slots__ = ('customerId', '_dateOfBirth', 'emailAddress', 'firstName', 'lastName',
+                 'phoneNumbers', 'postalAddress', 'streetAddress')
+    _objects = {'postalAddress': SbankenAddress, 'streetAddress': SbankenAddress}
+    _lists = {'phoneNumbers': SbankenPhoneNumber}
+    dateOfBirth = LazyDate()
+
+class SbankenTransaction(SbankenObject):
     'Objectify Sbanken Transaction'
     # properties defined in Sbanken json structs
     #  {'accountNumber': '', # str
     # 'accountingDate': '2018-01-22T00:00:00+01:00',
-    # 'amount': 1.5, # float
+    # 'amount': 1.5, # Decimal
     # 'customerId': '', # str, norwegian ssn
     # 'interestDate': '2018-01-21T00:00:00+01:00',
     # 'otherAccountNumber': None,
@@ -125,82 +256,825 @@ class SbankenTransaction(jsonobject.JsonObject):
     # 'text': '', # str
     # 'transactionId': '', # str
     # 'transactionType': 'RKI'} # one of RKI, 
-    accountNumber = jsonobject.StringProperty()
-    accountingDate = jsonobject.DefaultProperty() # TODO: use DateTimeProperty()
-    amount = jsonobject.FloatProperty()
-    customerId = jsonobject.StringProperty()
-    interestDate = jsonobject.DefaultProperty() # TODO: use DateTimeProperty()
-    otherAccountNumber = jsonobject.StringProperty()
-    registrationDate = jsonobject.DefaultProperty() # TODO: use DateTimeProperty()
-    text = jsonobject.StringProperty()
-    transactionId = jsonobject.StringProperty()
-    transactionType = jsonobject.StringProperty()
+    __slots__ = ('accountNumber', '_accountingDate', 'amount', 'customerId', '_interestDate',
+                 'otherAccountNumber', '_registrationDate', 'text', 'transactionId', 'transactionType')
+    _decimals = ('amount',)
+    accountingDate = LazyDate()
+    interestDate = LazyDate()
+    registrationDate = LazyDate()
 
-class SbankenClient:
-    def __init__(self, config: configparser.ConfigParser):
+def errorClass(status) -> str:
+    'Return what kind of error an http status code (or exception name) is: auth, rate_limit, validation, server or network. None for success'
+    if isinstance(status, str):
+        return 'auth' if status == 'expired' else 'network'
+    if status in (401, 403):
+        return 'auth'
+    if status == 429:
+        return 'rate_limit'
+    if 400 <= status < 500:
+        return 'validation'
+    if status >= 500:
+        return 'server'
+    return None
+
+ERRORS = {'auth': SbankenAuthError, 'rate_limit': SbankenRateLimitError, 'validation': SbankenValidationError,
+          'server': SbankenServerError, 'network': SbankenUnavailableError}
+
+def responseError(r:requests.Response) -> SbankenError:
+    'Return the right SbankenError for a failed http response'
+    try:
+        reply = r.json()
+    except ValueError:
+        reply = None
+    message = (reply or {}).get('errorMessage') if isinstance(reply, dict) else None
+    e = ERRORS.get(errorClass(r.status_code), SbankenError)(message or '{} {}'.format(r.status_code, r.reason),
+                                                           status=r.status_code, reply=reply)
+    if r.status_code == 429:
+        try:
+            e.retryAfter = float(r.headers.get('Retry-After'))
+        except (TypeError, ValueError):
+            pass
+    return e
+
+def tokenError(e:Exception) -> SbankenError:
+    'Return the right SbankenError for an error from fetching a token'
+    if isinstance(e, SbankenError):
+        return e
+    if isinstance(e, requests.RequestException):
+        return SbankenUnavailableError('token: {}'.format(e))
+    if isinstance(e, OAuth2Error):
+        return SbankenAuthError('Could not log in: {}'.format(e), status=e.status_code)
+    return SbankenError('Could not log in: {!r}'.format(e))
+
+def parseTimeout(value:str) -> tuple:
+    'Parse "3.05, 10" to a (connect, read) timeout in seconds, or "10" to the same for both'
+    parts = [float(v) for v in value.split(',')]
+    return (parts[0], parts[-1])
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+# the class of each endpoint, for rate limits and priorities. others are 'balance'
+ENDPOINT_CLASSES = {'transferMethod': 'transfer',
+                    'accountList': 'balance', 'accountDetails': 'balance', 'customerDetails': 'balance',
+                    'transactionList': 'history'}
+PRIORITIES = ('transfer', 'balance', 'history') # first in line first
+# requests per second, and burst, per endpoint class. see [ratelimit] in config.ini.example
+RATE_LIMITS = {'transfer': (5, 10), 'balance': (10, 20), 'history': (5, 10)}
+
+def endpointClass(endpoint:str) -> str:
+    return ENDPOINT_CLASSES.get(endpoint, 'balance')
+
+def parseRate(value:str) -> tuple:
+    'Parse "5, 10" to (5 requests per second, bursts of 10), or "5" to the same for both'
+    parts = [float(v) for v in value.split(',')]
+    return (parts[0], parts[-1])
+
+class TokenBucket:
+    '''Let `rate` requests per second through on average, and bursts of up to `burst`.
+
+    `await bucket.take()` returns right away while there are tokens left,
+    and otherwise waits for the next one. Waiting requests go in the order
+    they came. Use it from one event loop.
+    '''
+    def __init__(self, rate:float, burst:float):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = self.burst # below 0 when requests are waiting for tokens
+        self.waiting = 0
+        self._stamp = time.monotonic()
+
+    def _fill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self._stamp) * self.rate)
+        self._stamp = now
+
+    async def take(self) -> float:
+        'Take a token, waiting for it if need be. Returns the seconds waited'
+        self._fill()
+        self.tokens -= 1 # ours, even if it comes later
+        if self.tokens >= 0:
+            return 0.0
+        wait = -self.tokens / self.rate
+        self.waiting += 1
+        try:
+            await asyncio.sleep(wait)
+        except asyncio.CancelledError:
+            self._fill()
+            self.tokens += 1 # give it back
+            raise
+        finally:
+            self.waiting -= 1
+        return wait
+
+class CircuitBreaker:
+    '''Stop calling the bank for a while when it keeps failing.
+
+    After `threshold` failures in a row the breaker opens, and requests fail
+    right away (or are served from the cache) for `resetTimeout` seconds.
+    Then it is half open, and lets one request through to try: if that works
+    the breaker closes again, if not it opens for another `resetTimeout`.
+    Use it from one thread, like the client event loop.
+    '''
+    def __init__(self, threshold:int=5, resetTimeout:float=30):
+        self.threshold = threshold
+        self.resetTimeout = resetTimeout
+        self.failures = 0 # in a row
+        self.openedAt = None
+        self._trial = False # a half open trial request is in flight
+
+    @property
+    def state(self) -> str:
+        if self.openedAt is None:
+            return CLOSED
+        if time.monotonic() - self.openedAt < self.resetTimeout:
+            return OPEN
+        return HALF_OPEN
+
+    def allow(self) -> bool:
+        'Return True if a request may go to the bank now'
+        state = self.state
+        if state == CLOSED:
+            return True
+        if state == OPEN or self._trial:
+            return False
+        self._trial = True
+        return True
+
+    def success(self):
+        self.failures = 0
+        self.openedAt = None
+        self._trial = False
+
+    def failure(self):
+        self.failures += 1
+        if self.openedAt is not None or self.failures >= self.threshold:
+            if self.state != OPEN:
+                logging.warning('Bank failed %i times in a row, pausing requests for %g s', self.failures, self.resetTimeout)
+            self.openedAt = time.monotonic()
+        self._trial = False
+
+class TokenManager:
+    '''Keep a valid OAuth2 token on a session.
+
+    The token is refreshed in the background `margin` seconds before it
+    expires, or right away if the server rejects it. If `cacheFile` is set,
+    tokens are shared through that file (keyed by client id), so several
+    processes on the same host only hit the identity server once between
+    them. The file is locked while a process refreshes. Errors are raised
+    as the SbankenError that fits, see tokenError().
+    '''
+    def __init__(self, session:OAuth2Session, tokenUrl:str, auth:HTTPBasicAuth, cacheFile:str=None, margin:float=60,
+                 metrics:Metrics=None, timeout:tuple=None):
+        self.session = session
+        self.tokenUrl = tokenUrl
+        self.auth = auth
+        self.cacheFile = os.path.expanduser(cacheFile) if cacheFile else None
+        self.margin = margin
+        self.timeout = timeout # (connect, read) seconds for the identity server
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.refreshes = 0 # number of tokens fetched from the identity server
+        self._lock = None # asyncio.Lock, created on the running loop
+        self._timer = None # asyncio.TimerHandle for the next background refresh
+        session.register_compliance_hook('access_token_response', self._checkResponse)
+
+    @property
+    def token(self) -> dict:
+        return self.session.token or None
+
+    @property
+    def accessToken(self) -> str:
+        return (self.session.token or {}).get('access_token')
+
+    def valid(self, token:dict=None, margin:float=0) -> bool:
+        'Return True if token (or the current token) will still be valid in `margin` seconds'
+        token = token or self.session.token
+        if not token or not token.get('access_token'):
+            return False
+        return token.get('expires_at', 0) - margin > time.time()
+
+    async def ensure(self) -> dict:
+        'Make sure we have a token that is valid right now'
+        if not self.valid(margin=5):
+            await self.refresh()
+        return self.token
+
+    async def refresh(self, rejected:str=None) -> dict:
+        '''Get a new token, from the cache file or the identity server.
+
+        Pass the access token that the server `rejected`, so it isn't picked up from
+        the cache file again.'''
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if rejected is not None and self.accessToken != rejected and self.valid(margin=5):
+                return self.token # someone else refreshed while we waited for the lock
+            loop = asyncio.get_running_loop()
+            self.session.token = await loop.run_in_executor(None, self._refreshLocked, rejected)
+            self._schedule(loop)
+            return self.token
+
+    def stop(self):
+        'Cancel the background refresh'
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def _schedule(self, loop, delay:float=None):
+        'Set up the next background refresh'
+        self.stop()
+        if delay is None:
+            delay = max(self.session.token.get('expires_at', 0) - self.margin - time.time(), 1)
+        logging.debug('next token refresh in %.0f s', delay)
+        self._timer = loop.call_later(delay, lambda: loop.create_task(self._backgroundRefresh()))
+
+    async def _backgroundRefresh(self):
+        try:
+            await self.refresh(rejected=self.accessToken)
+        except Exception as e:
+            logging.warning('Could not refresh token, trying again soon: %r', e)
+            self._schedule(asyncio.get_running_loop(), delay=min(30, self.margin))
+
+    def _refreshLocked(self, rejected:str=None) -> dict:
+        'blocking: take the cache file lock, and use the cached token or fetch a new one'
+        if self.cacheFile is None:
+            return self._fetch()
+        os.makedirs(os.path.dirname(self.cacheFile) or '.', exist_ok=True)
+        with open(self.cacheFile + '.lock', 'a') as lockfile:
+            fcntl.flock(lockfile, fcntl.LOCK_EX)
+            try:
+                cached = self._readCache().get(self.session.client_id)
+                if self.valid(cached, margin=self.margin) and cached.get('access_token') != rejected:
+                    logging.debug('using token from %s', self.cacheFile)
+                    self.metrics.count('token_refreshes', source='cache')
+                    return cached
+                token = self._fetch()
+                self._writeCache(token)
+                return token
+            finally:
+                fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+    def _checkResponse(self, r:requests.Response) -> requests.Response:
+        'the identity server failed, or wants us to slow down: raise that, instead of reading the error page as a token'
+        if r.status_code == 429 or r.status_code >= 500:
+            raise responseError(r)
+        return r
+
+    def _fetch(self) -> dict:
+        'blocking: fetch a new token from the identity server'
+        started = time.perf_counter()
+        try:
+            token = dict(self.session.fetch_token(token_url=self.tokenUrl, auth=self.auth, timeout=self.timeout))
+        except Exception as e:
+            self.metrics.count('errors', endpoint='token', error=type(e).__name__)
+            raise tokenError(e) from e
+        finally:
+            self.metrics.observe('request_seconds', time.perf_counter() - started, endpoint='token')
+        token.setdefault('expires_at', time.time() + float(token.get('expires_in', 3600)))
+        self.refreshes += 1
+        self.metrics.count('token_refreshes', source='server')
+        logging.debug('fetched new token, expires in %s s', token.get('expires_in'))
+        return token
+
+    def _readCache(self) -> dict:
+        try:
+            with open(self.cacheFile) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _writeCache(self, token:dict):
+        'write the cache file atomically, readable only by us'
+        cache = self._readCache()
+        cache[self.session.client_id] = token
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self.cacheFile) or '.', prefix='.token')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(cache, f)
+            os.replace(tmp, self.cacheFile)
+        except OSError:
+            logging.exception('Could not write token cache %s', self.cacheFile)
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+
+class TTLCache:
+    '''A small LRU cache for api replies, where entries expire after a time to live.
+
+    `ttl` is a dict of endpoint name -> seconds. Replies from endpoints without
+    a ttl are not cached. When there are more than `maxsize` entries, the least
+    recently used one is dropped. Look at `.hits` and `.misses` (or `.stats()`)
+    to see how well it works.
+
+    Any object with the same get/put/invalidate methods can be passed to the
+    client instead.
+    '''
+    def __init__(self, ttl:dict=None, maxsize:int=256):
+        self.ttl = ttl if ttl is not None else {}
+        self.maxsize = maxsize
+        self._entries = OrderedDict() # key -> (expires, reply)
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def fromConfig(cls, config: configparser.ConfigParser) -> 'TTLCache':
+        'Set up a cache from the optional [cache] section of the config'
+        ttl = {'customerDetails': 3600, 'accountList': 30, 'accountDetails': 30}
+        maxsize = 256
+        if config.has_section('cache'):
+            for name in config.options('cache'):
+                if name == 'maxSize':
+                    maxsize = config.getint('cache', name)
+                else:
+                    ttl[name] = config.getfloat('cache', name)
+        return cls(ttl, maxsize)
+
+    @staticmethod
+    def key(endpoint:str, customerId:str, **kwargs) -> tuple:
+        return (endpoint, customerId, tuple(sorted(kwargs.items())))
+
+    def get(self, key:tuple):
+        'Return the cached reply for key, or None. Replies are shared, so do not change them'
+        if not self.ttl.get(key[0]):
+            return None
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def stale(self, key:tuple):
+        'Return the cached reply for key even if it has expired, or None. For when the bank is down'
+        entry = self._entries.get(key)
+        return entry[1] if entry is not None else None
+
+    def put(self, key:tuple, reply:dict):
+        'Cache the reply for key, if its endpoint has a ttl'
+        ttl = self.ttl.get(key[0])
+        if not ttl:
+            return
+        self._entries[key] = (time.monotonic() + ttl, reply)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, endpoint:str=None, **kwargs):
+        '''Expire cached replies from endpoint (or all endpoints), for the arguments given.
+
+        They are kept for stale(), until they are pushed out.'''
+        for key, (expires, reply) in list(self._entries.items()):
+            if endpoint is not None and key[0] != endpoint:
+                continue
+            args = dict(key[2])
+            if all(args.get(k) == v for k, v in kwargs.items()):
+                self._entries[key] = (float('-inf'), reply)
+
+    def stats(self) -> dict:
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries)}
+
+class FairScheduler:
+    '''Share `slots` requests in flight between customers, by priority, and fairly.
+
+    Use `async with scheduler.slot(customer, priority):` around each
+    request, with a priority from 0 (first) to `priorities` - 1. While
+    requests are waiting, each free slot goes to the highest priority that
+    has any, and within it to the next waiting customer in turn (round
+    robin), so a customer with many requests can not starve the others. Use
+    it from one event loop.
+    '''
+    def __init__(self, slots:int, priorities:int=1):
+        self.slots = slots
+        self.busy = 0
+        # per priority: customer -> deque of futures, next in turn first
+        self.waiting = [OrderedDict() for _ in range(priorities)]
+
+    def depth(self, priority:int=None) -> int:
+        'Return the number of requests waiting for a slot, at priority or at all'
+        levels = self.waiting if priority is None else [self.waiting[priority]]
+        return sum(len(q) for level in levels for q in level.values())
+
+    async def acquire(self, customer:str, priority:int=0):
+        if self.busy < self.slots and not any(self.waiting):
+            self.busy += 1
+            return
+        waiting = self.waiting[priority]
+        future = asyncio.get_running_loop().create_future()
+        waiting.setdefault(customer, deque()).append(future)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release() # got the slot just as we were cancelled, pass it on
+            else:
+                queue = waiting.get(customer)
+                if queue is not None and future in queue:
+                    queue.remove(future)
+                    if not queue:
+                        del waiting[customer]
+            raise
+
+    def release(self):
+        'Give the slot to the next customer in turn at the highest priority waiting, or free it'
+        for waiting in self.waiting:
+            while waiting:
+                customer, queue = next(iter(waiting.items()))
+                future = queue.popleft()
+                if queue:
+                    waiting.move_to_end(customer) # back of the line
+                else:
+                    del waiting[customer]
+                if not future.done():
+                    future.set_result(None) # the slot is theirs now, busy stays the same
+                    return
+        self.busy -= 1
+
+    def slot(self, customer:str, priority:int=0) -> '_Slot':
+        return _Slot(self, customer, priority)
+
+class _Slot:
+    def __init__(self, scheduler:FairScheduler, customer:str, priority:int):
+        self.scheduler = scheduler
+        self.customer = customer
+        self.priority = priority
+
+    async def __aenter__(self):
+        await self.scheduler.acquire(self.customer, self.priority)
+
+    async def __aexit__(self, *exc):
+        self.scheduler.release()
+
+class SbankenPool:
+    '''Connections, worker threads and an event loop, shared by the clients of many customers.
+
+    Pass the same pool to the clients of every customer on a host, and they
+    share one keep-alive connection pool, `maxConcurrent` requests in flight
+    (transfers first, then balances, then history, and fairly between
+    customers, see FairScheduler), and one event
+    loop thread for the blocking SbankenClient. Each client keeps its own
+    token, cache and circuit breaker. Clients with the same credentials share
+    their rate limits, see rateLimits().
+
+    With `metrics`, the time each request waited for a slot is observed as
+    `queue_seconds`, and the number of requests waiting set as the gauge
+    `queue_depth`, both by endpoint class.
+    '''
+    def __init__(self, maxConcurrent:int=4, metrics:Metrics=None):
+        self.maxConcurrent = maxConcurrent
+        self.metrics = metrics
+        # keep connections alive between requests, one per concurrent request
+        self.adapter = HTTPAdapter(pool_connections=2, pool_maxsize=maxConcurrent)
+        self.executor = ThreadPoolExecutor(max_workers=maxConcurrent, thread_name_prefix='sbanken')
+        self.scheduler = FairScheduler(maxConcurrent, len(PRIORITIES))
+        self.loop = None
+        self.buckets = {} # client id -> endpoint class -> TokenBucket
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def rateLimits(self, clientId:str, limits:dict) -> dict:
+        'Return a TokenBucket per endpoint class for clientId, from limits (class -> (rate, burst)) the first time'
+        with self._lock:
+            if clientId not in self.buckets:
+                self.buckets[clientId] = {name:TokenBucket(rate, burst) for name, (rate, burst) in limits.items() if rate > 0}
+            return self.buckets[clientId]
+
+    def mount(self, session:requests.Session):
+        session.mount('https://', self.adapter)
+        session.mount('http://', self.adapter)
+
+    async def call(self, customer:str, fn, *args, priority:int=0, **kwargs):
+        'run a blocking call in the thread pool, when the scheduler gives customer a slot'
+        loop = asyncio.get_running_loop()
+        queued = time.perf_counter()
+        self._gauge(priority)
+        async with self.scheduler.slot(customer, priority):
+            if self.metrics is not None:
+                self.metrics.observe('queue_seconds', time.perf_counter() - queued, endpoint=PRIORITIES[priority])
+            self._gauge(priority)
+            return await loop.run_in_executor(self.executor, lambda: fn(*args, **kwargs))
+
+    def _gauge(self, priority:int):
+        if self.metrics is not None:
+            self.metrics.gauge('queue_depth', self.scheduler.depth(priority), endpoint=PRIORITIES[priority])
+
+    def startLoop(self) -> asyncio.AbstractEventLoop:
+        'Return the shared event loop, running in a background thread'
+        with self._lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(target=self.loop.run_forever, name='sbanken-loop', daemon=True)
+                self._thread.start()
+            return self.loop
+
+    def close(self):
+        'Stop the event loop and close all pooled connections'
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self._thread.join()
+            self.loop = None
+        self.executor.shutdown(wait=False)
+        self.adapter.close()
+
+class AsyncSbankenClient:
+    '''asyncio client for Sbanken. All api methods are coroutines.
+
+    Requests go through one keep-alive connection pool, and are run in a
+    small thread pool so they don't block the event loop. At most
+    `maxConcurrent` requests are in flight at the same time, set it in the
+    optional [client] section of the config, or pass it in.
+
+    Replies are cached in `.cache`, a TTLCache set up from the config unless
+    you pass in your own.
+
+    Each request has a (connect, read) timeout, from the optional [timeouts]
+    section. GET requests that fail with a network or server error, or are
+    rate limited, are tried again `retries` times, after a random wait of up
+    to `retryBase` * 2**attempt seconds (at most `retryMax`). Other requests,
+    like transfers, are never repeated here. When the bank keeps failing, the
+    CircuitBreaker in `.breaker` opens, and requests fail fast. While the
+    bank is failing, GETs are answered from the cache, even if the cached
+    reply has expired, when there is one. Errors are raised as the
+    SbankenError subclass that fits.
+
+    Every request is counted and timed in `.metrics`, see metrics.py: the
+    counters `requests` (by endpoint, method and status), `errors` (by
+    endpoint and errorClass()), `cache` (hits and misses by endpoint),
+    `token_refreshes` and `token_rejected`, and the histogram
+    `request_seconds` by endpoint.
+
+    Requests are rate limited per endpoint class (transfers, balances and
+    history, see ENDPOINT_CLASSES) with a TokenBucket each, from the
+    optional [ratelimit] section. The time spent waiting for a token is the
+    histogram `ratelimit_seconds`. When all `maxConcurrent` slots are busy,
+    transfers get the next free slot before balances, and balances before
+    history. queues() shows how many requests are waiting.
+
+    The credentials and customer id are read from the [secrets] section, or
+    the section named by `secrets`. To serve several customers from one
+    process, give their clients the same SbankenPool.
+    '''
+    def __init__(self, config: configparser.ConfigParser, maxConcurrent:int=None, cache:TTLCache=None,
+                 metrics:Metrics=None, pool:SbankenPool=None, secrets:str='secrets'):
         self.config = config
-        self.customerId = config.get('secrets', 'customerId')
+        self._ownMetrics = metrics is None
+        self.metrics = metrics if metrics is not None else Metrics.fromConfig(config)
+        self.customerId = config.get(secrets, 'customerId')
         # read all endpoints from config into a dict
         # TODO make this more readable
         self.endpoints = { x:'{baseUrl}{endpoint}'.format(baseUrl=config.get('api', 'baseUrl'), endpoint=config.get('api', x)) for x in config.options('api')}
         logging.debug('endp: %r', self.endpoints)
+        self._ownPool = pool is None
+        self.pool = pool if pool is not None else SbankenPool(maxConcurrent or config.getint('client', 'maxConcurrent', fallback=4),
+                                                              self.metrics)
+        self.maxConcurrent = self.pool.maxConcurrent
+        self.pageSize = config.getint('client', 'pageSize', fallback=100)
+        self.retries = config.getint('client', 'retries', fallback=3)
+        self.retryBase = config.getfloat('client', 'retryBase', fallback=0.25)
+        self.retryMax = config.getfloat('client', 'retryMax', fallback=5)
+        self.breaker = CircuitBreaker(config.getint('client', 'breakerThreshold', fallback=5),
+                                      config.getfloat('client', 'breakerReset', fallback=30))
+        # (connect, read) timeouts in seconds, per endpoint
+        self.timeouts = {'default': (3.05, 10), 'transferMethod': (3.05, 30)}
+        if config.has_section('timeouts'):
+            self.timeouts.update({name:parseTimeout(config.get('timeouts', name)) for name in config.options('timeouts')})
         # log in with oauth2 authentication
-        client_id = quote(config.get('secrets', 'clientId'))
-        client_secret = quote(config.get('secrets', 'password'))
+        client_id = quote(config.get(secrets, 'clientId'))
+        client_secret = quote(config.get(secrets, 'password'))
         self.auth = HTTPBasicAuth(client_id, client_secret)
         client = BackendApplicationClient(client_id=client_id)
         self.session = OAuth2Session(client=client)
-        self.fetch_token()
+        self.pool.mount(self.session)
+        # requests per second per endpoint class, shared with other clients with the same credentials
+        limits = dict(RATE_LIMITS)
+        if config.has_section('ratelimit'):
+            limits.update({name:parseRate(config.get('ratelimit', name)) for name in config.options('ratelimit')})
+        self.buckets = self.pool.rateLimits(client_id, limits)
+        self.tokens = TokenManager(self.session,
+                                   config.get('login', 'identityServer'),
+                                   self.auth,
+                                   cacheFile=config.get('login', 'tokenCache', fallback=None),
+                                   margin=config.getfloat('login', 'tokenRefreshMargin', fallback=60),
+                                   metrics=self.metrics,
+                                   timeout=self.timeout('token'))
+        self.cache = cache if cache is not None else TTLCache.fromConfig(config)
 
-    def fetch_token(self):
-        self.token = self.session.fetch_token(token_url=self.config.get('login', 'identityServer'), 
-                                              auth=self.auth)
+    async def _call(self, endpoint:str, fn, *args, **kwargs):
+        '''run a blocking call for endpoint from the session in the thread pool,
+        when the rate limit of its class lets it through, and the pool has a slot for it'''
+        kind = endpointClass(endpoint)
+        bucket = self.buckets.get(kind)
+        if bucket is not None:
+            waited = await bucket.take()
+            self.metrics.observe('ratelimit_seconds', waited, endpoint=kind)
+        return await self.pool.call(self.customerId, fn, *args, priority=PRIORITIES.index(kind), **kwargs)
+
+    def queues(self) -> dict:
+        'Return, per endpoint class, the requests waiting for the rate limit and for a slot, and the tokens left'
+        queues = {}
+        for priority, kind in enumerate(PRIORITIES):
+            bucket = self.buckets.get(kind)
+            queues[kind] = {'slot': self.pool.scheduler.depth(priority),
+                            'rateLimit': bucket.waiting if bucket is not None else 0,
+                            'tokens': round(bucket.tokens, 2) if bucket is not None else None}
+        return queues
+
+    def timeout(self, endpoint:str) -> tuple:
+        'Return the (connect, read) timeout for endpoint'
+        return self.timeouts.get(endpoint, self.timeouts['default'])
+
+    @property
+    def token(self) -> dict:
+        return self.tokens.token
 
-    def __request(self, endpoint: str, method='GET', customerId=None, **kwargs):
-        'internal method to run request through Oauth session, and return response body or raise error'
-        headers = {'User-Agent':'grisebank@lurtgjort.no'}
+    async def fetch_token(self):
+        'Make sure we have a valid token, from the token cache or the identity server'
+        return await self.tokens.ensure()
+
+    async def _request(self, endpoint: str, method='GET', customerId=None, json=None, params=None, stale:bool=True, **kwargs):
+        '''internal method to run request through Oauth session, and return response body or raise error
+
+        When the bank fails, an expired reply from the cache is returned
+        instead, if we have one. With `stale` False, the error is raised, for
+        callers that need to know if the bank answered.'''
         if customerId is None:
             raise SbankenError('Need customerId for transaction')
-        r = self.session.request(url=self.endpoints.get(endpoint).format(**kwargs), 
-                                 method=method,
-                                 headers={'customerId':customerId})
-
-        #TODO: also add POST with json payload  --- see .transfer()
-        if r.ok:  # got HTTP 200
-            reply = r.json() 
-            if not reply.get('isError'):
-                # no api errors
+        cacheKey = None
+        if method == 'GET':
+            cacheKey = self.cache.key(endpoint, customerId, **kwargs, **(params or {}))
+            reply = self.cache.get(cacheKey)
+            if reply is not None:
+                self.metrics.count('cache', endpoint=endpoint, result='hit')
+            elif getattr(self.cache, 'ttl', {}).get(endpoint):
+                self.metrics.count('cache', endpoint=endpoint, result='miss')
+            if reply is not None:
                 return reply
-            # we have an error
-            raise SbankenError(reply)
-        else:
-            raise SbankenError(r)
+        if not self.breaker.allow():
+            return self._stale(endpoint, cacheKey if stale else None, SbankenUnavailableError('Not calling the bank for a while, it keeps failing'))
+        retries = self.retries if method == 'GET' else 0 # only safe requests are repeated
+        for attempt in range(retries + 1):
+            try:
+                reply = await self._send(endpoint, method, customerId, json, params, kwargs)
+            except (SbankenServerError, SbankenUnavailableError) as e:
+                self.breaker.failure()
+                error = e
+            except SbankenRateLimitError as e:
+                error = e
+            except SbankenError:
+                self.breaker.success() # the bank is up, it just didn't like the request
+                raise
+            else:
+                self.breaker.success()
+                if cacheKey is not None:
+                    self.cache.put(cacheKey, reply)
+                return reply
+            if attempt == retries or self.breaker.state != CLOSED:
+                break
+            delay = random.uniform(0, min(self.retryMax, self.retryBase * 2 ** attempt))
+            if isinstance(error, SbankenRateLimitError) and error.retryAfter is not None:
+                if error.retryAfter > self.retryMax:
+                    break
+                delay = max(delay, error.retryAfter)
+            logging.info('%s failed (%s), trying again in %.2f s', endpoint, error, delay)
+            self.metrics.count('retries', endpoint=endpoint)
+            await asyncio.sleep(delay)
+        return self._stale(endpoint, cacheKey if stale else None, error)
 
-    @property
-    def me(self) -> dict:
+    def _stale(self, endpoint:str, cacheKey:tuple, error:SbankenError) -> dict:
+        'return an expired cached reply for cacheKey, if we have one, or raise error'
+        stale = getattr(self.cache, 'stale', None)
+        reply = stale(cacheKey) if cacheKey is not None and stale is not None else None
+        if reply is None:
+            raise error
+        logging.warning('%s failed (%s), using an old reply from the cache', endpoint, error)
+        self.metrics.count('cache', endpoint=endpoint, result='stale')
+        return reply
+
+    async def _send(self, endpoint:str, method:str, customerId:str, json:dict, params:dict, kwargs:dict) -> dict:
+        'send one request, getting a new token and trying once more if the token is rejected'
+        headers = {'User-Agent':'grisebank@lurtgjort.no',
+                   'customerId':customerId}
+        rejected = None
+        for retry in (True, False):
+            started = time.perf_counter()
+            try:
+                if rejected is not None:
+                    await self.tokens.refresh(rejected=rejected)
+                await self.tokens.ensure()
+                accessToken = self.tokens.accessToken
+                started = time.perf_counter()
+                r = await self._call(endpoint, self.session.request,
+                                     url=self.endpoints.get(endpoint).format(**kwargs), 
+                                     method=method,
+                                     headers=headers,
+                                     params=params, # query string
+                                     json=json, # transfer as JSON-Encoded POST/PATCH data
+                                     timeout=self.timeout(endpoint))
+            except TokenExpiredError as e:
+                r = e
+            except OAuth2Error as e:
+                raise SbankenAuthError('Could not log in: {}'.format(e), status=e.status_code)
+            except requests.RequestException as e:
+                self._measure(endpoint, method, started, type(e).__name__)
+                raise SbankenUnavailableError('{} {}: {}'.format(method, endpoint, e))
+            self._measure(endpoint, method, started, 'expired' if isinstance(r, TokenExpiredError) else r.status_code)
+            if retry and (isinstance(r, TokenExpiredError) or r.status_code == 401):
+                # token was rejected, get a new one and try once more
+                logging.info('token rejected by %s, refreshing', endpoint)
+                self.metrics.count('token_rejected', endpoint=endpoint)
+                rejected = accessToken
+                continue
+            break
+        if isinstance(r, TokenExpiredError):
+            raise SbankenAuthError(r)
+        if not r.ok:
+            raise responseError(r)
+        reply = r.json() 
+        if reply.get('isError'):
+            # the api said no
+            self.metrics.count('errors', endpoint=endpoint, error='api')
+            raise SbankenValidationError(reply.get('errorMessage') or reply, status=r.status_code, reply=reply)
+        return reply
+
+    def _measure(self, endpoint:str, method:str, started:float, status):
+        'count and time one request. status is the http status code, or what went wrong'
+        self.metrics.observe('request_seconds', time.perf_counter() - started, endpoint=endpoint)
+        self.metrics.count('requests', endpoint=endpoint, method=method, status=status)
+        error = errorClass(status)
+        if error is not None:
+            self.metrics.count('errors', endpoint=endpoint, error=error)
+
+    async def me(self) -> 'SbankenUser':
         'Return details about customer'
-        r = self.__request('customerDetails', customerId=self.customerId)
+        r = await self._request('customerDetails', customerId=self.customerId)
         logging.debug('user:%r', r.get('item'))
-        return SbankenUser(r.get('item'))
+        return SbankenUser.from_json(r.get('item'))
 
-    def accounts(self) -> list:
-        'Return a list of all accounts, as Account objects, belonging to customer'
-        r = []
-        for acct in self.__request('accountList', customerId=self.customerId).get('items'):
-            r.append(Account(self, acct))
-        return r
+    async def accounts(self, stale:bool=True) -> list:
+        'Return a list of all accounts, as SbankenAccount objects, belonging to customer'
+        r = await self._request('accountList', customerId=self.customerId, stale=stale)
+        return [SbankenAccount.from_json(acct) for acct in r.get('items')]
 
-    def accountDetails(self, account: str) -> SbankenAccount:
+    async def accountDetails(self, account: str, stale:bool=True) -> SbankenAccount:
         'Return details from one account'
-        r = self.__request('accountDetails', customerId=self.customerId, accountNumber=account)
-        return SbankenAccount(r.get('item'))
+        r = await self._request('accountDetails', customerId=self.customerId, accountNumber=account, stale=stale)
+        return SbankenAccount.from_json(r.get('item'))
+
+    async def accountDetailsMany(self, accounts: list, limit:int=None, stale:bool=True) -> list:
+        '''Return details from many accounts, fetched concurrently, in the same order as `accounts`.
 
-    def transactions(self, account: str) -> dict:
+        With `limit`, at most that many of them are in flight at the same time.'''
+        if limit is None:
+            return await asyncio.gather(*[self.accountDetails(a, stale) for a in accounts])
+        slots = asyncio.Semaphore(limit)
+        async def one(account):
+            async with slots:
+                return await self.accountDetails(account, stale)
+        return await asyncio.gather(*[one(a) for a in accounts])
+
+    async def transactions(self, account: str, startDate=None, endDate=None, limit:int=None) -> list:
         'This operation returns the latest transactions of the given account within the time span set by the start and end date parameters.'
-        # TODO add options index, length, startDate, endDate
-        return [SbankenTransaction(t) for t in self.__request('transactionList', customerId=self.customerId, accountNumber=account).get('items')]
+        return [t async for t in self.iterTransactions(account, startDate, endDate, limit)]
+
+    async def iterTransactions(self, account: str, startDate=None, endDate=None, limit:int=None, pageSize:int=None, stale:bool=True):
+        '''Yield the latest transactions of the given account, newest first, one page at a time.
 
-    def transfer(self, fromAccount: str, toAccount: str, amount: float, message: str) -> dict:
+        startDate and endDate are datetime.date objects or 'YYYY-MM-DD' strings.
+        Stops after `limit` transactions. The next page is fetched while the
+        current one is consumed.'''
+        pageSize = pageSize or self.pageSize
+        if limit is not None:
+            pageSize = min(pageSize, limit)
+        params = {'length': pageSize}
+        for name, value in (('startDate', startDate), ('endDate', endDate)):
+            if value is not None:
+                params[name] = value.strftime('%Y-%m-%d') if isinstance(value, datetime.date) else value
+
+        def fetch(index):
+            return asyncio.ensure_future(self._request('transactionList', customerId=self.customerId,
+                                                       accountNumber=account, params=dict(params, index=index), stale=stale))
+        index = 0
+        yielded = 0
+        page = fetch(index)
+        try:
+            while page is not None:
+                r = await page
+                items = r.get('items') or []
+                index += len(items)
+                more = len(items) == pageSize and index < r.get('availableItems', index + 1)
+                if limit is not None:
+                    more = more and index < limit
+                page = fetch(index) if more else None
+                for t in items:
+                    if limit is not None and yielded >= limit:
+                        return
+                    yield SbankenTransaction.from_json(t)
+                    yielded += 1
+        finally:
+            if page is not None:
+                page.cancel()
+
+    async def transfer(self, fromAccount: str, toAccount: str, amount: Decimal, message: str) -> dict:
         '''Transfer money between your accounts, according to arguments
         
         The details of the transfer to be executed. The fields are as
@@ -227,18 +1101,104 @@ class SbankenClient:
             'fromAccount': fromAccount,
             'toAccount': toAccount,
             'message':message,
-            'amount':amount
+            'amount':float(amount) # json has no Decimal
         }
-        r = self.session.post(self.endpoints.get('transferMethod').format(customerId=self.customerId),
-                              json=transferPayload, # transfer as  JSON-Encoded POST/PATCH data
-                              )
-        if r.ok:  # got HTTP 200
-            reply = r.json() 
-            if not reply.get('isError'):
-                # no api errors
-                return reply
-            # we have an error
-            raise SbankenError(reply)
-        else:
-            raise SbankenError(r)
+        try:
+            return await self._request('transferMethod', method='POST', customerId=self.customerId, json=transferPayload)
+        finally:
+            # balances have changed, even if we didn't get a proper reply
+            for account in (fromAccount, toAccount):
+                self.cache.invalidate('accountDetails', accountNumber=account)
+                self.cache.invalidate('transactionList', accountNumber=account)
+            self.cache.invalidate('accountList')
+
+    def close(self):
+        'Close all pooled connections, and the metrics exporter if we started it'
+        self.tokens.stop()
+        self.session.close()
+        if self._ownPool:
+            self.pool.close()
+        if self._ownMetrics:
+            self.metrics.close()
+
+class SbankenClient:
+    '''Blocking client for Sbanken.
+
+    A thin wrapper that runs an AsyncSbankenClient on the event loop of its
+    SbankenPool, in a background thread. Use `.submit()` to start a coroutine
+    from `.aio` without waiting for it, e.g. from a UI thread.
+    '''
+    def __init__(self, config: configparser.ConfigParser, maxConcurrent:int=None, cache:TTLCache=None,
+                 metrics:Metrics=None, pool:SbankenPool=None, secrets:str='secrets'):
+        self.config = config
+        self.aio = AsyncSbankenClient(config, maxConcurrent, cache, metrics, pool, secrets)
+        self.cache = self.aio.cache
+        self.metrics = self.aio.metrics
+        self.customerId = self.aio.customerId
+        self.endpoints = self.aio.endpoints
+        self.pool = self.aio.pool
+        self.loop = self.pool.startLoop()
+        try:
+            self.fetch_token()
+        except Exception:
+            self.close() # don't leave the event loop and its threads running
+            raise
+
+    def submit(self, coro) -> 'concurrent.futures.Future':
+        'Schedule a coroutine on the client event loop, and return a Future for its result'
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro):
+        'Run a coroutine on the client event loop, and wait for its result'
+        return self.submit(coro).result()
+
+    @property
+    def token(self) -> dict:
+        return self.aio.token
+
+    def fetch_token(self):
+        'Make sure we have a valid token, from the token cache or the identity server'
+        return self.run(self.aio.fetch_token())
+
+    @property
+    def me(self) -> SbankenUser:
+        'Return details about customer'
+        return self.run(self.aio.me())
+
+    def accounts(self) -> list:
+        'Return a list of all accounts, as Account objects, belonging to customer'
+        return [Account(self, acct) for acct in self.run(self.aio.accounts())]
+
+    def accountDetails(self, account: str, stale:bool=True) -> SbankenAccount:
+        'Return details from one account'
+        return self.run(self.aio.accountDetails(account, stale))
+
+    def accountDetailsMany(self, accounts: list, limit:int=None, stale:bool=True) -> list:
+        'Return details from many accounts, fetched concurrently (at most `limit` at a time), in the same order as `accounts`'
+        return self.run(self.aio.accountDetailsMany(accounts, limit, stale))
+
+    def transactions(self, account: str, startDate=None, endDate=None, limit:int=None) -> list:
+        'This operation returns the latest transactions of the given account within the time span set by the start and end date parameters.'
+        return self.run(self.aio.transactions(account, startDate, endDate, limit))
+
+    def iterTransactions(self, account: str, startDate=None, endDate=None, limit:int=None, pageSize:int=None, stale:bool=True):
+        'Yield the latest transactions of the given account, see AsyncSbankenClient.iterTransactions()'
+        transactions = self.aio.iterTransactions(account, startDate, endDate, limit, pageSize, stale)
+        try:
+            while True:
+                try:
+                    yield self.run(transactions.__anext__())
+                except StopAsyncIteration:
+                    return
+        finally:
+            self.run(transactions.aclose())
+
+    def transfer(self, fromAccount: str, toAccount: str, amount: Decimal, message: str) -> dict:
+        'Transfer money between your accounts, see AsyncSbankenClient.transfer()'
+        return self.run(self.aio.transfer(fromAccount, toAccount, amount, message))
 
+    def close(self):
+        'Close the client. The pool (event loop and connections) is closed too, unless it was passed in'
+        self.loop.call_soon_threadsafe(self.aio.tokens.stop)
+        self.run(asyncio.sleep(0)) # wait for the loop to get to it
+        self.aio.close()
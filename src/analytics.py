@@ -0,0 +1,282 @@
+'''Savings statistics per account: weekly and monthly totals, rolling sums, rewards per card and trends.
+
+SavingsAnalytics keeps the transactions of each account in columns, as
+arrays of day numbers (date.toordinal()) and amounts in øre, instead of
+SbankenTransactions with Decimal amounts and date strings, with the net
+of each day in another array. It listens to the TransactionStore, so new
+transactions are added as they are synced, and the totals per day, week,
+month and card are updated with them. Only the first question about an
+account reads its history from the store.
+
+Rewards are found by the transfer tag in the transaction text (see
+ledger.taggedMessage()), and split between cards by the rewards the ledger
+has for that transfer: a transfer of merged rewards has one reward per scan,
+with the card name as its message.
+
+numpy is used for rolling sums and totals over the days if it is
+installed, with plain python as the fallback. The results are the same.
+
+'''
+import re
+import array
+import itertools
+import datetime
+import threading
+import logging
+from decimal import Decimal
+
+from ledger import taggedMessage
+from outbox import DEFAULT_MESSAGE, MERGED_MESSAGE
+
+TAG = re.compile(r' (\([0-9a-f]{8}\))$') # see ledger.transferTag()
+
+_numpy = None
+
+def numpy():
+    'Return the numpy module, or None if it is not installed'
+    global _numpy
+    if _numpy is None:
+        try:
+            import numpy
+            _numpy = numpy
+        except ImportError:
+            logging.debug('numpy is not installed, analytics uses plain python')
+            _numpy = False
+    return _numpy or None
+
+def ore(amount) -> int:
+    'Return an amount in kroner (Decimal, str or float from sqlite) as whole øre'
+    if isinstance(amount, float):
+        return round(amount * 100) # amounts have two decimals, so this is exact
+    return int((Decimal(str(amount)) * 100).to_integral_value())
+
+def kroner(ore:int) -> Decimal:
+    return Decimal(int(ore)).scaleb(-2)
+
+def dayNumber(value) -> int:
+    'Return a date, datetime or date string from the api as a day number, see date.toordinal()'
+    if isinstance(value, str):
+        return datetime.date.fromisoformat(value[:10]).toordinal()
+    if isinstance(value, datetime.datetime):
+        value = value.date()
+    return value.toordinal()
+
+def weekOf(day:int) -> int:
+    'Return the day number of the monday of the week of day'
+    return day - datetime.date.fromordinal(day).weekday()
+
+def monthOf(day:int) -> int:
+    'Return the month of day, counted from year 0'
+    d = datetime.date.fromordinal(day)
+    return d.year * 12 + d.month - 1
+
+def _monthStart(month:int) -> datetime.date:
+    return datetime.date(month // 12, month % 12 + 1, 1)
+
+def _zeros(n:int) -> array.array:
+    return array.array('q', bytes(8 * n))
+
+class AccountColumns:
+    '''The transactions of one account, as columns, with running totals.
+
+    `.days` and `.amounts` (in øre) are arrays with one row per
+    transaction, in the order they arrived. `.net` is an array with the
+    net øre of each day, from day number `.first` on. `.weekly` and
+    `.monthly` map the monday of a week and a month (see monthOf()) to
+    [deposits, withdrawals] in øre, and `.rewards` maps a card name to
+    [count, øre]. Rewards we can't tie to a card are under None.
+    '''
+    def __init__(self, account:str):
+        self.account = account
+        self.days = array.array('l')
+        self.amounts = array.array('q')
+        self.rows = {} # transaction key -> row
+        self.first = None
+        self.net = array.array('q')
+        self.weekly = {}
+        self.monthly = {}
+        self.rewards = {}
+
+    def __len__(self) -> int:
+        return len(self.days)
+
+    def add(self, key:str, day:int, amount:int, cards:list=()) -> bool:
+        '''Add a transaction of amount øre on day. Returns False if we already have it.
+
+        `cards` is a list of (card name, øre) for the rewards in it.'''
+        row = self.rows.get(key)
+        if row is not None:
+            if self.amounts[row] != amount: # the bank changed it, e.g. a reservation that was booked
+                self._count(self.days[row], self.amounts[row], undo=True)
+                self._count(self.days[row], amount)
+                self.amounts[row] = amount
+            return False
+        self.rows[key] = len(self.days)
+        self.days.append(day)
+        self.amounts.append(amount)
+        self._count(day, amount)
+        for card, value in cards:
+            totals = self.rewards.setdefault(card, [0, 0])
+            totals[0] += 1
+            totals[1] += value
+        return True
+
+    def _count(self, day:int, amount:int, undo:bool=False):
+        'add amount to the totals of day, or with `undo`, take it out again'
+        side = 0 if amount >= 0 else 1
+        if undo:
+            amount = -amount
+        if self.first is None:
+            self.first = day
+        if day < self.first:
+            self.net[0:0] = _zeros(self.first - day)
+            self.first = day
+        if day >= self.first + len(self.net):
+            self.net.extend(_zeros(day - self.first - len(self.net) + 1))
+        self.net[day - self.first] += amount
+        for totals, key in ((self.weekly, weekOf(day)), (self.monthly, monthOf(day))):
+            totals.setdefault(key, [0, 0])[side] += amount
+
+    def daily(self, first:int, last:int) -> array.array:
+        'Return the net øre of each day from first to last, both included'
+        net = _zeros(last - first + 1)
+        if self.first is not None:
+            lo, hi = max(first, self.first), min(last, self.first + len(self.net) - 1)
+            if lo <= hi:
+                net[lo - first:hi - first + 1] = self.net[lo - self.first:hi - self.first + 1]
+        return net
+
+    def total(self, first:int, last:int) -> int:
+        'Return the sum of the transactions from day first to day last, both included, in øre'
+        net = self.daily(first, last)
+        np = numpy()
+        if np is not None:
+            return int(np.frombuffer(net, dtype=np.int64).sum())
+        return sum(net)
+
+    def rolling(self, window:int, first:int, last:int) -> list:
+        'Return the sum of the `window` days up to and including each day from first to last, in øre'
+        net = self.daily(first - window + 1, last)
+        np = numpy()
+        if np is not None:
+            sums = np.concatenate(([0], np.cumsum(np.frombuffer(net, dtype=np.int64))))
+            return (sums[window:] - sums[:-window]).tolist()
+        sums = [0, *itertools.accumulate(net)]
+        return [sums[i + window] - sums[i] for i in range(last - first + 1)]
+
+class SavingsAnalytics:
+    '''Savings statistics for the accounts in a TransactionStore, see the module doc.
+
+    Call add() with new SbankenTransactions, or let the store do it with
+    `store.addListener(analytics.add)`. With a RewardLedger, rewards are
+    split between the cards that were scanned; without one, a tagged
+    transfer counts as one reward to the card in its message.
+    '''
+    def __init__(self, store:'TransactionStore', ledger:'RewardLedger'=None):
+        self.store = store
+        self.ledger = ledger
+        self.columns = {} # account number -> AccountColumns
+        self._lock = threading.RLock()
+
+    def add(self, transactions:list) -> int:
+        'Add SbankenTransactions to the columns of the accounts we have loaded. Returns the number of new ones'
+        added = 0
+        with self._lock:
+            for t in transactions:
+                columns = self.columns.get(t.accountNumber)
+                if columns is None:
+                    continue # not loaded yet, it will be read from the store with the rest
+                key = t.transactionId or self.store.transactionKey(t.to_json())
+                added += columns.add(key, dayNumber(t.accountingDate), ore(t.amount), self.cards(t.text, t.amount))
+        return added
+
+    def account(self, account:str) -> AccountColumns:
+        'Return the AccountColumns of account, reading its history from the store the first time'
+        with self._lock:
+            columns = self.columns.get(account)
+            if columns is None:
+                columns = AccountColumns(account)
+                for key, date, amount, text in self.store.rows(account):
+                    if date is not None:
+                        columns.add(key, dayNumber(date), ore(amount), self.cards(text, amount))
+                self.columns[account] = columns
+                logging.debug('analytics: read %i transactions of %s', len(columns), account)
+            return columns
+
+    def cards(self, text:str, amount) -> list:
+        'Return (card name, øre) for each reward in a transaction with text and amount'
+        match = TAG.search(text or '')
+        if match is None or amount is None or amount <= 0:
+            return []
+        if self.ledger is not None:
+            rewards = self.ledger.rewardsOf(match.group(1))
+            if rewards:
+                return [(message, ore(value)) for message, value in rewards]
+        number = re.match(r'\d+', text)
+        for unknown in (MERGED_MESSAGE.format(number.group() if number else ''), DEFAULT_MESSAGE):
+            if taggedMessage(unknown, match.group(1).strip('()')) == text: # the message as the outbox sent it
+                return [(None, ore(amount))] # not a card name, and the ledger doesn't know them
+        return [(text[:match.start()], ore(amount))]
+
+    def periods(self, account:str, period:str='week', count:int=8, today:datetime.date=None) -> list:
+        '''Return the last `count` weeks or months (`period`) up to today, oldest first.
+
+        Each is a dict with start (a date), deposits, withdrawals and net, in kroner.'''
+        today = dayNumber(today or datetime.date.today())
+        with self._lock:
+            columns = self.account(account)
+            if period == 'week':
+                keys = [weekOf(today) - 7 * i for i in range(count)]
+                starts = [datetime.date.fromordinal(k) for k in keys]
+                totals = columns.weekly
+            elif period == 'month':
+                keys = [monthOf(today) - i for i in range(count)]
+                starts = [_monthStart(k) for k in keys]
+                totals = columns.monthly
+            else:
+                raise ValueError('period must be week or month, not {!r}'.format(period))
+            result = []
+            for key, start in reversed(list(zip(keys, starts))):
+                deposits, withdrawals = totals.get(key, (0, 0))
+                result.append({'start': start, 'deposits': kroner(deposits), 'withdrawals': kroner(withdrawals),
+                               'net': kroner(deposits + withdrawals)})
+            return result
+
+    def rolling(self, account:str, days:int=7, count:int=30, today:datetime.date=None) -> list:
+        'Return (date, sum of the `days` days up to it, in kroner) for the last `count` days up to today'
+        last = dayNumber(today or datetime.date.today())
+        first = last - count + 1
+        with self._lock:
+            sums = self.account(account).rolling(days, first, last)
+        return [(datetime.date.fromordinal(first + i), kroner(s)) for i, s in enumerate(sums)]
+
+    def total(self, account:str, startDate, endDate) -> Decimal:
+        'Return the sum of the transactions of account between two dates, both included, in kroner'
+        with self._lock:
+            return kroner(self.account(account).total(dayNumber(startDate), dayNumber(endDate)))
+
+    def rewards(self, account:str) -> dict:
+        'Return card name -> (number of rewards, kroner) for all rewards to account'
+        with self._lock:
+            return {card:(count, kroner(amount)) for card, (count, amount) in self.account(account).rewards.items()}
+
+    def trend(self, account:str, weeks:int=8, today:datetime.date=None) -> Decimal:
+        'Return how much more (or less) is saved each week, in kroner, over the last `weeks` full weeks'
+        today = today or datetime.date.today()
+        nets = [ore(p['net']) for p in self.periods(account, 'week', weeks + 1, today)[:-1]] # the current week isn't over
+        if len(nets) < 2:
+            return kroner(0)
+        # least squares slope of the net of each week
+        mean = (len(nets) - 1) / 2
+        average = sum(nets) / len(nets)
+        slope = sum((i - mean) * (n - average) for i, n in enumerate(nets)) / sum((i - mean) ** 2 for i in range(len(nets)))
+        return kroner(round(slope))
+
+    def summary(self, account:str, weeks:int=8, months:int=6, today:datetime.date=None) -> dict:
+        'Return weeks, months, rewards per card and trend of account, see the other methods'
+        today = today or datetime.date.today()
+        with self._lock:
+            return {'weeks': self.periods(account, 'week', weeks, today),
+                    'months': self.periods(account, 'month', months, today),
+                    'rewards': self.rewards(account),
+                    'trend': self.trend(account, weeks, today)}
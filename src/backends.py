@@ -0,0 +1,263 @@
+'''Hardware backends: the card reader and the screen with its buttons.
+
+The kiosk talks to the hardware through these interfaces, so it can run on a
+Raspberry Pi with a PiTFT and an rc522 reader, or simulated on any Linux box
+with scripted card scans and virtual buttons. Pick one with `backend` in the
+[hardware] section of the config: `pi` (the default) or `sim`.
+
+Nothing here imports the hardware libraries until they are needed.
+
+'''
+import threading
+import time
+import queue
+import logging
+
+class RFIDCard:
+    'Model for rfid (mifare rc522) cards or tags'
+
+    def __init__(self, uid):
+        self.uid = uid
+        self.hex = ''.join('{:02X}'.format(a) for a in uid)
+        self.name = None # set later
+        self.reward = -1 # set later
+
+    def __str__(self):
+        return '<RFIDCard: {} ({})>'.format(self.hex, self.name)
+
+class CardReader:
+    '''Base class for card readers.
+
+    Subclasses implement run(), which waits for cards in a background thread
+    and calls card_detected() with the uid of each one. The callback is called
+    with an RFIDCard, from the reader thread.
+    '''
+    def __init__(self, callback_new_rfid_fn, duplicate_window=2.0):
+        self.callbackfn = callback_new_rfid_fn # call this function with a RFIDCard() on new card detected
+        self.last_card = None # to filter out duplicates
+        self.last_seen = 0 # when we last saw last_card
+        self.duplicate_window = duplicate_window # seconds. a card seen again within this time is a duplicate
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        'Start waiting for cards in a background thread'
+        self._running = True
+        self._thread = threading.Thread(target=self.run, name='rfid', daemon=True)
+        self._thread.start()
+
+    def on_stop(self):
+        self._running = False
+        self.wakeup()
+        if self._thread is not None:
+            self._thread.join()
+
+    def wakeup(self):
+        'make run() notice that we are stopping'
+        pass
+
+    def card_detected(self, uid):
+        'Is run on each card detected, in the reader thread'
+        now = time.monotonic()
+        duplicate = uid == self.last_card and now - self.last_seen < self.duplicate_window
+        self.last_card = uid
+        self.last_seen = now
+        if duplicate:
+            # same card still on the reader
+            return
+        self.callbackfn(RFIDCard(uid))
+
+    def run(self):
+        raise NotImplementedError
+
+class RFIDReader(CardReader):
+    'The rc522 reader on the Pi, woken up by its IRQ pin'
+
+    # The 2.8TFT uses the hardware SPI pins (SCK, MOSI, MISO, CE0, CE1), #25 and #24.
+    # buttons: #23, #22, #27/#21, and #18
+    #
+    # Thus, we need to set up the rc522 RFID reader on SPI1, and on unused pins
+    # SDA = BOARD12
+    # SCK = BOARD40
+    # MOSI = BOARD38
+    # MISO = BOARD35
+    # IRQ = BOARD32
+    # RST = BOARD15
+    # self.rdr = RFID(bus=1, device=0, pin_ce=12, pin_irq=32, pin_rst=15)
+
+    def __init__(self, callback_new_rfid_fn, duplicate_window=2.0):
+        'Set up RFID reader'
+        super().__init__(callback_new_rfid_fn, duplicate_window)
+        from pirc522 import RFID # pip install pirc522
+        self.rdr = RFID(bus=1, device=0, pin_ce=12, pin_irq=32, pin_rst=15)
+        util = self.rdr.util()
+        util.debug = True
+
+    def on_stop(self):
+        super().on_stop()
+        self.rdr.cleanup()
+
+    def wakeup(self):
+        self.rdr.irq.set() # wake up wait_for_tag()
+
+    def run(self):
+        'wait for the IRQ pin to tell us a card is nearby, then read it. Runs in the reader thread'
+        while self._running:
+            self.rdr.wait_for_tag()
+            if not self._running:
+                break
+            self.read()
+
+    def read(self):
+        'read the uid of the card that is nearby, if any'
+        (error, data) = self.rdr.request()
+        if not error:
+            logging.debug("Detected RFID: %s", format(data, "02x"))
+            (error, uid) = self.rdr.anticoll()
+            if error:
+                logging.error("Error reading RFID: %r <UID: %r>", error, uid)
+            else:
+                logging.debug("Card read UID: "+str(uid[0])+","+str(uid[1])+","+str(uid[2])+","+str(uid[3]))
+                self.card_detected(uid)
+
+def hexToUid(hex:str) -> list:
+    'Return the uid bytes of a card from its hex, like the rc522 gives them'
+    return [int(hex[i:i+2], 16) for i in range(0, len(hex), 2)]
+
+class ScriptedCardReader(CardReader):
+    '''A simulated card reader.
+
+    Plays `script`, a list of (seconds to wait, card hex), and then any cards
+    passed to scan(), from any thread. Use loadScript() to read a script file.
+    '''
+    def __init__(self, callback_new_rfid_fn, duplicate_window=2.0, script=()):
+        super().__init__(callback_new_rfid_fn, duplicate_window)
+        self.scans = queue.Queue()
+        for delay, hex in script:
+            self.scans.put((delay, hex))
+
+    @staticmethod
+    def loadScript(path:str) -> list:
+        'Read a script file: one scan per line, as seconds to wait and card hex. # starts a comment'
+        script = []
+        with open(path) as f:
+            for line in f:
+                line = line.split('#', 1)[0].strip()
+                if line:
+                    delay, hex = line.split()
+                    script.append((float(delay), hex))
+        return script
+
+    def scan(self, hex:str, delay:float=0):
+        'Put a card on the reader'
+        self.scans.put((delay, hex))
+
+    def wakeup(self):
+        self.scans.put(None)
+
+    def run(self):
+        while self._running:
+            scan = self.scans.get()
+            if scan is None or not self._running:
+                break
+            delay, hex = scan
+            if delay:
+                time.sleep(delay)
+            self.card_detected(hexToUid(hex))
+
+class Screen:
+    '''The interface of the screen with four buttons, as PiTFT_Screen has it.
+
+    ButtonNInterrupt(callback) calls callback(channel) from another thread
+    when button N is pressed, ButtonN is True while it is held down, and
+    Backlight(light) turns the backlight on or off.
+    '''
+    def Button1Interrupt(self, callback=None, bouncetime=200):
+        raise NotImplementedError
+
+    def Button2Interrupt(self, callback=None, bouncetime=200):
+        raise NotImplementedError
+
+    def Button3Interrupt(self, callback=None, bouncetime=200):
+        raise NotImplementedError
+
+    def Button4Interrupt(self, callback=None, bouncetime=200):
+        raise NotImplementedError
+
+    def Backlight(self, light):
+        raise NotImplementedError
+
+    def Cleanup(self):
+        pass
+
+class VirtualScreen(Screen):
+    'A simulated PiTFT. Call press() to push a button, and look at .backlight'
+    def __init__(self):
+        self.backlight = True
+        self.callbacks = {}
+        self.pressed = set()
+
+    def _interrupt(self, button, callback):
+        if callback is not None:
+            self.callbacks[button] = callback
+
+    def Button1Interrupt(self, callback=None, bouncetime=200):
+        self._interrupt(1, callback)
+
+    def Button2Interrupt(self, callback=None, bouncetime=200):
+        self._interrupt(2, callback)
+
+    def Button3Interrupt(self, callback=None, bouncetime=200):
+        self._interrupt(3, callback)
+
+    def Button4Interrupt(self, callback=None, bouncetime=200):
+        self._interrupt(4, callback)
+
+    def Backlight(self, light):
+        self.backlight = bool(light)
+
+    def press(self, button:int, hold:float=0.1):
+        'Push a button and hold it down for `hold` seconds. The callback runs in its own thread, like with RPi.GPIO'
+        def run():
+            self.pressed.add(button)
+            if button in self.callbacks:
+                self.callbacks[button](button)
+            time.sleep(hold)
+            self.pressed.discard(button)
+        threading.Thread(target=run, name='button{}'.format(button), daemon=True).start()
+
+    @property
+    def Button1(self):
+        return 1 in self.pressed
+
+    @property
+    def Button2(self):
+        return 2 in self.pressed
+
+    @property
+    def Button3(self):
+        return 3 in self.pressed
+
+    @property
+    def Button4(self):
+        return 4 in self.pressed
+
+def simulated(config:'configparser.ConfigParser') -> bool:
+    'Return True if the config asks for the simulated backends'
+    return config.get('hardware', 'backend', fallback='pi') == 'sim'
+
+def openScreen(config:'configparser.ConfigParser') -> Screen:
+    'Return the screen from the [hardware] config'
+    if simulated(config):
+        return VirtualScreen()
+    from pitftscreen import PiTFT_Screen
+    return PiTFT_Screen()
+
+def openCardReader(config:'configparser.ConfigParser', callback) -> CardReader:
+    'Return the card reader from the [hardware] config, calling callback with each new RFIDCard'
+    duplicate_window = config.getfloat('hardware', 'duplicateWindow', fallback=2.0)
+    if simulated(config):
+        script = config.get('hardware', 'cardScript', fallback=None)
+        return ScriptedCardReader(callback, duplicate_window,
+                                  ScriptedCardReader.loadScript(script) if script else ())
+    return RFIDReader(callback, duplicate_window)
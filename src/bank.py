@@ -1,8 +1,20 @@
 
 import configparser 
 import logging
+import os
+import os.path
+import time
 
-from SbankenClient import SbankenClient, SbankenError, SbankenAccount, Account
+from decimal import Decimal
+
+from SbankenClient import SbankenClient, SbankenPool, SbankenError, Account
+from metrics import Metrics
+from transactionstore import TransactionStore
+from outbox import RewardOutbox, DEFAULT_MESSAGE
+from ledger import RewardLedger
+from watcher import BalanceWatcher
+from analytics import SavingsAnalytics
+from snapshot import BalanceSnapshot, storageDir, snapshotPath, outboxPath
 
 class GriseError(SbankenError):
     pass
@@ -13,19 +25,44 @@ class GriseAccount:
         self.bank = bank
         self.account = account
         self.details = account.details
+        self.updated = None # time.time() when the bank last told us the details, see GriseBank.refreshed()
     
     def __str__(self) -> str:
         return '<GriseAccount: {}, account # {}, balance:{}>'.format(self.title, self.details.accountNumber, self.details.balance)
 
-    def reward(self, amount:float, message:str=None) -> bool:
+    def reward(self, amount:Decimal, message:str=None) -> bool:
         '''Add amount to user's account. Returns boolean True if it succeeded.'''
         result = self.bank.reward(self, amount, message)
         if not result.get('isError'):
-            self.account.update()
-            self.details = self.account.details
+            self.update()
             return True
         return False
 
+    def update(self) -> None:
+        'Get new details from server about balance etc'
+        old = self.details
+        self.account.update(stale=False) # refreshed() only for replies from the bank
+        self.details = self.account.details
+        self.bank.refreshed([self])
+        if self.details != old:
+            self.bank.changed(self)
+
+    def expectedBalance(self) -> Decimal:
+        'The balance once the rewards waiting in the outbox are sent'
+        return self.details.balance + self.bank.outbox.owed(self.details.accountNumber)
+
+    def history(self, limit:int=None, startDate=None, endDate=None, sync:bool=True) -> list:
+        '''Return transactions on the user's account, newest first, from the local transaction store.
+
+        With `sync`, get new transactions from the bank first.'''
+        if sync:
+            self.bank.transactions.sync(self.bank.client, self.details.accountNumber)
+        return self.bank.transactions.history(self.details.accountNumber, limit, startDate, endDate)
+
+    def savings(self, weeks:int=8, months:int=6) -> dict:
+        'Return savings per week and month, rewards per card and the trend, see SavingsAnalytics.summary()'
+        return self.bank.analytics.summary(self.details.accountNumber, weeks, months)
+
 class GriseBank:
     '''The main class, that binds users and accounts together.
 
@@ -34,27 +71,170 @@ class GriseBank:
 
     After init, look at 
     `.users` -- a list of GriseAccounts
+    `.usersByName` -- the same GriseAccounts, keyed by their name in the config
     `.baseAccount` -- the base account for all operations (the one with all the money that is rewarded)
+    `.accounts` -- all Accounts at the bank, keyed by account number
+    `.missingAccounts` -- configured accounts (name -> account number) that the bank doesn't know about
+    `.transactions` -- a TransactionStore with the transactions we have seen, kept in the [storage] dir
+    `.outbox` -- a RewardOutbox that queues rewards on disk, call `.outbox.start()` to send them
+    `.ledger` -- a RewardLedger that makes sure the outbox never pays the same reward twice
+    `.watcher` -- a BalanceWatcher that notices transfers made elsewhere, call `.watcher.start()` to run it
+    `.snapshot` -- a BalanceSnapshot of all details, saved after every refresh, see CachedBank
+    `.analytics` -- SavingsAnalytics with weekly and monthly savings, and rewards per card, from `.transactions`
+
+    With `customer`, the credentials and accounts are read from the
+    [secrets:customer] and [accounts:customer] sections instead, and local
+    data is kept in a subdirectory of the storage dir. See GriseBanks, to
+    serve many customers from one process.
 
     '''
-    def __init__(self, config: configparser.ConfigParser):
+    ready = True # see snapshot.CachedBank
+
+    def __init__(self, config: configparser.ConfigParser, customer:str=None, pool:SbankenPool=None, metrics:Metrics=None):
         self.config = config
-        self.client = SbankenClient(config)
+        self.customer = customer
+        self.client = SbankenClient(config, metrics=metrics, pool=pool, secrets=self._section('secrets'))
+        try:
+            self._open(config, customer)
+        except Exception:
+            self.client.close() # or its event loop and threads keep running, e.g. while gris.py retries
+            raise
+
+    def _open(self, config: configparser.ConfigParser, customer:str):
+        'find the configured accounts at the bank, and set up local storage'
+        self.storage = storageDir(config, customer)
+        os.makedirs(self.storage, exist_ok=True)
+        self.transactions = TransactionStore(os.path.join(self.storage, 'transactions.db'))
+        # fetch the account list once, and index it by account number
+        self.accounts = { acct.details.accountNumber:acct for acct in self.client.accounts() }
+        self.baseAccount = None
         self.users = []
+        self.usersByName = {}
+        self.usersByAccount = {}
+        self.missingAccounts = {} # name -> account number, for configured accounts not found at the bank
+        self.listeners = [] # functions to call with a GriseAccount when its details change
         # read through user=account combos from config file and populate user list
-        for name in config.options('accounts'):
-            if name == "BASE": continue
-            userAccount = config.get('accounts', name) # get account number
-            for acct in self.client.accounts(): # parse SbankenAccounts
-                if acct.details.accountNumber == userAccount: #this is it
-                    self.users.append(GriseAccount(name, acct, self))
-
-        # TODO: fix this algo
-        for acct in self.client.accounts(): # parse SbankenAccounts
-            if acct.details.accountNumber == config.get('accounts', 'BASE') :
+        for name in config.options(self._section('accounts')):
+            userAccount = config.get(self._section('accounts'), name) # get account number
+            acct = self.accounts.get(userAccount)
+            if acct is None:
+                logging.warning('Configured account %s (%s) was not found at the bank', name, userAccount)
+                self.missingAccounts[name] = userAccount
+                continue
+            if name == "BASE":
                 self.baseAccount = GriseAccount('base', acct, self)
+                continue
+            user = GriseAccount(name, acct, self)
+            self.users.append(user)
+            self.usersByName[name] = user
+            self.usersByAccount[userAccount] = user
+
+        if self.baseAccount is None:
+            raise GriseError('Could not find the BASE account, check the [{}] section of your config'.format(self._section('accounts')))
+
+        self.ledger = RewardLedger(os.path.join(self.storage, 'ledger.db'))
+        self.outbox = RewardOutbox(outboxPath(config, customer), self, self.ledger,
+                                   mergeWindow=config.getfloat('outbox', 'mergeWindow', fallback=5),
+                                   maxBackoff=config.getfloat('outbox', 'maxBackoff', fallback=300),
+                                   dedupWindow=config.getfloat('outbox', 'dedupWindow', fallback=60))
+        self.watcher = BalanceWatcher.fromConfig(self, config)
+        self.analytics = SavingsAnalytics(self.transactions, self.ledger)
+        self.transactions.addListener(self.analytics.add)
+        # for the next start, and for when the bank is down, see CachedBank
+        self.snapshot = BalanceSnapshot(snapshotPath(config, customer))
+        self.refreshed(self.users + [self.baseAccount])
+
+    def _section(self, name:str) -> str:
+        'the name of a per customer config section'
+        return name if self.customer is None else '{}:{}'.format(name, self.customer)
+
+    def addListener(self, fn) -> None:
+        '''Call fn(user) whenever the details (like the balance) of a GriseAccount change.
+
+        fn is called from the thread that noticed the change.'''
+        self.listeners.append(fn)
+
+    def changed(self, user:GriseAccount) -> None:
+        'Tell the listeners that the details of user have changed'
+        for fn in self.listeners:
+            try:
+                fn(user)
+            except Exception:
+                logging.exception('Listener %r failed', fn)
+
+    def user(self, name:str) -> GriseAccount:
+        'Look up a GriseAccount by its configured name'
+        return self.usersByName[name]
+
+    def account(self, accountNumber:str) -> Account:
+        'Look up an Account by account number'
+        return self.accounts[accountNumber]
+
+    def refreshAll(self, fromList:bool=True, limit:int=None, fresh:bool=True) -> dict:
+        '''Get new details about balance etc for all users and the base account.
+
+        With `fromList`, they all come from one accountList request.
+        Otherwise from one accountDetails request per account, at most
+        `limit` at a time. With `fresh`, cached replies are not used.
+        Returns {name: (old balance, new balance)} for the balances that changed.'''
+        everyone = self.users + [self.baseAccount]
+        if fresh:
+            self._expire()
+        return self._applyDetails(everyone, self.client.run(self._fetchDetails(everyone, fromList, limit)))
+
+    def _expire(self):
+        'expire the cached account replies, so the next requests go to the bank'
+        self.client.cache.invalidate('accountList')
+        self.client.cache.invalidate('accountDetails')
 
-    def reward(self, receiver:GriseAccount, amount:float, message:str=None) -> dict:
+    async def _fetchDetails(self, users:list, fromList:bool, limit:int) -> list:
+        'new details for users, in the same order, None for accounts the bank did not list'
+        if fromList:
+            byNumber = {a.accountNumber:a for a in await self.client.aio.accounts(stale=False)}
+            return [byNumber.get(u.details.accountNumber) for u in users]
+        return await self.client.aio.accountDetailsMany([u.details.accountNumber for u in users], limit, stale=False)
+
+    def _applyDetails(self, users:list, details:list) -> dict:
+        'set the details we got, and return {name: (old balance, new balance)} for the balances that changed'
+        found = [(u, d) for u, d in zip(users, details) if d is not None]
+        for u, d in zip(users, details):
+            if d is None:
+                logging.warning('Account %s (%s) is gone from the account list', u.title, u.details.accountNumber)
+        old = {u:u.details.balance for u, _ in found}
+        self._setDetails([u for u, _ in found], [d for _, d in found])
+        return {u.title:(old[u], u.details.balance) for u, _ in found if u.details.balance != old[u]}
+
+    def _setDetails(self, users:list, details:list) -> None:
+        'give each user their new details, and tell the listeners about the ones that changed'
+        changed = []
+        for user, d in zip(users, details):
+            old = user.details
+            user.account.details = d
+            user.details = d
+            if d != old:
+                changed.append(user)
+        self.refreshed(users)
+        for user in changed:
+            self.changed(user)
+
+    def refreshed(self, users:list) -> None:
+        '''The bank just told us the details of users: note the time, and save the snapshot.
+
+        Not for replies from the client cache after the bank failed, see AsyncSbankenClient._request().'''
+        now = time.time()
+        for user in users:
+            user.updated = now
+        self.snapshot.save(self)
+
+    def sync(self) -> dict:
+        'Get new transactions for all users from the bank, into the local store. Returns name -> number of new transactions'
+        return { user.title:self.transactions.sync(self.client, user.details.accountNumber) for user in self.users }
+
+    def reconcile(self, days:float=7) -> dict:
+        'Check the reward ledger against the transactions at the bank, see RewardLedger.reconcile()'
+        return self.ledger.reconcile(self, days)
+
+    def reward(self, receiver:GriseAccount, amount:Decimal, message:str=None) -> dict:
         'Transfer amount to receiver from BASE account, with optional message'
         if receiver.details.accountNumber == self.baseAccount.details.accountNumber:
             # can't transfer to itself, the base account never receives money
@@ -62,7 +242,74 @@ class GriseBank:
         return self.client.transfer(self.baseAccount.details.accountNumber, 
                                     receiver.details.accountNumber, 
                                     amount, 
-                                    message or 'Rewarded by Grisebank')
+                                    message or DEFAULT_MESSAGE)
+
+class GriseBanks:
+    '''Many GriseBanks, one per customer (family), served from one process.
+
+    Every `[accounts:name]` section in the config is a customer called name,
+    with its credentials in `[secrets:name]`. Each customer has its own token
+    and base account, but they share one SbankenPool: one connection pool,
+    `[client] maxConcurrent` requests in flight scheduled fairly between the
+    customers, and one event loop thread. They also share one Metrics.
+
+    After init, look at
+    `.banks` -- the GriseBank of each customer, keyed by name
+    `.pool` -- the shared SbankenPool
+    '''
+    def __init__(self, config: configparser.ConfigParser, customers:list=None):
+        self.config = config
+        self.metrics = Metrics.fromConfig(config)
+        self.pool = SbankenPool(config.getint('client', 'maxConcurrent', fallback=4), self.metrics)
+        self.banks = {}
+        try:
+            for name in customers if customers is not None else self.customers(config):
+                self.banks[name] = GriseBank(config, name, self.pool, self.metrics)
+        except Exception:
+            self.close() # the banks we opened, the pool and its threads, and the metrics exporter
+            raise
+
+    @staticmethod
+    def customers(config: configparser.ConfigParser) -> list:
+        'Return the names of the customers in the config'
+        return [section.split(':', 1)[1] for section in config.sections() if section.startswith('accounts:')]
+
+    def __getitem__(self, name:str) -> GriseBank:
+        return self.banks[name]
+
+    def __iter__(self):
+        return iter(self.banks.values())
+
+    def __len__(self) -> int:
+        return len(self.banks)
+
+    def start(self):
+        'Start sending rewards from the outbox, and watching for new transactions, for every customer'
+        for bank in self:
+            bank.outbox.start()
+            bank.watcher.start()
+
+    def stop(self):
+        for bank in self:
+            bank.watcher.stop()
+            bank.outbox.stop()
+
+    def refreshAll(self, fromList:bool=True, limit:int=None, fresh:bool=True) -> dict:
+        'Refresh the balances of all customers at the same time, see GriseBank.refreshAll(). Returns customer -> changes'
+        everyone = {bank:bank.users + [bank.baseAccount] for bank in self}
+        futures = {}
+        for bank, users in everyone.items():
+            if fresh:
+                bank._expire()
+            futures[bank] = bank.client.submit(bank._fetchDetails(users, fromList, limit))
+        return {bank.customer:bank._applyDetails(everyone[bank], future.result()) for bank, future in futures.items()}
+
+    def close(self):
+        self.stop()
+        for bank in self:
+            bank.client.aio.close()
+        self.pool.close()
+        self.metrics.close()
 
 if __name__ == '__main__':
     import argparse
@@ -70,8 +317,10 @@ if __name__ == '__main__':
 
     parser = argparse.ArgumentParser(description="Grisebank")
     parser.add_argument('--configfile', default='config.ini')
+    parser.add_argument('--loglevel', default='INFO', help='DEBUG shows every request to the bank')
 
     args = parser.parse_args()
+    logging.basicConfig(level=args.loglevel)
 
     c = configparser.RawConfigParser()
     c.optionxform = lambda option: option # make configparser case aware
@@ -0,0 +1,117 @@
+'''Button presses from the GPIO thread, as events on the UI loop.
+
+RPi.GPIO calls our button callbacks from its own thread. The callbacks here
+only put the press in a queue and ask the UI loop to wake up, everything
+else (debouncing, bursts, long presses, chords, and what the buttons do)
+happens on the UI loop, so it never races with the rendering.
+
+'''
+import collections
+import time
+import logging
+
+PRESS = 'press'
+LONG = 'long'
+CHORD = 'chord'
+
+class ButtonEvent:
+    '''A gesture on the buttons.
+
+    kind is PRESS (count is how many times the button was pressed in one
+    burst), LONG (the button is still held down) or CHORD (several buttons
+    pressed together).'''
+    __slots__ = ('kind', 'buttons', 'count')
+
+    def __init__(self, kind:str, buttons:tuple, count:int=1):
+        self.kind = kind
+        self.buttons = buttons
+        self.count = count
+
+    def __repr__(self) -> str:
+        return 'ButtonEvent({!r}, {!r}, {!r})'.format(self.kind, self.buttons, self.count)
+
+class ButtonBridge:
+    '''Turn raw button presses from any thread into ButtonEvents on the UI loop.
+
+    `schedule(fn, delay)` must run fn() on the UI loop after delay seconds, and
+    be safe to call from other threads (like kivy's Clock.schedule_once).
+    `handler(event)` is called on the UI loop with each ButtonEvent.
+    `isPressed(button)`, if given, tells if a button is held down right now,
+    and is needed for long presses.
+
+    Presses of the same button closer than `debounce` seconds are bounces.
+    Presses within `window` seconds of the first one are one burst: one
+    button gives one PRESS with a count, several buttons give a CHORD.
+    A button still held `longPress` seconds after a PRESS gives a LONG too.
+    '''
+    def __init__(self, schedule, handler, isPressed=None, debounce=0.05, window=0.25, longPress=1.0):
+        self.schedule = schedule
+        self.handler = handler
+        self.isPressed = isPressed
+        self.debounce = debounce
+        self.window = window
+        self.longPress = longPress
+        self._raw = collections.deque() # (button, time) from the GPIO thread. append and popleft are atomic
+        self._wakeup = False
+        self._lastRaw = {} # button -> time of last raw press that was not a bounce
+        self._burst = [] # presses in the current burst
+        self._burstOpen = False
+
+    def gpio(self, button:int, channel=None):
+        'Call this from the GPIO callback. Only queues the press, and wakes up the UI loop'
+        self._raw.append((button, time.monotonic()))
+        if not self._wakeup:
+            self._wakeup = True
+            self.schedule(self.drain, 0)
+
+    def drain(self):
+        'Take raw presses off the queue, on the UI loop'
+        self._wakeup = False
+        while self._raw:
+            button, when = self._raw.popleft()
+            if when - self._lastRaw.get(button, float('-inf')) < self.debounce:
+                continue # bounce
+            self._lastRaw[button] = when
+            self._burst.append(button)
+            if not self._burstOpen:
+                self._burstOpen = True
+                self.schedule(self._closeBurst, self.window)
+
+    def _closeBurst(self):
+        burst, self._burst = self._burst, []
+        self._burstOpen = False
+        if not burst:
+            return
+        buttons = tuple(sorted(set(burst)))
+        if len(buttons) > 1:
+            self._dispatch(ButtonEvent(CHORD, buttons))
+            return
+        self._dispatch(ButtonEvent(PRESS, buttons, len(burst)))
+        if self.isPressed is not None:
+            lastPress = self._lastRaw[buttons[0]]
+            self.schedule(lambda: self._checkLong(buttons[0], lastPress), max(self.longPress - self.window, 0))
+
+    def _checkLong(self, button:int, lastPress:float):
+        if self._lastRaw.get(button) != lastPress:
+            return # pressed again since, so it was let go
+        if self.isPressed(button):
+            self._dispatch(ButtonEvent(LONG, (button,)))
+
+    def _dispatch(self, event:ButtonEvent):
+        try:
+            self.handler(event)
+        except Exception:
+            logging.exception('Button handler failed on %r', event)
+
+def parseGesture(gesture:str) -> tuple:
+    'Parse "2" or "1+4" to a tuple of button numbers, like the buttons of a ButtonEvent'
+    return tuple(sorted(int(b) for b in gesture.split('+')))
+
+def buttonMap(config:'configparser.ConfigParser', names:list) -> dict:
+    '''Return button tuple -> account name, from the [buttons] section of the config.
+
+    Keys are a button number, or buttons joined with + for a chord. Without
+    a [buttons] section, buttons 2 and 4 pick the first two accounts in `names`.'''
+    if not config.has_section('buttons'):
+        return {(b,):name for b, name in zip((2, 4), names)}
+    return {parseGesture(gesture):config.get('buttons', gesture) for gesture in config.options('buttons')}
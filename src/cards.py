@@ -0,0 +1,155 @@
+'''The rfid cards we know about, from cards.yaml.
+
+Cards are looked up by their UID in hex. The file is checked when it is
+loaded, and watched for changes, so cards can be added or changed without
+restarting the kiosk.
+
+'''
+import os
+import threading
+import logging
+import string
+from decimal import Decimal, InvalidOperation
+
+from outbox import MIN_AMOUNT
+
+class CardError(Exception):
+    pass
+
+def normalizeHex(uid) -> str:
+    'Return a card UID as upper case hex without separators, like E65AF2307E'
+    uid = str(uid).strip().upper()
+    for separator in ': -':
+        uid = uid.replace(separator, '')
+    if not uid or any(c not in string.hexdigits for c in uid):
+        raise CardError('Not a hex card UID: {!r}'.format(uid))
+    return uid
+
+class Card:
+    'A known rfid card or tag'
+    __slots__ = ('hex', 'name', 'reward')
+
+    def __init__(self, hex:str, name:str, reward:Decimal):
+        self.hex = hex
+        self.name = name
+        self.reward = reward
+
+    def __str__(self) -> str:
+        return '<Card: {} ({}, {} kr)>'.format(self.hex, self.name, self.reward)
+
+def parseCards(definitions:list, source:str='cards') -> dict:
+    'Check card definitions from yaml, and return a dict of hex -> Card. Raises CardError listing all problems'
+    if definitions is None:
+        definitions = []
+    if not isinstance(definitions, list):
+        raise CardError('{}: expected a list of cards'.format(source))
+    cards = {}
+    problems = []
+    for i, c in enumerate(definitions, 1):
+        if not isinstance(c, dict) or 'hex' not in c:
+            problems.append('card #{}: needs at least a hex uid'.format(i))
+            continue
+        try:
+            uid = normalizeHex(c['hex'])
+        except CardError as e:
+            problems.append('card #{}: {}'.format(i, e))
+            continue
+        try:
+            reward = Decimal(str(c.get('reward', 0)))
+        except InvalidOperation:
+            problems.append('card #{} ({}): reward is not a number: {!r}'.format(i, uid, c.get('reward')))
+            continue
+        if not reward.is_finite() or reward < 0 or 0 < reward < MIN_AMOUNT:
+            problems.append('card #{} ({}): reward must be 0, or {} or more, not {}'.format(i, uid, MIN_AMOUNT, reward))
+            continue
+        if uid in cards:
+            problems.append('card #{} ({}): same uid as card {!r}'.format(i, uid, cards[uid].name))
+            continue
+        cards[uid] = Card(uid, c.get('name') or uid, reward)
+    if problems:
+        raise CardError('{}: {}'.format(source, '; '.join(problems)))
+    return cards
+
+class CardRegistry:
+    '''All known cards, indexed by hex UID, loaded from a yaml file.
+
+    Call start() to watch the file (its modification time and size, every
+    `pollInterval` seconds) and reload it when it changes. A broken file is
+    logged and ignored, and the cards we had keep working.
+    `onReload(registry)` is called, from the watcher thread, after a reload.
+    '''
+    def __init__(self, path:str, pollInterval:float=2.0, onReload=None):
+        self.path = path
+        self.pollInterval = pollInterval
+        self.onReload = onReload
+        self.cards = {}
+        self._stamp = None
+        self._stop = threading.Event()
+        self._thread = None
+        self.load()
+
+    def __len__(self) -> int:
+        return len(self.cards)
+
+    def __contains__(self, uid) -> bool:
+        return self.get(uid) is not None
+
+    def get(self, uid) -> Card:
+        'Return the Card with this uid, or None'
+        card = self.cards.get(uid)
+        if card is None:
+            try:
+                card = self.cards.get(normalizeHex(uid))
+            except CardError:
+                return None
+        return card
+
+    def _fileStamp(self) -> tuple:
+        st = os.stat(self.path)
+        return (st.st_mtime_ns, st.st_size)
+
+    def load(self) -> dict:
+        'Read and check the cards file. Raises CardError if something is wrong with it'
+        import yaml # pip install PyYAML. here, to keep it out of the kiosk startup
+        stamp = self._fileStamp()
+        with open(self.path) as f:
+            try:
+                definitions = yaml.safe_load(f)
+            except yaml.YAMLError as e:
+                raise CardError('{}: {}'.format(self.path, e))
+        self.cards = parseCards(definitions, self.path) # replace all cards in one go
+        self._stamp = stamp
+        logging.info('%i rfid card definitions loaded from %s', len(self.cards), self.path)
+        return self.cards
+
+    def reload(self) -> bool:
+        'Load the cards file again if it has changed. Returns True if we have new cards'
+        try:
+            if self._fileStamp() == self._stamp:
+                return False
+            self.load()
+        except (OSError, CardError) as e:
+            logging.error('Could not reload cards, keeping the %i we have: %s', len(self.cards), e)
+            try:
+                self._stamp = self._fileStamp() # don't complain again until it changes
+            except OSError:
+                pass
+            return False
+        if self.onReload is not None:
+            self.onReload(self)
+        return True
+
+    def start(self):
+        'Watch the cards file for changes, in a background thread'
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._watch, name='cards', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _watch(self):
+        while not self._stop.wait(self.pollInterval):
+            self.reload()
@@ -0,0 +1,325 @@
+'''A fake Sbanken API, to run, profile and load test grisebank without a bank.
+
+Serves the endpoints SbankenClient uses, over plain http on localhost, with
+an oauth2 token endpoint, in-memory accounts and transactions, and a
+configurable latency per request. Transfers are checked like the real API
+does it, and move money between the fake accounts.
+
+    python fakesbanken.py --port 8080 --latency 0.2 --accounts config.ini
+
+'''
+import os
+import re
+import json
+import time
+import random
+import datetime
+import threading
+import configparser
+import logging
+from decimal import Decimal
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+# oauthlib refuses to send tokens over plain http, unless told otherwise
+os.environ.setdefault('OAUTHLIB_INSECURE_TRANSPORT', '1')
+
+API = {
+    'customerDetails': '/customers/api/v1/Customers/',
+    'accountList': '/bank/api/v1/Accounts/',
+    'accountDetails': '/bank/api/v1/Accounts/{accountNumber}',
+    'transactionList': '/bank/api/v1/Transactions/{accountNumber}',
+    'transferMethod': '/bank/api/v1/Transfers/',
+}
+TOKEN = '/identityserver/connect/token'
+
+# allowed characters in a transfer message, see AsyncSbankenClient.transfer()
+MESSAGE = re.compile(r'^[0-9a-zA-ZæÆøØåÅäÄëËïÏöÖüÜÿâÂêÊîÎôÔûÛãÃñÑõÕàÀèÈìÌòÒùÙáÁéÉíÍóÓýÝ,;.:!\-/()? ]{1,30}$')
+
+def _route(template:str) -> 're.Pattern':
+    return re.compile('^' + re.escape(template).replace(re.escape('{accountNumber}'), r'(?P<accountNumber>\w+)') + '$')
+
+ROUTES = [(name, _route(path)) for name, path in API.items()]
+
+class FakeSbankenError(Exception):
+    'An api error, sent as an isError reply with this http status'
+    def __init__(self, status:int, errorType:str, message:str):
+        super().__init__(message)
+        self.status = status
+        self.errorType = errorType
+
+class FakeSbanken:
+    '''The fake bank, and the http server in front of it.
+
+    `accounts` is a dict of account number -> balance. Each request waits
+    `latency` seconds, plus up to `jitter` seconds more. Tokens expire
+    after `tokenLifetime` seconds. Set `failures[endpoint]` to a number of
+    requests to answer with a `failureStatus` error (500, or e.g. 429).
+
+    `requests` counts requests per endpoint, `tokens` counts issued tokens.
+    '''
+    def __init__(self, accounts:dict, customerId:str='12345678901', latency:float=0.0, jitter:float=0.0,
+                 tokenLifetime:float=3600, host:str='127.0.0.1', port:int=0):
+        self.customerId = customerId
+        self.latency = latency
+        self.jitter = jitter
+        self.tokenLifetime = tokenLifetime
+        self.failures = {}
+        self.failureStatus = 500
+        self.requests = {}
+        self.tokens = 0
+        self._tokens = {} # access token -> expiry time
+        self._lock = threading.Lock()
+        self.accounts = {}
+        self.transactions = {}
+        for number, balance in accounts.items():
+            self.addAccount(number, balance)
+        self.server = ThreadingHTTPServer((host, port), _Handler)
+        self.server.daemon_threads = True
+        self.server.fake = self
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return 'http://{}:{}'.format(host, port)
+
+    def start(self) -> 'FakeSbanken':
+        'Serve requests in a background thread'
+        self._thread = threading.Thread(target=self.server.serve_forever, name='fakesbanken', daemon=True)
+        self._thread.start()
+        logging.info('Fake Sbanken at %s', self.url)
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def addAccount(self, number:str, balance=0, name:str=None):
+        self.accounts[number] = {
+            'accountNumber': number,
+            'customerId': self.customerId,
+            'ownerCustomerId': self.customerId,
+            'name': name or 'Konto {}'.format(number),
+            'accountType': 'Standard account',
+            'available': Decimal(str(balance)),
+            'balance': Decimal(str(balance)),
+            'creditLimit': Decimal(0),
+            'defaultAccount': False,
+        }
+        self.transactions[number] = [] # newest first
+
+    def configure(self, config:configparser.ConfigParser) -> configparser.ConfigParser:
+        'Point the [api] and [login] sections of config at this server. Returns config'
+        for section in ('api', 'login', 'secrets'):
+            if not config.has_section(section):
+                config.add_section(section)
+        config.set('api', 'baseUrl', self.url)
+        for name, path in API.items():
+            config.set('api', name, path)
+        config.set('login', 'identityServer', self.url + TOKEN)
+        config.set('secrets', 'customerId', self.customerId)
+        for option in ('clientId', 'password'):
+            if not config.has_option('secrets', option):
+                config.set('secrets', option, 'fake')
+        return config
+
+    def config(self, accounts:dict) -> configparser.ConfigParser:
+        'Return a config for GriseBank, using this server and `accounts`, a dict of name -> account number'
+        config = configparser.RawConfigParser()
+        config.optionxform = lambda option: option # make configparser case aware
+        config.add_section('accounts')
+        for name, number in accounts.items():
+            config.set('accounts', name, number)
+        return self.configure(config)
+
+    @classmethod
+    def fromConfig(cls, config:configparser.ConfigParser, balance=1000, **kwargs) -> 'FakeSbanken':
+        'Return a fake bank with the accounts in the [accounts] section of config, each with `balance`'
+        return cls({number:balance for name, number in config.items('accounts')}, **kwargs)
+
+    # the api
+
+    def _wait(self):
+        delay = self.latency + (random.uniform(0, self.jitter) if self.jitter else 0)
+        if delay > 0:
+            time.sleep(delay)
+
+    def _count(self, endpoint:str):
+        with self._lock:
+            self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+            if self.failures.get(endpoint):
+                self.failures[endpoint] -= 1
+                raise FakeSbankenError(self.failureStatus, 'System', 'Injected failure')
+
+    def issueToken(self) -> dict:
+        with self._lock:
+            self.tokens += 1
+            token = 'fake-token-{}-{}'.format(self.tokens, random.getrandbits(32))
+            self._tokens[token] = time.monotonic() + self.tokenLifetime
+        return {'access_token': token, 'token_type': 'Bearer', 'expires_in': self.tokenLifetime}
+
+    def authorized(self, authorization:str) -> bool:
+        'Return True if the Authorization header has a token we issued, that has not expired'
+        if not authorization or not authorization.startswith('Bearer '):
+            return False
+        expires = self._tokens.get(authorization[len('Bearer '):])
+        return expires is not None and expires > time.monotonic()
+
+    def _account(self, number:str) -> dict:
+        if number not in self.accounts:
+            raise FakeSbankenError(404, 'NotFound', 'No account {}'.format(number))
+        return self.accounts[number]
+
+    def handle(self, method:str, endpoint:str, params:dict, body:dict) -> dict:
+        'Return the reply for a request to endpoint. Raises FakeSbankenError'
+        self._count(endpoint)
+        if endpoint == 'customerDetails' and method == 'GET':
+            return {'item': {'customerId': self.customerId, 'firstName': 'Fake', 'lastName': 'Sbanken',
+                             'dateOfBirth': '2000-01-01T00:00:00', 'phoneNumbers': [], 'postalAddress': {},
+                             'streetAddress': {}}}
+        if endpoint == 'accountList' and method == 'GET':
+            with self._lock:
+                return {'availableItems': len(self.accounts), 'items': [dict(a) for a in self.accounts.values()]}
+        if endpoint == 'accountDetails' and method == 'GET':
+            with self._lock:
+                return {'item': dict(self._account(params['accountNumber']))}
+        if endpoint == 'transactionList' and method == 'GET':
+            return self.transactionList(params)
+        if endpoint == 'transferMethod' and method == 'POST':
+            return self.transfer(body)
+        raise FakeSbankenError(405, 'Validation', '{} not allowed on {}'.format(method, endpoint))
+
+    def transactionList(self, params:dict) -> dict:
+        with self._lock:
+            self._account(params['accountNumber'])
+            items = list(self.transactions[params['accountNumber']])
+        if 'startDate' in params:
+            items = [t for t in items if t['accountingDate'][:10] >= params['startDate'][:10]]
+        if 'endDate' in params:
+            items = [t for t in items if t['accountingDate'][:10] <= params['endDate'][:10]]
+        index = int(params.get('index', 0))
+        length = int(params.get('length', 100))
+        if length < 1 or length > 1000:
+            raise FakeSbankenError(400, 'Validation', 'length must be between 1 and 1000')
+        return {'availableItems': len(items), 'items': items[index:index + length]}
+
+    def transfer(self, body:dict) -> dict:
+        'Move money, checking the transfer like the real api'
+        try:
+            amount = Decimal(str(body['amount']))
+            fromAccount, toAccount, message = body['fromAccount'], body['toAccount'], body['message']
+        except (KeyError, TypeError, ArithmeticError):
+            raise FakeSbankenError(400, 'Validation', 'Transfer needs fromAccount, toAccount, amount and message')
+        if not amount.is_finite() or amount < 1:
+            raise FakeSbankenError(400, 'Validation', 'Amount must be 1.00 or more')
+        if not isinstance(message, str) or not MESSAGE.match(message):
+            raise FakeSbankenError(400, 'Validation', 'Message must be 1 to 30 allowed characters')
+        if fromAccount == toAccount:
+            raise FakeSbankenError(400, 'Validation', 'Cannot transfer to the same account')
+        now = datetime.datetime.now().replace(microsecond=0).isoformat()
+        with self._lock:
+            debit, credit = self._account(fromAccount), self._account(toAccount)
+            if debit['available'] < amount:
+                raise FakeSbankenError(400, 'Validation', 'Not enough money on {}'.format(fromAccount))
+            for account, sign in ((debit, -1), (credit, 1)):
+                account['balance'] += sign * amount
+                account['available'] += sign * amount
+                self.transactions[account['accountNumber']].insert(0, {
+                    'transactionId': '{}{}'.format(time.time_ns(), sign),
+                    'accountNumber': account['accountNumber'],
+                    'accountingDate': now,
+                    'interestDate': now,
+                    'registrationDate': now,
+                    'amount': sign * amount,
+                    'text': message,
+                    'transactionType': 'OVFNETTB',
+                    'transactionTypeCode': 200,
+                    'transactionTypeText': 'OVFNETTB',
+                    'isReservation': False,
+                })
+        return {}
+
+def _json(value):
+    if isinstance(value, Decimal):
+        return float(value)
+    raise TypeError('{!r} is not json'.format(value))
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # keep connections alive, like the real api
+    disable_nagle_algorithm = True # headers and body are written separately, don't wait for the ack between them
+
+    def log_message(self, format, *args):
+        logging.debug('fakesbanken: ' + format, *args)
+
+    def reply(self, status:int, data:dict):
+        body = json.dumps(data, default=_json).encode()
+        self.send_response(status)
+        if status == 429:
+            self.send_header('Retry-After', '1')
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def route(self, method:str):
+        fake = self.server.fake
+        url = urlparse(self.path)
+        length = int(self.headers.get('Content-Length') or 0)
+        data = self.rfile.read(length) if length else b''
+        fake._wait()
+        if url.path == TOKEN and method == 'POST':
+            return self.reply(200, fake.issueToken())
+        if not fake.authorized(self.headers.get('Authorization')):
+            return self.reply(401, {'error': 'invalid_token'})
+        params = {k:v[-1] for k, v in parse_qs(url.query).items()}
+        for endpoint, pattern in ROUTES:
+            m = pattern.match(url.path)
+            if m:
+                break
+        else:
+            return self.reply(404, {'isError': True, 'errorType': 'NotFound', 'errorMessage': url.path})
+        params.update(m.groupdict())
+        try:
+            body = json.loads(data) if data else {}
+            reply = fake.handle(method, endpoint, params, body)
+        except ValueError:
+            return self.reply(400, {'isError': True, 'errorType': 'Validation', 'errorMessage': 'Body is not json'})
+        except FakeSbankenError as e:
+            return self.reply(e.status, {'isError': True, 'errorType': e.errorType, 'errorMessage': str(e), 'httpCode': e.status})
+        reply.update(isError=False, errorType=None, errorMessage=None)
+        self.reply(200, reply)
+
+    def do_GET(self):
+        self.route('GET')
+
+    def do_POST(self):
+        self.route('POST')
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Fake Sbanken api, for testing grisebank")
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds to wait before each reply')
+    parser.add_argument('--jitter', type=float, default=0.0, help='up to this many seconds more')
+    parser.add_argument('--balance', type=float, default=1000)
+    parser.add_argument('--accounts', metavar='CONFIGFILE', help='make the accounts in this grisebank config')
+    parser.add_argument('--loglevel', default='INFO')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=args.loglevel)
+    accounts = {'99999999999': args.balance, '88888888888': args.balance, '77777777777': args.balance}
+    if args.accounts:
+        c = configparser.RawConfigParser()
+        c.optionxform = lambda option: option # make configparser case aware
+        c.read(args.accounts)
+        accounts = {number:args.balance for name, number in c.items('accounts')}
+    fake = FakeSbanken(accounts, latency=args.latency, jitter=args.jitter, port=args.port)
+    print('Fake Sbanken at {}, token endpoint {}'.format(fake.url, fake.url + TOKEN))
+    try:
+        fake.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
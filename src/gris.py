@@ -1,3 +1,6 @@
+import time
+_started = time.perf_counter() # for the StartupProfile, from before the slow imports
+
 from kivy.app import App
 from kivy.uix.widget import Widget
 from kivy.properties import NumericProperty, ReferenceListProperty, ObjectProperty, StringProperty
@@ -5,87 +8,233 @@ from kivy.vector import Vector
 from kivy.clock import Clock
 from kivy.logger import Logger
 
-from pitftscreen import PiTFT_Screen 
-from pirc522 import RFID # pip install pirc522
-
-import yaml # pip install PyYAML
-
 import configparser
+import threading
+import logging
 
-import bank
+# the bank client (requests, oauthlib) is imported in the background, see openBank()
+from ledger import rewardKey
+from cards import CardRegistry
+from buttons import ButtonBridge, ButtonEvent, LONG, buttonMap
+from snapshot import CachedBank
+from startup import StartupProfile
+import backends
 
 class GriseBank(Widget):
     accountName = StringProperty("Ingen")
     accountValue = NumericProperty(0.0)
     status = StringProperty("Velg konto...")
+    account = ObjectProperty(None, allownone=True) # the selected GriseAccount
+    updated = StringProperty("") # when the balance is from, if it is old
+    idleTimeout = NumericProperty(60) # seconds without anything happening, before the backlight is turned off
+    staleAfter = NumericProperty(600) # seconds, show when the balance is from if it is older
+
+    # nothing is redrawn on a timer. the labels in grisebank.kv are bound to
+    # the properties above, so kivy only redraws when one of them changes
 
-    def update(self, dt):
-        'update stuff'
-        #Logger.info("updating gris , %r", dt)
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.screen = None
+        self.dimmed = False
+        self._idle = Clock.create_trigger(self.on_idle, self.idleTimeout)
 
     def setScreen(self, screen):
-        screen.Button1Interrupt(lambda x: self.button(1, x))
-        screen.Button2Interrupt(lambda x: self.button(2, x))
-        screen.Button3Interrupt(lambda x: self.button(3, x))
-        screen.Button4Interrupt(lambda x: self.button(4, x))
+        # gpio callbacks run in the RPi.GPIO thread, the bridge gets them over to the kivy loop
+        self.buttons = ButtonBridge(lambda fn, delay: Clock.schedule_once(lambda dt: fn(), delay),
+                                    self.button,
+                                    isPressed=lambda n: getattr(screen, 'Button{}'.format(n)))
+        screen.Button1Interrupt(lambda x: self.buttons.gpio(1, x))
+        screen.Button2Interrupt(lambda x: self.buttons.gpio(2, x))
+        screen.Button3Interrupt(lambda x: self.buttons.gpio(3, x))
+        screen.Button4Interrupt(lambda x: self.buttons.gpio(4, x))
         screen.Backlight(True)
         self.screen = screen
-
-    def setAccounts(self, accounts:[]):
-        print("setting accounts")
-        #pr(accounts)
+        self.wake()
+
+    def wake(self):
+        'something happened: turn the backlight on, and start counting idle time again'
+        self._idle.cancel()
+        self._idle()
+        if self.dimmed and self.screen is not None:
+            self.screen.Backlight(True)
+        self.dimmed = False
+        self.showUpdated()
+
+    def showUpdated(self):
+        'show when the balance of the selected account is from, if the bank has not told us for a while'
+        acc = self.account
+        if acc is None or acc.updated is None or time.time() - acc.updated < self.staleAfter:
+            self.updated = ""
+        elif time.localtime(acc.updated)[:3] == time.localtime()[:3]:
+            self.updated = time.strftime("Oppdatert %H:%M", time.localtime(acc.updated))
+        else:
+            self.updated = time.strftime("Oppdatert %d.%m. %H:%M", time.localtime(acc.updated))
+
+    def on_idle(self, dt):
+        'nothing has happened for idleTimeout seconds'
+        Logger.debug('idle for %s s, turning off backlight', self.idleTimeout)
+        if self.screen is not None:
+            self.screen.Backlight(False)
+        self.dimmed = True
+
+    def on_idleTimeout(self, instance, value):
+        self._idle.timeout = value
+        self.wake()
+
+    def on_account(self, instance, acc):
+        'a new account is selected'
+        if acc is not None:
+            self.accountName = acc.title
+            self.accountValue = float(acc.expectedBalance()) # with the rewards still in the outbox
+        self.wake()
+
+    def setAccounts(self, accounts:dict):
+        'set which account each button (or chord of buttons) selects, as a dict of button tuple -> GriseAccount'
+        Logger.debug('setting accounts: %r', accounts)
         self.accounts = accounts
 
-    def button(self, btnNumber:int, channel:int):
-        print('pressed button {}, gpio channel {}'.format(btnNumber, channel))
-        _map = {2:0, 4:1}
-        acc = self.accounts[_map[btnNumber]]
-        self.accountName = acc.title
-        self.accountValue = acc.details.balance
-        return
-        if btnNumber == 1:
-            self.accountName = "Bjarne"
-            self.accountValue = 20 
-        elif btnNumber == 2:
-            self.accountName = "Anna"
-            self.accountValue = 50 
-        elif btnNumber == 3:
-            self.accountName = "Cecilie"
-            self.accountValue = 92 
-        elif btnNumber == 4:
-            self.accountName = "BASE"
-            self.accountValue = -1 
+    def button(self, event:ButtonEvent):
+        'a button gesture, on the kivy loop'
+        Logger.debug('button event %r', event)
+        self.wake()
+        acc = self.accounts.get(event.buttons)
+        if acc is None:
+            Logger.info('No account for buttons %r', event.buttons)
+            return
+        if event.kind == LONG:
+            # held down: get fresh balances, balanceChanged() shows them
+            self.status = "Oppdaterer..."
+            threading.Thread(target=self.refresh, args=(acc,), name='refresh', daemon=True).start()
+            return
+        self.account = acc
         self.status = "Skann kortet..."
 
     def scan(self, card):
         'scaning rfid card'
         Logger.debug ('scanning rfid card: %s', card)
+        self.wake()
         self.status = card.name or card.hex
         if card.reward > 0:
             Logger.info("Rewarding %s based on card", card.reward)
 
+    def refresh(self, acc):
+        'in a background thread: get fresh balances of all accounts, in one request. balanceChanged() shows them'
+        try:
+            acc.bank.refreshAll()
+        except Exception as e:
+            Logger.warning('Could not refresh %s: %r', acc.title, e)
+            Clock.schedule_once(lambda dt: setattr(self, 'status', "Ingen kontakt med banken"))
+        else:
+            Clock.schedule_once(self.refreshed)
+
+    def refreshed(self, dt):
+        'the refresh went well: stop saying we are at it, unless a scan or another button has taken over'
+        if self.status == "Oppdaterer...":
+            self.status = "Velg konto..." if self.account is None else "Skann kortet..."
+        self.showUpdated()
+
+    def balanceChanged(self, user):
+        'the bank has new details for user, or a reward for user is waiting in the outbox'
+        if user is self.account:
+            self.accountValue = float(user.expectedBalance())
+            self.wake()
+
     def on_stop(self):
         Logger.debug("on_stop")
 
 class GriseBankApp(App):
+    cards = None
+    profile = None # a StartupProfile
+
     def setScreen(self, screen):
         self.screen = screen
 
     def setBank(self, bank):
         self.bank = bank
 
-    def setCards(self, cards):
+    def setCards(self, cards:CardRegistry):
         self.cards = cards
 
+    def openBank(self, opener):
+        '''Show the CachedBank set with setBank() until the real one is up.
+
+        opener() returns (bank, cards). It is called in a background thread
+        after the ui is built, and again until it works.'''
+        self.opener = opener
+
     def build(self):
         self.gris = GriseBank()
         self.gris.setScreen(self.screen)
-        self.gris.setAccounts(self.bank.users)
-        Clock.schedule_interval(self.gris.update, 1.0/60.0)
-        self.RFID = RFIDReader(self.on_rfid_card)
-        Clock.schedule_interval(self.RFID.update, 1.0/20.0)
+        self.gris.idleTimeout = self.bank.config.getfloat('screen', 'idleTimeout', fallback=60)
+        self.gris.staleAfter = self.bank.config.getfloat('screen', 'staleAfter', fallback=600)
+        self.pending = [] # (card, account name) scanned before the bank was ready
+        self.setAccounts()
+        # the reader calls us from its own thread, hand the card over to the kivy main loop
+        self.RFID = backends.openCardReader(self.bank.config,
+                                            lambda card: Clock.schedule_once(lambda dt: self.on_rfid_card(card)))
+        self.RFID.start()
+        self._starting = {'first frame'}
+        if self.bank.ready:
+            self.startBank()
+        else:
+            self.gris.status = "Kobler til banken..."
+            self._starting.add('bank ready')
+            threading.Thread(target=self._openBank, name='open bank', daemon=True).start()
+        Clock.schedule_once(lambda dt: self.started('first frame'))
         return self.gris
 
+    def started(self, step:str):
+        'mark a step of the startup on the profile, and log the profile when the ui and the bank are both up'
+        if self.profile is None:
+            return
+        self.profile.mark(step)
+        self._starting.discard(step)
+        if not self._starting:
+            self.profile.log()
+
+    def setAccounts(self):
+        'map the buttons to the accounts of self.bank'
+        accounts = {}
+        for buttons, name in buttonMap(self.bank.config, [u.title for u in self.bank.users]).items():
+            if name in self.bank.usersByName:
+                accounts[buttons] = self.bank.user(name)
+            else:
+                Logger.warning('Buttons %r: there is no account called %s', buttons, name)
+        self.gris.setAccounts(accounts)
+        if self.gris.account is not None:
+            self.gris.account = self.bank.usersByName.get(self.gris.account.title)
+
+    def startBank(self):
+        self.bank.addListener(self.on_balance_changed)
+        self.bank.outbox.start()
+        self.bank.watcher.start() # balance changes made elsewhere
+
+    def _openBank(self):
+        'in a background thread: get the real bank going'
+        wait = 5
+        while True:
+            try:
+                bank, cards = self.opener()
+                break
+            except Exception as e:
+                Logger.warning('Could not open the bank, trying again in %i s: %r', wait, e)
+                time.sleep(wait)
+                wait = min(300, wait * 2)
+        Clock.schedule_once(lambda dt: self.bankReady(bank, cards))
+
+    def bankReady(self, bank, cards):
+        'the real bank is up, swap it in for the CachedBank'
+        self.bank = bank
+        self.cards = cards
+        self.setAccounts()
+        self.startBank()
+        self.gris.status = "Velg konto..." if self.gris.account is None else "Skann kortet..."
+        pending, self.pending = self.pending, []
+        for card, name in pending:
+            self.lookup(card)
+            self.reward(card, self.bank.usersByName.get(name))
+        self.started('bank ready')
+
     def on_stop(self):
         """Event handler for the on_stop event which is fired when the
         application has finished running (i.e. the window is about to be
@@ -93,106 +242,126 @@ class GriseBankApp(App):
         """
         self.gris.on_stop()
         self.RFID.on_stop()
+        if self.bank.ready:
+            self.bank.outbox.stop()
+            self.bank.watcher.stop()
+        if self.cards is not None:
+            self.cards.stop()
 
     def on_rfid_card(self, card):
         'this is run when a new card is read'
         Logger.info('rfid card read: %r', card)
-        # look for card in known cards list
-        for c in self.cards:
-            if c['hex'] == card.hex:
-                # we know it
-                card.name = c['name']
-                card.reward = c['reward']
-
-        self.gris.scan(card)
-
-class RFIDCard:
-    'Model for rfid (mifare rc522) cards or tags'
-
-    def __init__(self, uid):
-        self.uid = uid
-        self.hex = ''.join('{:02X}'.format(a) for a in uid)
-        self.name = None # set later
-        self.reward = -1 # set later
-
-    def __str__(self):
-        return '<RFIDCard: {} ({})>'.format(self.hex, self.name)
-
-class RFIDReader:
-
-    # The 2.8TFT uses the hardware SPI pins (SCK, MOSI, MISO, CE0, CE1), #25 and #24. 
-    # buttons: #23, #22, #27/#21, and #18
-    # 
-    # Thus, we need to set up the rc522 RFID reader on SPI1, and on unused pins
-    # SDA = BOARD12
-    # SCK = BOARD40
-    # MOSI = BOARD38
-    # MISO = BOARD35
-    # IRQ = BOARD32
-    # RST = BOARD15
-    # self.rdr = RFID(bus=1, device=0, pin_ce=12, pin_irq=32, pin_rst=15)
-
-    def __init__(self, callback_new_rfid_fn):
-        'Set up RFID reader'
-        self.rdr = RFID(bus=1, device=0, pin_ce=12, pin_irq=32, pin_rst=15)
-        util = self.rdr.util()
-        util.debug = True
-        self.callbackfn = callback_new_rfid_fn # call this function with a RFIDCard() on new card detected
-        # TODO: use kivy events https://kivy.org/docs/guide/events.html
-        self.last_card = None # to filter out duplicates
-
-    def on_stop(self):
-        #Logger.debug("on_stop")
-        self.rdr.cleanup()
-
-    def card_detected(self, uid):
-        'Is run on each card detected'
-        if uid == self.last_card:
-            # duplicate
+        if not self.bank.ready:
+            # reward it when the bank is up, to the account selected now
+            self.gris.scan(card)
+            if self.gris.account is not None:
+                self.pending.append((card, self.gris.account.title))
+                self.gris.status = "Kobler til banken..."
             return
-        self.last_card = uid
-        self.callbackfn(RFIDCard(uid))
-
-    def update(self, dt):
-        'check if we have a new card nearby. Run this periodically'
-
-        #Logger.info("wating fir tag, %r", dt)
-        (error, data) = self.rdr.request()
-        if not error:
-            Logger.debug("Detected RFID: %s", format(data, "02x"))
-            (error, uid) = self.rdr.anticoll()
-            if error:
-                Logger.error("Error reading RFID: %r <UID: %r>", error, uid)
+        self.lookup(card)
+        self.gris.scan(card)
+        self.reward(card, self.gris.account)
+
+    def lookup(self, card):
+        'look for card in known cards'
+        known = self.cards.get(card.hex)
+        if known is not None:
+            card.name = known.name
+            card.reward = known.reward
+
+    def reward(self, card, account):
+        if card.reward > 0 and account is not None:
+            # queue it, the outbox sends it to the bank in the background
+            key = rewardKey(card.hex, account.details.accountNumber, bucket=self.bank.outbox.dedupWindow)
+            if self.bank.outbox.put(account, card.reward, card.name, key=key) is None:
+                self.gris.status = "Allerede registrert"
             else:
-                Logger.debug("Card read UID: "+str(uid[0])+","+str(uid[1])+","+str(uid[2])+","+str(uid[3]))
-                self.card_detected(uid)
+                self.gris.balanceChanged(account) # show it now, the bank gets it in a moment
 
+    def on_balance_changed(self, user):
+        'this is run from any thread, when the bank has new details for user'
+        Clock.schedule_once(lambda dt: self.gris.balanceChanged(user))
 
 if __name__ == '__main__':
     import argparse
 
     parser = argparse.ArgumentParser(description="Grisebank")
     parser.add_argument('configfile', default='config.ini')
-    parser.add_argument('cardsfile', default='cards.yaml')
-
+    parser.add_argument('cardsfile', nargs='?', help='cards.yaml, or look up cards on the reward service')
+    parser.add_argument('--loglevel', default='INFO', help='DEBUG shows every request to the bank')
+    parser.add_argument('--customer', help='the customer (family) of this kiosk, if the config has several')
+    parser.add_argument('--simulate', action='store_true', help='run without a pi, see [hardware] in the config')
+    parser.add_argument('--profile', help='save how long each step of the startup took to this json file')
+
+    profile = StartupProfile(_started)
+    profile.mark('imports')
     args = parser.parse_args()
+    logging.basicConfig(level=args.loglevel)
 
     c = configparser.RawConfigParser() 
     c.optionxform = lambda option: option # make configparser case aware
     c.read(args.configfile)
-
-
-    cards = yaml.safe_load(open(args.cardsfile))
-    Logger.info('%i rfid card definitions loaded', len(cards))
-
-    sbank = bank.GriseBank(c)
+    if args.simulate:
+        if not c.has_section('hardware'):
+            c.add_section('hardware')
+        c.set('hardware', 'backend', 'sim')
+
+    if backends.simulated(c) and c.getboolean('hardware', 'fakeBank', fallback=True):
+        from fakesbanken import FakeSbanken
+        fake = FakeSbanken.fromConfig(c, latency=c.getfloat('hardware', 'fakeLatency', fallback=0.1)).start()
+        fake.configure(c)
+        # keep the fake money and tokens away from the real ones
+        import tempfile
+        if not c.has_section('storage'):
+            c.add_section('storage')
+        c.set('storage', 'dir', tempfile.mkdtemp(prefix='grisebank-sim-'))
+        c.remove_option('login', 'tokenCache')
+    profile.mark('config')
+
+    remote = c.has_option('service', 'url')
+    def openBank():
+        'log in to the bank (or the reward service), and get the accounts and cards'
+        if remote:
+            # a thin kiosk: the reward service talks to the bank
+            with profile.phase('import service'):
+                import service
+            sbank = service.RemoteBank(c, customer=args.customer)
+            cards = service.RemoteCards(sbank) if args.cardsfile is None else CardRegistry(args.cardsfile)
+        else:
+            with profile.phase('import bank'):
+                import bank
+            sbank = bank.GriseBank(c, customer=args.customer)
+            cards = CardRegistry(args.cardsfile or 'cards.yaml')
+        if isinstance(cards, CardRegistry):
+            cards.start() # reload cards when the file changes
+        profile.mark('bank')
+        return sbank, cards
+
+    # show the balances from the last run right away, if we have them
+    cached = CachedBank.fromConfig(c, args.customer, remote)
+    profile.mark('snapshot')
 
     from kivy.config import Config
-    Config.set('graphics', 'fullscreen', 'auto')
+    if not backends.simulated(c):
+        Config.set('graphics', 'fullscreen', 'auto')
 
     gapp = GriseBankApp()
-    pitft = PiTFT_Screen()
-    gapp.setScreen(pitft)
-    gapp.setBank(sbank)
-    gapp.setCards(cards)
+    gapp.profile = profile
+    screen = backends.openScreen(c)
+    if isinstance(screen, backends.VirtualScreen):
+        # push the virtual buttons with the keys 1 to 4
+        from kivy.core.window import Window
+        Window.bind(on_key_down=lambda window, key, scancode, text, modifiers:
+                    text in ('1', '2', '3', '4') and screen.press(int(text)))
+    gapp.setScreen(screen)
+    if cached is None:
+        # the first start, there is nothing to show before the bank answers
+        sbank, cards = openBank()
+        gapp.setBank(sbank)
+        gapp.setCards(cards)
+    else:
+        gapp.setBank(cached)
+        gapp.openBank(openBank)
     gapp.run()
+    if args.profile:
+        profile.save(args.profile)
@@ -0,0 +1,169 @@
+'''A ledger of rewards, so no reward is ever paid twice.
+
+Every reward gets a key, made from the card, the account and a time bucket,
+so scanning the same card again right away gives the same key. The ledger
+records each key as it moves from queued, to submitted, to confirmed. Before
+a transfer is retried, the ledger checks if the bank already has it.
+
+'''
+import sqlite3
+import threading
+import hashlib
+import time
+import datetime
+import logging
+from decimal import Decimal
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS rewards (
+    key TEXT PRIMARY KEY,
+    account TEXT NOT NULL,
+    amount TEXT,
+    message TEXT,
+    state TEXT NOT NULL, -- queued, submitted, confirmed, failed
+    transferKey TEXT, -- the transfer this reward was (or will be) part of
+    created REAL,
+    submitted REAL,
+    confirmed REAL
+);
+CREATE INDEX IF NOT EXISTS rewards_transfer ON rewards (transferKey);
+CREATE INDEX IF NOT EXISTS rewards_state ON rewards (state);
+'''
+
+QUEUED = 'queued'
+SUBMITTED = 'submitted'
+CONFIRMED = 'confirmed'
+FAILED = 'failed' # the bank refused the transfer, see RewardOutbox
+
+def rewardKey(card:str, account:str, when:float=None, bucket:float=60) -> str:
+    '''Return the idempotency key for a reward from card to account.
+
+    All scans of the same card for the same account within one `bucket`
+    seconds time slot get the same key.'''
+    when = time.time() if when is None else when
+    return hashlib.sha1('{}|{}|{}'.format(card, account, int(when // bucket)).encode()).hexdigest()
+
+def transferKey(keys:list) -> str:
+    'Return the key of a transfer that covers all reward keys'
+    return hashlib.sha1('|'.join(sorted(keys)).encode()).hexdigest()
+
+def transferTag(key:str) -> str:
+    '''Return the short tag we put in the transfer message, to find the transfer again.
+
+    Only characters the api allows in a message, see AsyncSbankenClient.transfer().'''
+    return '(' + key[:8] + ')'
+
+def taggedMessage(message:str, key:str, maxLength:int=30) -> str:
+    'Return message with the transfer tag, cut to fit the 30 character limit of the api'
+    tag = ' ' + transferTag(key)
+    return message[:maxLength - len(tag)] + tag
+
+class RewardLedger:
+    'The state of every reward key, in one SQLite file'
+    def __init__(self, path:str):
+        self.path = path
+        self._lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        with self._lock, self.db:
+            self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def claim(self, key:str, account:str, amount, message:str=None) -> bool:
+        'Record a new reward. Returns False if the key is already in the ledger'
+        with self._lock, self.db:
+            cursor = self.db.execute('INSERT OR IGNORE INTO rewards (key, account, amount, message, state, created) VALUES (?, ?, ?, ?, ?, ?)',
+                                     (key, account, str(amount), message, QUEUED, time.time()))
+            return cursor.rowcount == 1
+
+    def state(self, key:str) -> str:
+        'Return the state of key, or None if we have never seen it'
+        with self._lock:
+            row = self.db.execute('SELECT state FROM rewards WHERE key=?', (key,)).fetchone()
+        return row['state'] if row else None
+
+    def _set(self, keys:list, sql:str, args:tuple=()):
+        with self._lock, self.db:
+            self.db.executemany('UPDATE rewards SET ' + sql + ' WHERE key=?', [args + (k,) for k in keys])
+
+    def markSubmitted(self, keys:list, transfer:str):
+        'The rewards are about to be sent to the bank, as the transfer with key `transfer`'
+        self._set(keys, 'state=?, transferKey=?, submitted=?', (SUBMITTED, transfer, time.time()))
+
+    def markConfirmed(self, keys:list):
+        'The bank has the transfer with these rewards'
+        self._set(keys, 'state=?, confirmed=?', (CONFIRMED, time.time()))
+
+    def markFailed(self, keys:list):
+        'The bank refused the transfer with these rewards, and will refuse it again'
+        self._set(keys, 'state=?', (FAILED,))
+
+    def markQueued(self, keys:list):
+        'The bank never got these rewards, so they may be sent again'
+        self._set(keys, 'state=?, transferKey=NULL, submitted=NULL', (QUEUED,))
+
+    def _transfers(self, where:str, args:list) -> list:
+        with self._lock:
+            rows = self.db.execute('SELECT key, transferKey, account, submitted FROM rewards WHERE ' + where + ' ORDER BY submitted',
+                                   args).fetchall()
+        r = {}
+        for row in rows:
+            r.setdefault(row['transferKey'], (row['transferKey'], row['account'], row['submitted'], []))[3].append(row['key'])
+        return list(r.values())
+
+    def submitted(self, keys:list) -> list:
+        'Return (transferKey, account, submitted, [reward keys]) for rewards among keys that were submitted but not confirmed'
+        return self._transfers('state=? AND key IN ({})'.format(','.join('?' * len(keys))), [SUBMITTED] + list(keys))
+
+    def transfers(self, state:str, since:float=0) -> list:
+        'Return (transferKey, account, submitted, [reward keys]) for transfers in state, submitted after since'
+        return self._transfers('state=? AND submitted>=?', [state, since])
+
+    def rewardsOf(self, tag:str) -> list:
+        'Return (message, amount) of the rewards in the transfer with tag, see transferTag()'
+        prefix = tag.strip('()')
+        with self._lock:
+            rows = self.db.execute('SELECT message, amount FROM rewards WHERE transferKey >= ? AND transferKey < ? ORDER BY created',
+                                   (prefix, prefix + 'g')).fetchall() # the keys are hex
+        return [(row['message'], Decimal(row['amount'])) for row in rows]
+
+    def atBank(self, bank:'GriseBank', transfer:str, account:str, submitted:float) -> bool:
+        '''Return True if the transfer shows up in the transactions of account, in the local transaction store.
+
+        We look for the transfer tag in the transaction text, see taggedMessage().'''
+        since = datetime.date.fromtimestamp(submitted or time.time())
+        return bool(bank.transactions.find(account, transferTag(transfer), startDate=since))
+
+    def sync(self, bank:'GriseBank', transfers:list):
+        'Get transactions from the bank for all accounts in transfers, from the day of the first submit'
+        since = {}
+        for transfer, account, submitted, keys in transfers:
+            since[account] = min(since.get(account, submitted or time.time()), submitted or time.time())
+        for account, submitted in since.items():
+            bank.transactions.sync(bank.client, account, startDate=datetime.date.fromtimestamp(submitted))
+
+    def reconcile(self, bank:'GriseBank', days:float=7) -> dict:
+        '''Check the ledger against the transactions at the bank.
+
+        Submitted transfers that the bank has are marked confirmed, the rest are
+        queued again, so the outbox sends them. Confirmed transfers from the last
+        `days` days that the bank doesn't have are reported as missing.
+        Returns a dict of state -> list of transfer keys.'''
+        report = {CONFIRMED: [], QUEUED: [], 'missing': []}
+        submitted = self.transfers(SUBMITTED)
+        confirmed = self.transfers(CONFIRMED, since=time.time() - days * 86400)
+        self.sync(bank, submitted + confirmed)
+        for transfer, account, when, keys in submitted:
+            if self.atBank(bank, transfer, account, when):
+                self.markConfirmed(keys)
+                report[CONFIRMED].append(transfer)
+            else:
+                self.markQueued(keys)
+                report[QUEUED].append(transfer)
+        for transfer, account, when, keys in confirmed:
+            if not self.atBank(bank, transfer, account, when):
+                logging.warning('Confirmed transfer %s to %s is missing at the bank', transfer, account)
+                report['missing'].append(transfer)
+        return report
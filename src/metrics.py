@@ -0,0 +1,247 @@
+'''Counters and latency histograms, with pluggable sinks.
+
+The client records what it does here: requests per endpoint, how long they
+took, errors by class, token refreshes, cache hits and how many requests
+are waiting. A Metrics object keeps the numbers in memory, and passes every
+count, observation and gauge on to its sinks, like a StatsdSink. A PrometheusExporter serves the numbers as
+Prometheus text over http.
+
+Set it up with the optional [metrics] section of the config, see
+config.ini.example.
+
+'''
+import socket
+import threading
+import logging
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# seconds, for latency histograms
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float('inf'))
+
+def _labels(labels:dict) -> tuple:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+class Histogram:
+    'Counts of observations per bucket, and their sum'
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets:tuple=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value:float):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q:float) -> float:
+        'Estimate the q quantile (0 to 1), as the upper bound of the bucket it falls in'
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(self.buckets, self.counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return self.buckets[-1]
+
+class Metrics:
+    '''Counters and histograms, keyed by name and labels.
+
+    `count(name, value, **labels)` adds to a counter, `observe(name, seconds,
+    **labels)` adds to a histogram, and `gauge(name, value, **labels)` sets
+    a value that goes up and down. They are passed on to every sink added
+    with addSink(), an object with the same methods taking (name, value,
+    labels). gauge() is optional on sinks. Safe to use from any thread.
+    '''
+    def __init__(self, prefix:str='grisebank', buckets:tuple=BUCKETS):
+        self.prefix = prefix
+        self.buckets = buckets
+        self.counters = {} # (name, labels) -> value
+        self.histograms = {} # (name, labels) -> Histogram
+        self.gauges = {} # (name, labels) -> value
+        self.sinks = []
+        self.exporter = None # a PrometheusExporter, if fromConfig() started one
+        self._lock = threading.Lock()
+
+    @classmethod
+    def fromConfig(cls, config:'configparser.ConfigParser') -> 'Metrics':
+        'Set up metrics and sinks from the optional [metrics] section of the config'
+        metrics = cls(config.get('metrics', 'prefix', fallback='grisebank'))
+        if config.has_option('metrics', 'statsdHost'):
+            metrics.addSink(StatsdSink(config.get('metrics', 'statsdHost'),
+                                       config.getint('metrics', 'statsdPort', fallback=8125),
+                                       metrics.prefix))
+        if config.has_option('metrics', 'prometheusPort'):
+            metrics.exporter = PrometheusExporter(metrics, config.getint('metrics', 'prometheusPort'),
+                                                  config.get('metrics', 'prometheusHost', fallback='127.0.0.1')).start()
+        return metrics
+
+    def addSink(self, sink):
+        self.sinks.append(sink)
+
+    def close(self):
+        'Stop the PrometheusExporter, if fromConfig() started one, so its port is free again'
+        if self.exporter is not None:
+            self.exporter.stop()
+            self.exporter = None
+
+    def count(self, name:str, value:float=1, **labels):
+        key = (name, _labels(labels))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+        for sink in self.sinks:
+            self._send(sink.count, name, value, labels)
+
+    def observe(self, name:str, value:float, **labels):
+        key = (name, _labels(labels))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(self.buckets)
+            histogram.observe(value)
+        for sink in self.sinks:
+            self._send(sink.observe, name, value, labels)
+
+    def gauge(self, name:str, value:float, **labels):
+        with self._lock:
+            self.gauges[(name, _labels(labels))] = value
+        for sink in self.sinks:
+            if hasattr(sink, 'gauge'):
+                self._send(sink.gauge, name, value, labels)
+
+    def _send(self, fn, name, value, labels):
+        try:
+            fn(name, value, labels)
+        except Exception:
+            logging.debug('metrics sink failed on %s', name, exc_info=True)
+
+    def counter(self, name:str, **labels) -> float:
+        'Return the sum of counter `name` over all label values that match labels'
+        want = _labels(labels)
+        with self._lock:
+            return sum(v for (n, l), v in self.counters.items() if n == name and set(want) <= set(l))
+
+    def stats(self) -> dict:
+        '''Return {name: {labels: value}} for counters and gauges, and count, mean, p50, p95 and p99 for histograms.
+
+        Labels are written as "key=value,key=value".'''
+        fmt = lambda labels: ','.join('{}={}'.format(k, v) for k, v in labels)
+        stats = {}
+        with self._lock:
+            for (name, labels), value in list(self.counters.items()) + list(self.gauges.items()):
+                stats.setdefault(name, {})[fmt(labels)] = value
+            for (name, labels), h in self.histograms.items():
+                stats.setdefault(name, {})[fmt(labels)] = {
+                    'count': h.count, 'mean': h.sum / h.count if h.count else None,
+                    'p50': h.quantile(0.5), 'p95': h.quantile(0.95), 'p99': h.quantile(0.99)}
+        return stats
+
+    def prometheus(self) -> str:
+        'Return all metrics in the Prometheus text format'
+        def name(n):
+            return '{}_{}'.format(self.prefix, n) if self.prefix else n
+        def labels(l, extra=()):
+            l = l + tuple(extra)
+            if not l:
+                return ''
+            return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in l) + '}'
+        lines = []
+        with self._lock:
+            seen = set()
+            for (n, l), value in sorted(self.counters.items()):
+                if n not in seen:
+                    lines.append('# TYPE {}_total counter'.format(name(n)))
+                    seen.add(n)
+                lines.append('{}_total{} {}'.format(name(n), labels(l), value))
+            for (n, l), value in sorted(self.gauges.items()):
+                if n not in seen:
+                    lines.append('# TYPE {} gauge'.format(name(n)))
+                    seen.add(n)
+                lines.append('{}{} {}'.format(name(n), labels(l), value))
+            for (n, l), h in sorted(self.histograms.items(), key=lambda item: item[0]):
+                if n not in seen:
+                    lines.append('# TYPE {} histogram'.format(name(n)))
+                    seen.add(n)
+                cumulative = 0
+                for bound, count in zip(h.buckets, h.counts):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append('{}_bucket{} {}'.format(name(n), labels(l, [('le', le)]), cumulative))
+                lines.append('{}_sum{} {}'.format(name(n), labels(l), h.sum))
+                lines.append('{}_count{} {}'.format(name(n), labels(l), h.count))
+        return '\n'.join(lines) + '\n'
+
+class StatsdSink:
+    '''Send every count and observation to a statsd server, over udp.
+
+    Label values are added to the name, sorted by label, like grisebank.requests.accountList.200
+    Observations are sent as timings in ms, gauges as gauges. Lost packets are lost.
+    '''
+    def __init__(self, host:str='127.0.0.1', port:int=8125, prefix:str='grisebank'):
+        self.address = (host, port)
+        self.prefix = prefix
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setblocking(False)
+
+    def _name(self, name:str, labels:dict) -> str:
+        parts = [self.prefix] if self.prefix else []
+        parts.append(name)
+        parts.extend(str(labels[k]).replace('.', '_').replace(':', '_') for k in sorted(labels))
+        return '.'.join(parts)
+
+    def _send(self, line:str):
+        try:
+            self.socket.sendto(line.encode(), self.address)
+        except OSError:
+            pass
+
+    def count(self, name:str, value:float, labels:dict):
+        self._send('{}:{}|c'.format(self._name(name, labels), value))
+
+    def observe(self, name:str, value:float, labels:dict):
+        self._send('{}:{:.3f}|ms'.format(self._name(name, labels), value * 1000))
+
+    def gauge(self, name:str, value:float, labels:dict):
+        self._send('{}:{}|g'.format(self._name(name, labels), value))
+
+class PrometheusExporter:
+    'Serve metrics.prometheus() at /metrics, in a background thread'
+    def __init__(self, metrics:Metrics, port:int=9464, host:str='127.0.0.1'):
+        self.metrics = metrics
+        exporter = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = exporter.metrics.prometheus().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self._thread = None
+
+    def start(self) -> 'PrometheusExporter':
+        self._thread = threading.Thread(target=self.server.serve_forever, name='metrics', daemon=True)
+        self._thread.start()
+        logging.info('Serving metrics at http://%s:%i/metrics', *self.server.server_address[:2])
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
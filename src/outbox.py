@@ -0,0 +1,339 @@
+'''A durable outbox for rewards.
+
+Rewards are written to a journal on disk before they are sent, so a card
+scan returns right away, and no rewards are lost if the network is down or
+the kiosk restarts. A background thread sends them to the bank.
+
+Transfers the bank refuses for good (a validation error) are not retried:
+their rewards are moved to `.failed`, and stay there until retryFailed().
+
+'''
+import json
+import os
+import os.path
+import string
+import threading
+import time
+import logging
+import uuid
+import tempfile
+import unicodedata
+from decimal import Decimal
+
+from ledger import transferKey, taggedMessage
+
+# what the api takes in a transfer, see AsyncSbankenClient.transfer()
+MIN_AMOUNT = Decimal('1.00')
+# short enough to keep whole next to the transfer tag, see ledger.taggedMessage()
+DEFAULT_MESSAGE = 'Grisebank reward'
+MERGED_MESSAGE = '{} Grisebank rewards' # the number of rewards in the transfer, up to 9 fit whole
+MESSAGE_CHARACTERS = set(string.digits + string.ascii_letters +
+                         'æÆøØåÅäÄëËïÏöÖüÜÿâÂêÊîÎôÔûÛãÃñÑõÕàÀèÈìÌòÒùÙáÁéÉíÍóÓýÝ,;.:!-/()? ')
+
+def cleanMessage(message:str, maxLength:int=30) -> str:
+    '''Return message with only the characters the api allows, cut to maxLength, or None if nothing is left.
+
+    Letters with accents the api doesn't know lose the accent, other characters are dropped.'''
+    if not message:
+        return None
+    kept = []
+    for c in message:
+        if c not in MESSAGE_CHARACTERS:
+            c = unicodedata.normalize('NFKD', c)[0]
+        kept.append(c if c in MESSAGE_CHARACTERS else ' ')
+    return ' '.join(''.join(kept).split())[:maxLength].strip() or None
+
+class OutboxEntry:
+    'One reward waiting in the outbox'
+    __slots__ = ('id', 'account', 'amount', 'message', 'time', 'key')
+
+    def __init__(self, id:str, account:str, amount:Decimal, message:str, time:float, key:str=None):
+        self.id = id
+        self.account = account
+        self.amount = Decimal(amount)
+        self.message = message
+        self.time = time
+        self.key = key or id # idempotency key, see ledger.rewardKey()
+
+    def __str__(self) -> str:
+        return '<OutboxEntry: {} kr to {} ({})>'.format(self.amount, self.account, self.message)
+
+    def to_json(self) -> dict:
+        return {'id': self.id, 'account': self.account, 'amount': str(self.amount),
+                'message': self.message, 'time': self.time, 'key': self.key}
+
+def readJournal(path:str, outbox:'RewardOutbox'=None) -> dict:
+    '''Replay the outbox journal at path, and return the waiting rewards as id -> OutboxEntry, oldest first.
+
+    With `outbox`, the rewards the bank refused are put in `outbox.failed`.'''
+    pending = {}
+    if not os.path.exists(path):
+        return pending
+    with open(path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                logging.warning('Skipping broken line in outbox journal %s: %r', path, line)
+                continue
+            if outbox is not None:
+                outbox._records += 1
+            if record['op'] == 'put':
+                entry = record['entry']
+                pending[entry['id']] = OutboxEntry(**entry)
+            elif record['op'] == 'done':
+                for id in record['ids']:
+                    pending.pop(id, None)
+            elif record['op'] == 'failed':
+                for id in record['ids']:
+                    entry = pending.pop(id, None)
+                    if entry is not None and outbox is not None:
+                        outbox.failed[id] = entry
+    return pending
+
+class RewardOutbox:
+    '''Queue rewards for accounts in the bank, and send them in the background.
+
+    Every reward is appended to the journal at `path` and fsynced before
+    put() returns. Call start() to run the sender thread. It waits
+    `mergeWindow` seconds after the oldest waiting reward, and then sends
+    all waiting rewards to that account as one transfer. Failed transfers
+    are retried with exponential backoff, up to `maxBackoff` seconds apart.
+
+    With a RewardLedger, every reward is claimed in the ledger by its key, so
+    the same key is never queued twice. Transfers are recorded as submitted
+    before they are sent, and tagged with their key in the message. If a
+    send fails, the bank is checked for the tag before the rewards are sent
+    again, so a transfer that timed out but went through is not paid twice.
+
+    A transfer the bank refuses with a validation error is never retried.
+    Its rewards are recorded as failed in the journal (and the ledger), and
+    kept in `.failed`. Call retryFailed() to queue them again, e.g. after
+    putting money in the base account.
+
+    `onSent(user, entries)` is called from the sender thread after each
+    transfer and balance update, with the GriseAccount and the
+    OutboxEntries it covered.
+    '''
+    def __init__(self, path:str, bank:'GriseBank', ledger:'RewardLedger'=None,
+                 mergeWindow:float=5, maxBackoff:float=300, dedupWindow:float=60, onSent=None):
+        self.path = path
+        self.bank = bank
+        self.ledger = ledger
+        self.dedupWindow = dedupWindow # seconds, the time bucket of ledger.rewardKey()
+        self.mergeWindow = mergeWindow
+        self.maxBackoff = maxBackoff
+        self.onSent = onSent
+        self.pending = {} # id -> OutboxEntry, oldest first
+        self.failed = {} # id -> OutboxEntry, refused by the bank
+        self.failures = 0 # transfers that failed in a row
+        self._retryAt = 0 # don't try again before this time, after a failure
+        self._records = 0 # number of lines in the journal
+        self._cond = threading.Condition()
+        self._thread = None
+        self._running = False
+        self._load()
+
+    def _load(self):
+        'replay the journal'
+        self.pending = readJournal(self.path, self)
+        if self.pending:
+            logging.info('%i rewards waiting in outbox %s', len(self.pending), self.path)
+
+    def _append(self, record:dict):
+        'append a record to the journal, and make sure it is on disk'
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self._records += 1
+
+    def _compact(self):
+        'rewrite the journal with only the waiting rewards'
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self.path) or '.', prefix='.outbox')
+        with os.fdopen(fd, 'w') as f:
+            for entry in list(self.failed.values()) + list(self.pending.values()):
+                f.write(json.dumps({'op': 'put', 'entry': entry.to_json()}) + '\n')
+            if self.failed:
+                f.write(json.dumps({'op': 'failed', 'ids': list(self.failed)}) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        self._records = len(self.failed) + len(self.pending) + bool(self.failed)
+
+    def __len__(self) -> int:
+        return len(self.pending)
+
+    def put(self, user:'GriseAccount', amount:Decimal, message:str=None, key:str=None) -> OutboxEntry:
+        '''Queue a reward for user. Returns when the reward is safely on disk.
+
+        Returns None if a reward with the same idempotency key has been queued before.
+        Raises ValueError for amounts the bank can't transfer.'''
+        amount = Decimal(amount)
+        if not amount.is_finite() or amount < MIN_AMOUNT:
+            raise ValueError('A reward must be at least {} kr, not {}'.format(MIN_AMOUNT, amount))
+        entry = OutboxEntry(uuid.uuid4().hex, user.details.accountNumber, amount, message, time.time(), key)
+        if self.ledger is not None and not self.ledger.claim(entry.key, entry.account, entry.amount, message):
+            logging.info('Reward %s to %s is already in the ledger, skipping it', entry.key, user.title)
+            return None
+        with self._cond:
+            self._append({'op': 'put', 'entry': entry.to_json()})
+            self.pending[entry.id] = entry
+            self._cond.notify()
+        return entry
+
+    def owed(self, account:str) -> Decimal:
+        'The sum of the rewards waiting for account (an account number)'
+        with self._cond:
+            return sum((e.amount for e in self.pending.values() if e.account == account), Decimal(0))
+
+    def due(self, now:float=None) -> list:
+        'Return the entries that should be sent as one transfer now, or an empty list'
+        if not self.pending:
+            return []
+        now = now or time.time()
+        oldest = next(iter(self.pending.values()))
+        if now - oldest.time < self.mergeWindow:
+            return []
+        return [e for e in self.pending.values() if e.account == oldest.account]
+
+    def _done(self, entries:list):
+        'take entries out of the outbox'
+        with self._cond:
+            self._append({'op': 'done', 'ids': [e.id for e in entries]})
+            for e in entries:
+                self.pending.pop(e.id, None)
+            if self._records > 100 and self._records > 4 * (len(self.pending) + len(self.failed)):
+                self._compact()
+
+    def _failed(self, entries:list, error:Exception):
+        'take entries out of the outbox, and keep them as failed'
+        logging.error('The bank refused %i rewards to %s, not trying again: %s', len(entries), entries[0].account, error)
+        with self._cond:
+            self._append({'op': 'failed', 'ids': [e.id for e in entries], 'error': str(error)})
+            for e in entries:
+                self.pending.pop(e.id, None)
+                self.failed[e.id] = e
+
+    def retryFailed(self) -> list:
+        'Queue the rewards the bank refused again. Returns them'
+        with self._cond:
+            entries = list(self.failed.values())
+            for e in entries:
+                self._append({'op': 'put', 'entry': e.to_json()})
+                self.pending[e.id] = e
+            self.failed.clear()
+            self._cond.notify()
+        if self.ledger is not None:
+            self.ledger.markQueued([e.key for e in entries])
+        return entries
+
+    def _notAtBank(self, entries:list) -> list:
+        'return the entries that the bank does not have, after an earlier send may have failed'
+        submitted = self.ledger.submitted([e.key for e in entries])
+        if not submitted:
+            return entries
+        self.ledger.sync(self.bank, submitted)
+        atBank = set()
+        for transfer, account, when, keys in submitted:
+            if self.ledger.atBank(self.bank, transfer, account, when):
+                logging.info('Transfer %s is at the bank already, not sending it again', transfer)
+                self.ledger.markConfirmed(keys)
+                atBank.update(keys)
+            else:
+                self.ledger.markQueued(keys)
+        self._done([e for e in entries if e.key in atBank])
+        return [e for e in entries if e.key not in atBank]
+
+    def send(self, entries:list) -> dict:
+        'Send entries as one transfer, and take them out of the outbox'
+        user = self.bank.usersByAccount[entries[0].account]
+        if self.ledger is not None:
+            remaining = self._notAtBank(entries)
+            if not remaining:
+                # all of it went through on an earlier try
+                self._sent(user, entries)
+                return None
+            entries = remaining
+        amount = sum(e.amount for e in entries)
+        if len(entries) == 1:
+            message = cleanMessage(entries[0].message)
+        else:
+            message = MERGED_MESSAGE.format(len(entries))
+        keys = [e.key for e in entries]
+        if self.ledger is not None:
+            transfer = transferKey(keys)
+            message = taggedMessage(message or DEFAULT_MESSAGE, transfer)
+            self.ledger.markSubmitted(keys, transfer)
+        from SbankenClient import SbankenValidationError # loaded by the bank already, keep it out of the kiosk startup
+        try:
+            result = self.bank.reward(user, amount, message)
+        except SbankenValidationError as e:
+            # retrying won't help, and would hold up the rewards behind these
+            if self.ledger is not None:
+                self.ledger.markFailed(keys)
+            self._failed(entries, e)
+            return None
+        if self.ledger is not None:
+            self.ledger.markConfirmed(keys)
+        self._done(entries)
+        logging.info('Sent %s kr to %s, covering %i rewards', amount, user.title, len(entries))
+        self._sent(user, entries)
+        return result
+
+    def _sent(self, user:'GriseAccount', entries:list):
+        'get the new balance of user, and tell onSent. The rewards are at the bank, so a failure here is not a failed send'
+        from SbankenClient import SbankenError
+        try:
+            user.update()
+        except SbankenError as e:
+            logging.warning('Could not get the new balance of %s: %r', user.title, e)
+        if self.onSent is not None:
+            self.onSent(user, entries)
+
+    def flush(self):
+        'Send everything in the outbox now, without waiting for the merge window'
+        while self.pending:
+            self.send(self.due(now=float('inf')))
+
+    def start(self):
+        'Start sending rewards from a background thread'
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='outbox', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        'Stop the background thread. Waiting rewards stay in the journal'
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._running:
+                    now = time.time()
+                    if now < self._retryAt:
+                        self._cond.wait(self._retryAt - now)
+                        continue
+                    entries = self.due(now)
+                    if entries:
+                        break
+                    if self.pending:
+                        # wait for the merge window of the oldest reward to close
+                        oldest = next(iter(self.pending.values()))
+                        self._cond.wait(max(oldest.time + self.mergeWindow - time.time(), 0.01))
+                    else:
+                        self._cond.wait()
+                if not self._running:
+                    return
+            try:
+                self.send(entries)
+                self.failures = 0
+            except Exception as e:
+                self.failures += 1
+                backoff = min(self.maxBackoff, 2 ** self.failures)
+                logging.warning('Could not send rewards, trying again in %i s: %r', backoff, e)
+                self._retryAt = time.time() + backoff
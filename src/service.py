@@ -0,0 +1,680 @@
+'''The reward service: one host talks to the bank, the kiosks talk to it.
+
+RewardService wraps the GriseBank of each customer in a small http/json
+api, for balances, history, card lookup and rewards. The bank credentials,
+the token, the cache, the outbox and the ledger all live on the service
+host, and rewards from all kiosks are merged and sent from its outbox.
+
+A kiosk uses a RemoteBank instead of a GriseBank: it has the parts of
+GriseBank that gris.py uses, and talks to the service over one keep-alive
+connection. Set [service] url in the kiosk config to use it.
+
+    python service.py config.ini
+
+The api, all json, with `Authorization: Bearer <[service] token>`:
+
+    GET  /v1/customers
+    GET  /v1/<customer>/accounts
+    GET  /v1/<customer>/accounts/<name>?fresh=1
+    GET  /v1/<customer>/accounts/<name>/history?limit=&startDate=&endDate=&sync=1
+    GET  /v1/<customer>/accounts/<name>/savings?weeks=&months=&sync=1
+    GET  /v1/<customer>/cards/<hex>
+    POST /v1/<customer>/rewards   {"rewards": [{"account", "amount", "message", "key"}, ...]}
+    GET  /v1/<customer>/events    server-sent events, see EventHub
+
+The service runs the BalanceWatcher of each customer, so all kiosks share
+one poll of the bank, and hear about balance changes through /events.
+
+'''
+import os
+import os.path
+import re
+import json
+import time
+import hmac
+import threading
+import queue
+import logging
+import configparser
+from decimal import Decimal, InvalidOperation
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs, quote, unquote
+
+import requests # pip install requests
+
+from SbankenClient import SbankenError, SbankenAccount, SbankenTransaction
+from outbox import RewardOutbox, OutboxEntry, MIN_AMOUNT
+from cards import Card, CardError, normalizeHex
+from snapshot import BalanceSnapshot, storageDir, snapshotPath, outboxPath
+
+DEFAULT = 'default' # the customer name of a single customer setup
+
+class ServiceError(Exception):
+    'An error for the caller, sent with this http status'
+    def __init__(self, status:int, message:str):
+        super().__init__(message)
+        self.status = status
+
+class EventHub:
+    '''Pass balance changes of GriseAccounts on to subscribers, like the kiosks listening to /events.
+
+    Each event is a dict with the customer, the account name, its details,
+    `owed`, the rewards to it still in the outbox, and `delta`, how much the
+    balance changed since the last event for it.
+    Subscribers get a queue.Queue of events, that holds the newest
+    `backlog` events if they fall behind.
+    '''
+    def __init__(self, backlog:int=100):
+        self.backlog = backlog
+        self.subscribers = {} # customer -> set of queues
+        self.balances = {} # (customer, account number) -> last balance we told about
+        self.published = 0
+        self._lock = threading.Lock()
+
+    def watch(self, customer:str, bank:'bank.GriseBank'):
+        'Publish the balance changes of bank'
+        for user in bank.users + [bank.baseAccount]:
+            self.balances[(customer, user.details.accountNumber)] = user.details.balance
+        bank.addListener(lambda user: self.changed(customer, user))
+
+    def changed(self, customer:str, user:'bank.GriseAccount'):
+        key = (customer, user.details.accountNumber)
+        with self._lock:
+            old = self.balances.get(key)
+            self.balances[key] = user.details.balance
+        if old == user.details.balance:
+            return
+        self.publish(customer, {'customer': customer, 'name': user.title, 'details': user.details.to_json(),
+                                'owed': str(user.bank.outbox.owed(user.details.accountNumber)),
+                                'delta': float(user.details.balance - old) if old is not None else None})
+
+    def publish(self, customer:str, event:dict):
+        with self._lock:
+            subscribers = list(self.subscribers.get(customer, ()))
+            self.published += 1
+        for q in subscribers:
+            while True:
+                try:
+                    q.put_nowait(event)
+                    break
+                except queue.Full:
+                    try:
+                        q.get_nowait() # drop the oldest, the newest balance is what matters
+                    except queue.Empty:
+                        pass
+
+    def subscribe(self, customer:str) -> queue.Queue:
+        q = queue.Queue(self.backlog)
+        with self._lock:
+            self.subscribers.setdefault(customer, set()).add(q)
+        return q
+
+    def unsubscribe(self, customer:str, q:queue.Queue):
+        with self._lock:
+            self.subscribers.get(customer, set()).discard(q)
+
+class RewardService:
+    '''Serve the GriseBanks in `banks` (customer name -> GriseBank) over http.
+
+    `cards` is a CardRegistry for card lookups. With `token`, every request must send it as a bearer token.
+    Rewards above `maxReward` are refused. Balance changes of all banks are
+    published through `.events`, an EventHub.
+    '''
+    def __init__(self, banks:dict, cards=None, token:str=None, maxReward:Decimal=None, host:str='127.0.0.1', port:int=8421):
+        self.banks = banks
+        self.cards = cards
+        self.token = token
+        self.maxReward = maxReward
+        self.requests = {} # route name -> count
+        self.heartbeat = 15 # seconds between keep-alive comments on /events
+        self.events = EventHub()
+        for customer, bank in banks.items():
+            self.events.watch(customer, bank)
+        self.server = ThreadingHTTPServer((host, port), _Handler)
+        self.server.daemon_threads = True
+        self.server.service = self
+        self._thread = None
+        self._stopping = False
+        if token is None:
+            logging.warning('The reward service has no [service] token, anyone who can reach it can reward')
+
+    @classmethod
+    def fromConfig(cls, config:configparser.ConfigParser, banks:dict, cards=None) -> 'RewardService':
+        maxReward = config.get('service', 'maxReward', fallback=None)
+        return cls(banks, cards,
+                   token=config.get('service', 'token', fallback=None),
+                   maxReward=Decimal(maxReward) if maxReward else None,
+                   host=config.get('service', 'host', fallback='127.0.0.1'),
+                   port=config.getint('service', 'port', fallback=8421))
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return 'http://{}:{}'.format(host, port)
+
+    def start(self) -> 'RewardService':
+        'Serve requests in a background thread'
+        self._thread = threading.Thread(target=self.server.serve_forever, name='service', daemon=True)
+        self._thread.start()
+        logging.info('Reward service at %s, for %s', self.url, ', '.join(self.banks))
+        return self
+
+    def stop(self):
+        self._stopping = True
+        self.server.shutdown()
+        self.server.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    # the api
+
+    def bank(self, customer:str) -> 'bank.GriseBank':
+        if customer not in self.banks:
+            raise ServiceError(404, 'No customer {}'.format(customer))
+        return self.banks[customer]
+
+    def user(self, customer:str, name:str) -> 'bank.GriseAccount':
+        bank = self.bank(customer)
+        if name not in bank.usersByName:
+            raise ServiceError(404, 'No account {} for {}'.format(name, customer))
+        return bank.usersByName[name]
+
+    def customers(self) -> dict:
+        return {'customers': list(self.banks)}
+
+    def _account(self, user:'bank.GriseAccount') -> dict:
+        'the details of user, and the rewards to it still in the outbox, from any kiosk'
+        return {'name': user.title, 'details': user.details.to_json(),
+                'owed': str(user.bank.outbox.owed(user.details.accountNumber))}
+
+    def accounts(self, customer:str) -> dict:
+        bank = self.bank(customer)
+        return {'accounts': [self._account(u) for u in bank.users]}
+
+    def account(self, customer:str, name:str, fresh:bool=False) -> dict:
+        user = self.user(customer, name)
+        if fresh:
+            user.update() # goes through the client cache, so many kiosks asking cost one request
+        return self._account(user)
+
+    def history(self, customer:str, name:str, limit:int=None, startDate=None, endDate=None, sync:bool=True) -> dict:
+        user = self.user(customer, name)
+        return {'transactions': [t.to_json() for t in user.history(limit, startDate, endDate, sync)]}
+
+    def savings(self, customer:str, name:str, weeks:int=8, months:int=6, sync:bool=True) -> dict:
+        'Savings per week and month, rewards per card and the trend, in kroner as strings'
+        user = self.user(customer, name)
+        if sync:
+            user.bank.transactions.sync(user.bank.client, user.details.accountNumber)
+        summary = user.savings(weeks, months)
+        periods = lambda ps: [{'start': p['start'].isoformat(), 'deposits': str(p['deposits']),
+                               'withdrawals': str(p['withdrawals']), 'net': str(p['net'])} for p in ps]
+        return {'weeks': periods(summary['weeks']), 'months': periods(summary['months']),
+                'rewards': [{'card': card, 'count': count, 'amount': str(amount)} for card, (count, amount) in summary['rewards'].items()],
+                'trend': str(summary['trend'])}
+
+    def card(self, customer:str, hex:str) -> dict:
+        self.bank(customer)
+        card = self.cards.get(hex) if self.cards is not None else None
+        if card is None:
+            raise ServiceError(404, 'Unknown card {}'.format(hex))
+        return {'hex': card.hex, 'name': card.name, 'reward': str(card.reward)}
+
+    def reward(self, customer:str, rewards:list) -> dict:
+        '''Queue rewards in the outbox of customer. Returns the keys that were queued, the ones we already had,
+        and what the outbox now owes each account in the rewards.
+
+        Every reward needs a key (see ledger.rewardKey()), so a kiosk can send
+        the same rewards again after a timeout, and they are only paid once.
+        All rewards are checked before any are queued: if one is refused, none are.'''
+        bank = self.bank(customer)
+        if not isinstance(rewards, list):
+            raise ServiceError(400, 'rewards must be a list, not {!r}'.format(rewards))
+        checked = []
+        for r in rewards:
+            try:
+                user = bank.usersByAccount[r['account']]
+                amount = Decimal(str(r['amount']))
+                key = r['key']
+            except (KeyError, TypeError, InvalidOperation):
+                raise ServiceError(400, 'A reward needs a known account, an amount and a key: {!r}'.format(r))
+            if not amount.is_finite() or amount < MIN_AMOUNT or (self.maxReward is not None and amount > self.maxReward):
+                raise ServiceError(400, 'Reward must be at least {}{}, not {}'.format(MIN_AMOUNT,
+                    '' if self.maxReward is None else ' and at most {}'.format(self.maxReward), amount))
+            checked.append((user, amount, r.get('message'), key))
+        queued, duplicates = [], []
+        for user, amount, message, key in checked:
+            if bank.outbox.put(user, amount, message, key=key) is None:
+                duplicates.append(key)
+            else:
+                queued.append(key)
+        owed = {user.details.accountNumber:str(bank.outbox.owed(user.details.accountNumber)) for user, _, _, _ in checked}
+        return {'queued': queued, 'duplicates': duplicates, 'owed': owed}
+
+ROUTES = [
+    ('customers', 'GET', r'^/v1/customers$', lambda s, q, b: s.customers()),
+    ('accounts', 'GET', r'^/v1/(?P<customer>[^/]+)/accounts$', lambda s, q, b, customer: s.accounts(customer)),
+    ('account', 'GET', r'^/v1/(?P<customer>[^/]+)/accounts/(?P<name>[^/]+)$',
+     lambda s, q, b, customer, name: s.account(customer, name, q.get('fresh') == '1')),
+    ('history', 'GET', r'^/v1/(?P<customer>[^/]+)/accounts/(?P<name>[^/]+)/history$',
+     lambda s, q, b, customer, name: s.history(customer, name, int(q['limit']) if 'limit' in q else None,
+                                               q.get('startDate'), q.get('endDate'), q.get('sync', '1') == '1')),
+    ('savings', 'GET', r'^/v1/(?P<customer>[^/]+)/accounts/(?P<name>[^/]+)/savings$',
+     lambda s, q, b, customer, name: s.savings(customer, name, int(q.get('weeks', 8)), int(q.get('months', 6)),
+                                               q.get('sync', '1') == '1')),
+    ('card', 'GET', r'^/v1/(?P<customer>[^/]+)/cards/(?P<hex>[^/]+)$', lambda s, q, b, customer, hex: s.card(customer, hex)),
+    ('rewards', 'POST', r'^/v1/(?P<customer>[^/]+)/rewards$', lambda s, q, b, customer: s.reward(customer, b.get('rewards', []))),
+    ('events', 'GET', r'^/v1/(?P<customer>[^/]+)/events$', None), # see _Handler.events()
+]
+ROUTES = [(name, method, re.compile(pattern), fn) for name, method, pattern, fn in ROUTES]
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # keep connections from the kiosks alive
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        logging.debug('service: ' + format, *args)
+
+    def reply(self, status:int, data:dict):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def route(self, method:str):
+        service = self.server.service
+        url = urlparse(self.path)
+        length = int(self.headers.get('Content-Length') or 0)
+        data = self.rfile.read(length) if length else b''
+        if service.token is not None and not hmac.compare_digest(self.headers.get('Authorization', ''),
+                                                                 'Bearer ' + service.token):
+            return self.reply(401, {'error': 'Needs the service token'})
+        for name, m, pattern, fn in ROUTES:
+            match = pattern.match(url.path)
+            if match and m == method:
+                break
+        else:
+            return self.reply(404, {'error': 'No such thing: {} {}'.format(method, url.path)})
+        service.requests[name] = service.requests.get(name, 0) + 1
+        if name == 'events':
+            return self.events(unquote(match.group('customer')))
+        try:
+            body = json.loads(data) if data else {}
+            if not isinstance(body, dict):
+                raise ValueError('The body must be a json object, not {}'.format(type(body).__name__))
+            query = {k:v[-1] for k, v in parse_qs(url.query).items()}
+            reply = fn(service, query, body, **{k:unquote(v) for k, v in match.groupdict().items()})
+        except ServiceError as e:
+            return self.reply(e.status, {'error': str(e)})
+        except ValueError as e:
+            return self.reply(400, {'error': str(e)})
+        except SbankenError as e:
+            logging.warning('%s %s: the bank failed: %r', method, url.path, e)
+            return self.reply(502, {'error': 'The bank failed: {}'.format(e)})
+        self.reply(200, reply)
+
+    def events(self, customer:str):
+        'stream balance changes as server-sent events, until the kiosk goes away'
+        service = self.server.service
+        if customer not in service.banks:
+            return self.reply(404, {'error': 'No customer {}'.format(customer)})
+        q = service.events.subscribe(customer)
+        try:
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Cache-Control', 'no-cache')
+            self.end_headers()
+            self.wfile.write(b': hello\n\n')
+            while not service._stopping:
+                try:
+                    event = q.get(timeout=service.heartbeat)
+                    self.wfile.write('event: balance\ndata: {}\n\n'.format(json.dumps(event)).encode())
+                except queue.Empty:
+                    self.wfile.write(b': ping\n\n') # keep the connection, and find out if it is gone
+        except OSError:
+            pass # the kiosk went away
+        finally:
+            service.events.unsubscribe(customer, q)
+            self.close_connection = True
+
+    def do_GET(self):
+        self.route('GET')
+
+    def do_POST(self):
+        self.route('POST')
+
+def _owed(reply:dict) -> Decimal:
+    'what the service owes an account, from an account reply or event, or None from an older service'
+    return Decimal(reply['owed']) if reply.get('owed') is not None else None
+
+class RemoteAccount:
+    '''A GriseAccount on the reward service.
+
+    `.owed` is what the outbox on the service owes it, from this and other
+    kiosks, as the service last told us.'''
+    def __init__(self, title:str, details:SbankenAccount, bank:'RemoteBank', owed:Decimal=None):
+        self.title = title
+        self.details = details
+        self.bank = bank
+        self.owed = owed if owed is not None else Decimal(0)
+        self.updated = None # time.time() when the service last told us the details
+
+    def __str__(self) -> str:
+        return '<RemoteAccount: {}, account # {}, balance:{}>'.format(self.title, self.details.accountNumber, self.details.balance)
+
+    def update(self) -> None:
+        'Get new details from the service about balance etc'
+        a = self.bank.get('accounts/{}'.format(quote(self.title)), fresh=1)
+        self.bank.setDetails(self, SbankenAccount(a['details']), owed=_owed(a))
+
+    def expectedBalance(self) -> Decimal:
+        'The balance once the rewards waiting in the outbox here, and on the service, are sent'
+        return self.details.balance + self.owed + self.bank.outbox.owed(self.details.accountNumber)
+
+    def history(self, limit:int=None, startDate=None, endDate=None, sync:bool=True) -> list:
+        'Return transactions on the account, newest first'
+        params = {'sync': int(sync)}
+        if limit is not None:
+            params['limit'] = limit
+        if startDate is not None:
+            params['startDate'] = str(startDate)
+        if endDate is not None:
+            params['endDate'] = str(endDate)
+        reply = self.bank.get('accounts/{}/history'.format(quote(self.title)), **params)
+        return [SbankenTransaction(t) for t in reply['transactions']]
+
+class RemoteOutbox(RewardOutbox):
+    '''The outbox of a kiosk, that sends rewards on to the reward service.
+
+    Rewards are kept in a journal on the kiosk until the service has them,
+    and are sent with their keys, so sending them again is safe. The service
+    merges them with rewards from other kiosks, and pays them.
+
+    There is no ledger on the kiosk: put() skips a key that is waiting here,
+    or was sent to the service in the last two `dedupWindow`s, so a scan
+    that the service would call a duplicate isn't counted in the meantime.'''
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.recent = {} # key -> time.time() it was sent to the service
+
+    def put(self, user:'RemoteAccount', amount:Decimal, message:str=None, key:str=None) -> OutboxEntry:
+        with self._cond:
+            now = time.time()
+            self.recent = {k:t for k, t in self.recent.items() if now - t < 2 * self.dedupWindow}
+            if key is not None and (key in self.recent or any(e.key == key for e in self.pending.values())):
+                logging.info('Reward %s to %s is already queued, skipping it', key, user.title)
+                return None
+            return super().put(user, amount, message, key)
+
+    def send(self, entries:list) -> dict:
+        try:
+            reply = self.bank.post('rewards', {'rewards': [e.to_json() for e in entries]})
+        except ServiceError as e:
+            if e.status != 400:
+                raise # try again later
+            self._failed(entries, e)
+            return None
+        user = self.bank.usersByAccount[entries[0].account]
+        if entries[0].account in reply.get('owed', {}):
+            user.owed = Decimal(reply['owed'][entries[0].account]) # before _done(), so they count once
+        self._done(entries)
+        with self._cond:
+            self.recent.update((e.key, time.time()) for e in entries)
+        if reply['duplicates']:
+            logging.info('The service already had %i of the rewards', len(reply['duplicates']))
+        if self.onSent is not None:
+            self.onSent(user, entries)
+        return reply
+
+class RemoteCards:
+    'Look up cards on the reward service, like a CardRegistry. Known cards are remembered for `ttl` seconds'
+    def __init__(self, bank:'RemoteBank', ttl:float=60):
+        self.bank = bank
+        self.ttl = ttl
+        self._cards = {} # hex -> (time, Card or None)
+
+    def get(self, uid) -> Card:
+        'Return the Card with this uid, or None'
+        try:
+            hex = normalizeHex(uid)
+        except CardError:
+            return None
+        cached = self._cards.get(hex)
+        if cached is not None and time.monotonic() - cached[0] < self.ttl:
+            return cached[1]
+        try:
+            c = self.bank.get('cards/{}'.format(hex))
+            card = Card(c['hex'], c['name'], Decimal(c['reward']))
+        except ServiceError as e:
+            if e.status != 404:
+                logging.warning('Could not look up card %s: %s', hex, e)
+                return cached[1] if cached is not None else None
+            card = None
+        self._cards[hex] = (time.monotonic(), card)
+        return card
+
+    def stop(self):
+        pass
+
+class RemoteEvents:
+    '''Listen to balance changes from the reward service, in a background thread.
+
+    The kiosk side of BalanceWatcher: the service polls the bank, and pushes
+    changes to /events. After a lost connection we connect again, and get
+    all balances, in case we missed something on the way.
+    '''
+    def __init__(self, bank:'RemoteBank', maxBackoff:float=60, heartbeat:float=15):
+        self.bank = bank
+        self.maxBackoff = maxBackoff
+        self.heartbeat = heartbeat # the service sends something at least this often
+        self.events = 0
+        self._running = False
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._running = True
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='events', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        'Stop listening. A thread waiting for the service stops at the next event or heartbeat'
+        self._running = False
+        self._stop.set()
+
+    def poke(self):
+        'Get all balances now'
+        self.bank.refreshAll()
+
+    def apply(self, event:dict):
+        'A balance change from the service'
+        self.events += 1
+        user = self.bank.usersByName.get(event['name'])
+        if user is not None:
+            self.bank.setDetails(user, SbankenAccount(event['details']), owed=_owed(event))
+
+    def _run(self):
+        failures = 0
+        with requests.Session() as session:
+            session.headers.update(self.bank.session.headers)
+            while self._running:
+                try:
+                    with session.get('{}/v1/{}/events'.format(self.bank.url, quote(self.bank.customer)), stream=True,
+                                     timeout=(self.bank.timeout, 3 * self.heartbeat)) as r:
+                        r.raise_for_status()
+                        failures = 0
+                        self.bank.refreshAll() # catch up on what we missed while away
+                        self._read(r.iter_lines(chunk_size=1, decode_unicode=True)) # an event must not wait for a full chunk
+                except Exception as e:
+                    if not self._running:
+                        break
+                    failures += 1
+                    backoff = min(self.maxBackoff, 2 ** failures)
+                    logging.warning('Lost the events from the reward service, trying again in %i s: %r', backoff, e)
+                    self._stop.wait(backoff)
+
+    def _read(self, lines):
+        'read server-sent events'
+        kind, data = None, []
+        for line in lines:
+            if not self._running:
+                return
+            if line.startswith('event:'):
+                kind = line[6:].strip()
+            elif line.startswith('data:'):
+                data.append(line[5:].strip())
+            elif line.startswith(':'):
+                # a heartbeat: we are connected, so the balances we have are current
+                now = time.time()
+                for user in self.bank.users:
+                    user.updated = now
+            elif not line:
+                if kind == 'balance' and data:
+                    self.apply(json.loads('\n'.join(data)))
+                kind, data = None, []
+
+class RemoteBank:
+    '''A GriseBank on the reward service, for kiosks.
+
+    Has the parts of GriseBank that the kiosk uses: `.users`, `.usersByName`,
+    `.usersByAccount`, `user()`, `addListener()`, `.outbox`, `.watcher`
+    (a RemoteEvents) and `.snapshot`. Set it up
+    from the [service] section of the config: `url`, `token`, and `customer`
+    (or pass it in).
+    '''
+    ready = True # see snapshot.CachedBank
+
+    def __init__(self, config:configparser.ConfigParser, customer:str=None):
+        self.config = config
+        self.url = config.get('service', 'url').rstrip('/')
+        self.customer = customer or config.get('service', 'customer', fallback=DEFAULT)
+        self.timeout = config.getfloat('service', 'timeout', fallback=5)
+        self.session = requests.Session() # one keep-alive connection to the service
+        token = config.get('service', 'token', fallback=None)
+        if token is not None:
+            self.session.headers['Authorization'] = 'Bearer ' + token
+        self.listeners = []
+        self.users = [RemoteAccount(a['name'], SbankenAccount(a['details']), self, _owed(a)) for a in self.get('accounts')['accounts']]
+        self.usersByName = {u.title:u for u in self.users}
+        self.usersByAccount = {u.details.accountNumber:u for u in self.users}
+        self.storage = storageDir(config)
+        os.makedirs(self.storage, exist_ok=True)
+        # no merge window here, the service merges rewards from all kiosks
+        self.outbox = RemoteOutbox(outboxPath(config, remote=True), self, None, mergeWindow=0,
+                                   maxBackoff=config.getfloat('outbox', 'maxBackoff', fallback=300),
+                                   dedupWindow=config.getfloat('outbox', 'dedupWindow', fallback=60))
+        self.watcher = RemoteEvents(self)
+        self.snapshot = BalanceSnapshot(snapshotPath(config, remote=True))
+        self.refreshed(self.users)
+
+    def _call(self, method:str, path:str, **kwargs) -> dict:
+        try:
+            r = self.session.request(method, '{}/v1/{}/{}'.format(self.url, quote(self.customer), path),
+                                     timeout=self.timeout, **kwargs)
+        except requests.RequestException as e:
+            raise ServiceError(503, 'Could not reach the reward service: {}'.format(e))
+        if not r.ok:
+            try:
+                message = r.json().get('error')
+            except ValueError:
+                message = r.reason
+            raise ServiceError(r.status_code, message)
+        return r.json()
+
+    def get(self, path:str, **params) -> dict:
+        return self._call('GET', path, params=params)
+
+    def post(self, path:str, data:dict) -> dict:
+        return self._call('POST', path, json=data)
+
+    def addListener(self, fn) -> None:
+        'Call fn(user) whenever the details (like the balance) of a RemoteAccount change'
+        self.listeners.append(fn)
+
+    def changed(self, user:RemoteAccount) -> None:
+        for fn in self.listeners:
+            try:
+                fn(user)
+            except Exception:
+                logging.exception('Listener %r failed', fn)
+
+    def user(self, name:str) -> RemoteAccount:
+        return self.usersByName[name]
+
+    def setDetails(self, user:RemoteAccount, details:SbankenAccount, save:bool=True, owed:Decimal=None) -> None:
+        'give user new details (and what the service owes it), and tell the listeners if they changed'
+        old = user.details, user.owed
+        user.details = details
+        if owed is not None:
+            user.owed = owed
+        if save:
+            self.refreshed([user])
+        if (details, user.owed) != old:
+            self.changed(user)
+
+    def refreshed(self, users:list) -> None:
+        'The service just told us the details of users: note the time, and save the snapshot'
+        now = time.time()
+        for user in users:
+            user.updated = now
+        self.snapshot.save(self)
+
+    def refreshAll(self) -> dict:
+        'Get the balances of all accounts from the service, in one request. Returns {name: (old balance, new balance)} for the ones that changed'
+        users, changes = [], {}
+        for a in self.get('accounts')['accounts']:
+            user = self.usersByName.get(a['name'])
+            if user is not None:
+                old = user.details.balance
+                self.setDetails(user, SbankenAccount(a['details']), save=False, owed=_owed(a))
+                users.append(user)
+                if user.details.balance != old:
+                    changes[user.title] = (old, user.details.balance)
+        self.refreshed(users)
+        return changes
+
+    def close(self):
+        self.watcher.stop()
+        self.outbox.stop()
+        self.session.close()
+
+if __name__ == '__main__':
+    import argparse
+    import bank
+    from cards import CardRegistry
+
+    parser = argparse.ArgumentParser(description="Grisebank reward service")
+    parser.add_argument('configfile', default='config.ini')
+    parser.add_argument('--loglevel', default='INFO', help='DEBUG shows every request to the bank')
+    args = parser.parse_args()
+    logging.basicConfig(level=args.loglevel)
+
+    c = configparser.RawConfigParser()
+    c.optionxform = lambda option: option # make configparser case aware
+    c.read(args.configfile)
+
+    if bank.GriseBanks.customers(c):
+        banks = bank.GriseBanks(c)
+        griseBanks = banks.banks
+    else:
+        banks = bank.GriseBank(c)
+        griseBanks = {DEFAULT: banks}
+    for b in griseBanks.values():
+        b.outbox.start()
+        b.watcher.start() # one poll of the bank for all kiosks
+    cards = None
+    if c.has_option('service', 'cards'):
+        cards = CardRegistry(c.get('service', 'cards'))
+        cards.start() # reload cards when the file changes
+
+    service = RewardService.fromConfig(c, griseBanks, cards)
+    try:
+        service.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    for b in griseBanks.values():
+        b.watcher.stop()
+        b.outbox.stop()
@@ -0,0 +1,155 @@
+'''The last known state of every account, so the kiosk has balances to show without the bank.
+
+GriseBank and RemoteBank save the details of every account, and when the
+bank last told us about them, to a BalanceSnapshot in the [storage] dir
+after each refresh. On the next start, or while the bank is down, the kiosk
+shows them with a "last updated" time. CachedBank reads the snapshot back
+without importing the bank client or going on the network. This module
+only uses the standard library, keep it that way: it is imported before
+anything else.
+
+Rewards still waiting in the outbox are added to the balances the kiosk
+shows, see GriseAccount.expectedBalance(). The bank balance only has them
+once they are sent. A kiosk on the reward service saves what the outbox
+on the service owes each account too, see RemoteAccount.owed.
+
+'''
+import os
+import os.path
+import time
+import json
+import tempfile
+import logging
+import threading
+from decimal import Decimal, InvalidOperation
+
+from outbox import readJournal
+
+VERSION = 2
+
+def storageDir(config:'configparser.ConfigParser', customer:str=None) -> str:
+    'The dir for local data, from [storage] dir, with a subdir per customer'
+    storage = os.path.expanduser(config.get('storage', 'dir', fallback='~/.local/share/grisebank'))
+    if customer is not None:
+        storage = os.path.join(storage, customer)
+    return storage
+
+def snapshotPath(config:'configparser.ConfigParser', customer:str=None, remote:bool=False) -> str:
+    'Where GriseBank (or, with `remote`, RemoteBank) keeps its BalanceSnapshot'
+    if remote:
+        return os.path.join(storageDir(config), 'remote-balances.json')
+    return os.path.join(storageDir(config, customer), 'balances.json')
+
+def outboxPath(config:'configparser.ConfigParser', customer:str=None, remote:bool=False) -> str:
+    'Where GriseBank (or, with `remote`, RemoteBank) keeps the journal of its RewardOutbox'
+    if remote:
+        return os.path.join(storageDir(config), 'remote-outbox.journal')
+    return os.path.join(storageDir(config, customer), 'outbox.journal')
+
+class BalanceSnapshot:
+    '''The details of the accounts of a bank, and when we got them, in a json file at `path`.
+
+    save() writes a new file next to it, fsyncs it and renames it over the
+    old one, so a crash leaves either the old or the new snapshot.
+    '''
+    def __init__(self, path:str):
+        self.path = path
+        self.saves = 0
+        self._lock = threading.Lock()
+
+    def save(self, bank) -> None:
+        'Save the users and base account (if any) of bank, a GriseBank or RemoteBank'
+        base = getattr(bank, 'baseAccount', None)
+        snapshot = {'version': VERSION, 'saved': time.time(),
+                    'users': [{'name': u.title, 'accountNumber': u.details.accountNumber,
+                               'balance': str(u.details.balance), # exact, to_json() has floats
+                               'details': u.details.to_json(), 'updated': u.updated,
+                               'owed': str(getattr(u, 'owed', 0))} # on the reward service, see RemoteAccount
+                              for u in bank.users + ([base] if base is not None else [])]}
+        with self._lock:
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self.path) or '.', prefix='.balances')
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    json.dump(snapshot, f)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp, self.path)
+                self.saves += 1
+            except OSError:
+                logging.exception('Could not save balances to %s', self.path)
+                if os.path.exists(tmp):
+                    os.unlink(tmp)
+
+    def load(self) -> list:
+        'Return the saved users as dicts with name, accountNumber, balance, details, updated and owed, or None'
+        try:
+            with open(self.path) as f:
+                users = json.load(f)['users']
+            for u in users:
+                u['balance'] = Decimal(u['balance'])
+                u.setdefault('details', {})
+                u.setdefault('updated', None) # not in snapshots from before version 2
+                u['owed'] = Decimal(u.get('owed', 0))
+            return users
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError, TypeError, InvalidOperation) as e:
+            logging.warning('Ignoring the saved balances in %s: %r', self.path, e)
+            return None
+
+class CachedDetails:
+    'The SbankenAccount of an account as it was saved, without the bank client'
+    __slots__ = ('accountNumber', 'accountType', 'available', 'balance', 'name')
+
+    def __init__(self, accountNumber:str, balance:Decimal, details:dict):
+        self.accountNumber = accountNumber
+        self.balance = balance
+        self.accountType = details.get('accountType')
+        self.available = Decimal(str(details['available'])) if details.get('available') is not None else None
+        self.name = details.get('name')
+
+class CachedAccount:
+    'A GriseAccount as it was saved, with `.updated`, when the bank last told us about it'
+    def __init__(self, title:str, details:CachedDetails, updated:float, bank:'CachedBank', owed:Decimal=Decimal(0)):
+        self.title = title
+        self.details = details
+        self.updated = updated
+        self.bank = bank
+        self.owed = owed # on the reward service
+
+    def __str__(self) -> str:
+        return '<CachedAccount: {}, account # {}, balance:{}>'.format(self.title, self.details.accountNumber, self.details.balance)
+
+    def expectedBalance(self) -> Decimal:
+        return self.details.balance + self.owed + self.bank.owed.get(self.details.accountNumber, Decimal(0))
+
+class CachedBank:
+    '''Stands in for a GriseBank or RemoteBank while it is starting up.
+
+    Has `.config`, `.users`, `.usersByName` and `user()`, from the last
+    snapshot, and `.owed`, the rewards waiting in the outbox journal per
+    account number. It can't move money: `.ready` is False.
+    '''
+    ready = False
+
+    def __init__(self, config:'configparser.ConfigParser', users:list, owed:dict=None):
+        self.config = config
+        self.owed = owed or {}
+        self.users = [CachedAccount(u['name'], CachedDetails(u['accountNumber'], u['balance'], u['details']), u['updated'], self,
+                                    u.get('owed', Decimal(0)))
+                      for u in users if u['name'] != 'base']
+        self.usersByName = {u.title:u for u in self.users}
+
+    @classmethod
+    def fromConfig(cls, config:'configparser.ConfigParser', customer:str=None, remote:bool=False) -> 'CachedBank':
+        'Return a CachedBank from the snapshot of the last run, or None if there is none'
+        users = BalanceSnapshot(snapshotPath(config, customer, remote)).load()
+        if not users:
+            return None
+        owed = {}
+        for entry in readJournal(outboxPath(config, customer, remote)).values():
+            owed[entry.account] = owed.get(entry.account, Decimal(0)) + entry.amount
+        return cls(config, users, owed)
+
+    def user(self, name:str) -> CachedAccount:
+        return self.usersByName[name]
@@ -0,0 +1,60 @@
+'''Time the phases of starting the kiosk.
+
+gris.py marks each step of its startup on a StartupProfile: the imports,
+reading the config, loading the snapshot of the last run, the first frame,
+and the bank being ready (which happens in the background). The profile is
+logged when the bank is ready, and saved as json with `gris.py --profile
+FILE`. For the import time of every single module, run
+`python -X importtime src/gris.py`, or see bench/bench_startup.py.
+
+'''
+import sys
+import time
+import json
+import logging
+import threading
+from contextlib import contextmanager
+
+class StartupProfile:
+    '''Seconds since `started` (a time.perf_counter(), from before the imports) at each mark.
+
+    mark(name) records a moment, `with phase(name):` records how long
+    something took, and when it ended. Safe to use from any thread.
+    '''
+    def __init__(self, started:float=None):
+        self.started = started if started is not None else time.perf_counter()
+        self.marks = [] # (name, seconds since started, seconds it took or None)
+        self._lock = threading.Lock()
+
+    def mark(self, name:str, took:float=None) -> float:
+        'Record that name happened now, and return the seconds since started'
+        at = time.perf_counter() - self.started
+        with self._lock:
+            self.marks.append((name, at, took))
+        return at
+
+    @contextmanager
+    def phase(self, name:str):
+        began = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.mark(name, time.perf_counter() - began)
+
+    def report(self) -> dict:
+        'Return the marks in order, in ms, and the number of modules imported so far'
+        ms = lambda s: round(s * 1000, 1) if s is not None else None
+        with self._lock:
+            marks = sorted(self.marks, key=lambda m: m[1])
+        return {'marks': [{'name': name, 'at': ms(at), 'took': ms(took)} for name, at, took in marks],
+                'modules': len(sys.modules)}
+
+    def log(self):
+        report = self.report()
+        logging.info('Startup: %s, %i modules', ', '.join(
+            '{} at {:.0f} ms'.format(m['name'], m['at']) + (' ({:.0f} ms)'.format(m['took']) if m['took'] is not None else '')
+            for m in report['marks']), report['modules'])
+
+    def save(self, path:str):
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2)
@@ -0,0 +1,190 @@
+'''A local store of Sbanken transactions, in SQLite.
+
+Keeps every transaction we have seen, keyed by transactionId, so history,
+totals and statistics can be looked up without asking the bank again.
+`sync()` only fetches what is newer than the last transaction we have
+for an account. Listeners hear about every transaction added, see
+analytics.SavingsAnalytics.
+
+'''
+import sqlite3
+import threading
+import hashlib
+import json
+import logging
+import datetime
+from decimal import Decimal
+
+from SbankenClient import SbankenTransaction
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS transactions (
+    transactionId TEXT PRIMARY KEY,
+    accountNumber TEXT NOT NULL,
+    accountingDate TEXT,
+    amount REAL,
+    text TEXT,
+    transactionType TEXT,
+    data TEXT -- the transaction json, as we got it from the api
+);
+CREATE INDEX IF NOT EXISTS transactions_account_date ON transactions (accountNumber, accountingDate);
+CREATE TABLE IF NOT EXISTS cursors (
+    accountNumber TEXT PRIMARY KEY,
+    accountingDate TEXT, -- the newest accountingDate we have synced
+    synced REAL -- unix time of last sync
+);
+'''
+
+def _day(value) -> str:
+    'Return a date as a YYYY-MM-DD string'
+    if isinstance(value, datetime.date):
+        return value.strftime('%Y-%m-%d')
+    return value[:10]
+
+def _amount(value) -> Decimal:
+    'Return a sum of amounts from sqlite as Decimal, rounded to øre'
+    return Decimal(str(round(value, 2)))
+
+class TransactionStore:
+    '''Transactions for many accounts, in one SQLite file.
+
+    Pass ':memory:' as path to keep everything in memory.
+    '''
+    def __init__(self, path:str):
+        self.path = path
+        self._lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.listeners = [] # functions to call with the SbankenTransactions of each add()
+        with self._lock, self.db:
+            self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def addListener(self, fn) -> None:
+        '''Call fn with the list of SbankenTransactions of each add(), after they are stored.
+
+        Transactions we already had are in the list too.'''
+        self.listeners.append(fn)
+
+    @staticmethod
+    def transactionKey(t:dict) -> str:
+        'Return the transactionId, or make a stable one for transactions without it'
+        if t.get('transactionId'):
+            return t['transactionId']
+        fields = [str(t.get(k)) for k in ('accountNumber', 'accountingDate', 'amount', 'text', 'transactionType')]
+        return 'local-' + hashlib.sha1('|'.join(fields).encode()).hexdigest()
+
+    def add(self, transactions:list, upsert:bool=False) -> int:
+        '''Add SbankenTransactions to the store. Returns number of rows written.
+
+        Transactions we already have are left alone, unless `upsert` is True.'''
+        rows = []
+        added = []
+        newest = {} # accountNumber -> newest accountingDate
+        for t in transactions:
+            added.append(t)
+            data = t.to_json()
+            account, date = data.get('accountNumber'), data.get('accountingDate')
+            rows.append((self.transactionKey(data), account, date, data.get('amount'),
+                         data.get('text'), data.get('transactionType'), json.dumps(data)))
+            if date and date > newest.get(account, ''):
+                newest[account] = date
+        verb = 'INSERT OR REPLACE' if upsert else 'INSERT OR IGNORE'
+        with self._lock, self.db:
+            before = self.db.total_changes
+            self.db.executemany(verb + ' INTO transactions VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+            written = self.db.total_changes - before
+            self.db.executemany('''INSERT INTO cursors (accountNumber, accountingDate) VALUES (?, ?)
+                                   ON CONFLICT(accountNumber) DO UPDATE
+                                   SET accountingDate=max(coalesce(accountingDate, ''), excluded.accountingDate)''',
+                                newest.items())
+        for fn in self.listeners:
+            try:
+                fn(added)
+            except Exception:
+                logging.exception('Listener %r failed', fn)
+        return written
+
+    def cursor(self, account:str) -> str:
+        'Return the newest accountingDate we have synced for account, or None'
+        with self._lock:
+            row = self.db.execute('SELECT accountingDate FROM cursors WHERE accountNumber=?', (account,)).fetchone()
+        return row['accountingDate'] if row else None
+
+    def sync(self, client:'SbankenClient', account:str, upsert:bool=False, startDate=None, stale:bool=True) -> int:
+        '''Fetch transactions newer than our cursor from the bank. Returns number of new transactions.
+
+        The whole day of the cursor is fetched again, since the api filters on
+        dates, not times. Those come back as duplicates, and are ignored (or
+        replaced, with `upsert`). Pass startDate to fetch from that date instead.
+        With `stale` False, fail if the bank is down, instead of using old replies from the client cache.'''
+        cursor = self.cursor(account)
+        if startDate is None and cursor is not None:
+            startDate = _day(cursor)
+        added = self.add(client.iterTransactions(account, startDate=startDate, stale=stale), upsert=upsert)
+        with self._lock, self.db:
+            self.db.execute('''INSERT INTO cursors (accountNumber, synced) VALUES (?, strftime('%s','now'))
+                               ON CONFLICT(accountNumber) DO UPDATE SET synced=excluded.synced''', (account,))
+        logging.debug('synced %s from %s: %i new transactions', account, startDate, added)
+        return added
+
+    def _where(self, account:str, startDate=None, endDate=None) -> tuple:
+        'return sql and args to pick out the transactions of one account, between two dates'
+        sql, args = 'accountNumber=?', [account]
+        if startDate is not None:
+            sql += ' AND accountingDate >= ?'
+            args.append(_day(startDate))
+        if endDate is not None:
+            # dates are stored with time and offset, so compare with the day after
+            sql += ' AND accountingDate < ?'
+            args.append(_day(datetime.date.fromisoformat(_day(endDate)) + datetime.timedelta(days=1)))
+        return sql, args
+
+    def rows(self, account:str) -> list:
+        'Return (transactionId, accountingDate, amount, text) of every transaction for account, oldest first, without parsing the json'
+        with self._lock:
+            return self.db.execute('SELECT transactionId, accountingDate, amount, text FROM transactions WHERE accountNumber=? ORDER BY accountingDate',
+                                   (account,)).fetchall()
+
+    def history(self, account:str, limit:int=None, startDate=None, endDate=None) -> list:
+        'Return SbankenTransactions for account, newest first'
+        sql, args = self._where(account, startDate, endDate)
+        sql = 'SELECT data FROM transactions WHERE ' + sql + ' ORDER BY accountingDate DESC'
+        if limit is not None:
+            sql += ' LIMIT ?'
+            args.append(limit)
+        with self._lock:
+            rows = self.db.execute(sql, args).fetchall()
+        return [SbankenTransaction(json.loads(row['data'])) for row in rows]
+
+    def find(self, account:str, text:str, startDate=None, endDate=None) -> list:
+        'Return SbankenTransactions for account with `text` in their text, newest first'
+        sql, args = self._where(account, startDate, endDate)
+        with self._lock:
+            rows = self.db.execute('SELECT data FROM transactions WHERE ' + sql + ' AND instr(text, ?) > 0 ORDER BY accountingDate DESC',
+                                   args + [text]).fetchall()
+        return [SbankenTransaction(json.loads(row['data'])) for row in rows]
+
+    def total(self, account:str, startDate=None, endDate=None) -> Decimal:
+        'Return the sum of all transactions for account, between two dates'
+        sql, args = self._where(account, startDate, endDate)
+        with self._lock:
+            return _amount(self.db.execute('SELECT coalesce(sum(amount), 0) FROM transactions WHERE ' + sql, args).fetchone()[0])
+
+    def statistics(self, account:str, startDate=None, endDate=None) -> dict:
+        'Return count, total, deposits, withdrawals and first and last date for account, between two dates'
+        sql, args = self._where(account, startDate, endDate)
+        with self._lock:
+            row = self.db.execute('''SELECT count(*) AS count,
+                                            coalesce(sum(amount), 0) AS total,
+                                            coalesce(sum(CASE WHEN amount > 0 THEN amount END), 0) AS deposits,
+                                            coalesce(sum(CASE WHEN amount < 0 THEN amount END), 0) AS withdrawals,
+                                            min(accountingDate) AS first,
+                                            max(accountingDate) AS last
+                                     FROM transactions WHERE ''' + sql, args).fetchone()
+        stats = dict(row)
+        for key in ('total', 'deposits', 'withdrawals'):
+            stats[key] = _amount(stats[key])
+        return stats
@@ -0,0 +1,82 @@
+'''Notice balance changes we did not make ourselves, like a transfer from the bank app.
+
+BalanceWatcher polls the bank for new transactions on every account, into
+the local transaction store, and when an account has new ones, gets all
+balances with GriseBank.refreshAll(), so the listeners hear about it. The poll interval adapts:
+it starts at `minInterval`, and doubles after each quiet poll, up to
+`maxInterval`. Any change brings it back down.
+
+'''
+import threading
+import logging
+
+class BalanceWatcher:
+    '''Poll the bank for new transactions in a background thread, see the module doc.
+
+    Call poke() to poll right away, e.g. when someone is looking at the kiosk.
+    '''
+    def __init__(self, bank:'GriseBank', minInterval:float=10, maxInterval:float=300, factor:float=2):
+        self.bank = bank
+        self.minInterval = minInterval
+        self.maxInterval = maxInterval
+        self.factor = factor
+        self.interval = minInterval
+        self.polls = 0
+        self.changes = 0 # accounts found changed
+        self._wakeup = threading.Event()
+        self._running = False
+        self._thread = None
+
+    @classmethod
+    def fromConfig(cls, bank:'GriseBank', config:'configparser.ConfigParser') -> 'BalanceWatcher':
+        'Set up a watcher from the optional [watch] section of the config'
+        return cls(bank,
+                   minInterval=config.getfloat('watch', 'minInterval', fallback=10),
+                   maxInterval=config.getfloat('watch', 'maxInterval', fallback=300))
+
+    def poll(self) -> list:
+        'Get new transactions for every account, and new details for all if any had some. Returns the GriseAccounts that had'
+        self.polls += 1
+        everyone = self.bank.users + [self.bank.baseAccount]
+        # not from stale cached replies: no new transactions there doesn't mean the balances are right
+        changed = [u for u in everyone if self.bank.transactions.sync(self.bank.client, u.details.accountNumber, stale=False)]
+        if changed:
+            # one fresh account list for all of them, the cached details are from before the new transactions
+            self.bank.refreshAll()
+        else:
+            # no new transactions: the balances we have are still right
+            self.bank.refreshed(everyone)
+        self.changes += len(changed)
+        return changed
+
+    def poke(self):
+        'Poll now, and often for a while'
+        self.interval = self.minInterval
+        self._wakeup.set()
+
+    def start(self):
+        'Start polling in a background thread'
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='watcher', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        while self._running:
+            try:
+                changed = self.poll()
+            except Exception as e:
+                logging.warning('Could not check for new transactions: %r', e)
+                changed = []
+            if changed:
+                logging.info('New transactions on %s', ', '.join(u.title for u in changed))
+                self.interval = self.minInterval
+            else:
+                self.interval = min(self.maxInterval, self.interval * self.factor)
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
@@ -0,0 +1,34 @@
+'''Tests for GriseBank and GriseBanks, on the fake bank in fakesbanken.py.
+
+    python -m pytest test
+'''
+import sys
+import os.path
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import pytest
+
+from fakesbanken import FakeSbanken
+from bank import GriseBanks, GriseError
+
+@pytest.fixture
+def fake():
+    fake = FakeSbanken({'97104133219': 1000, '97104133220': 0}).start()
+    yield fake
+    fake.stop()
+
+def test_failed_customer_closes_the_banks_already_opened(fake, tmp_path):
+    config = fake.config({})
+    config.add_section('storage')
+    config.set('storage', 'dir', str(tmp_path))
+    for customer, base in (('first', '97104133219'), ('second', '99999999999')): # the bank doesn't know the second BASE
+        config.add_section('accounts:' + customer)
+        config.set('accounts:' + customer, 'BASE', base)
+        config.add_section('secrets:' + customer)
+        for option, value in config.items('secrets'):
+            config.set('secrets:' + customer, option, value)
+    with pytest.raises(GriseError):
+        GriseBanks(config)
+    assert not [t for t in threading.enumerate() if t.name == 'sbanken-loop']
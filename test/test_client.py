@@ -0,0 +1,51 @@
+'''Tests for SbankenClient against the fake bank in fakesbanken.py.
+
+    python -m pytest test
+'''
+import sys
+import os.path
+import socket
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import pytest
+
+from fakesbanken import FakeSbanken
+from SbankenClient import SbankenClient, SbankenAuthError, SbankenUnavailableError
+
+@pytest.fixture
+def fake():
+    fake = FakeSbanken({'97104133219': 1000}).start()
+    yield fake
+    fake.stop()
+
+def freePort() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def test_failed_login_frees_the_metrics_port(fake):
+    config = fake.config({'BASE': '97104133219'})
+    config.add_section('metrics')
+    config.set('metrics', 'prometheusPort', str(freePort()))
+    identityServer = config.get('login', 'identityServer')
+    config.set('login', 'identityServer', 'http://127.0.0.1:{}/token'.format(freePort())) # nobody there
+    with pytest.raises(SbankenUnavailableError):
+        SbankenClient(config)
+    config.set('login', 'identityServer', identityServer)
+    client = SbankenClient(config)
+    try:
+        assert client.metrics.exporter is not None
+        assert [a.details.accountNumber for a in client.accounts()] == ['97104133219']
+    finally:
+        client.close()
+    assert client.metrics.exporter is None
+
+def test_token_errors_are_typed(fake):
+    config = fake.config({'BASE': '97104133219'})
+    config.set('login', 'identityServer', 'http://127.0.0.1:{}/token'.format(freePort()))
+    with pytest.raises(SbankenUnavailableError):
+        SbankenClient(config)
+    config.set('login', 'identityServer', fake.url + '/no/token/here')
+    with pytest.raises(SbankenAuthError):
+        SbankenClient(config)
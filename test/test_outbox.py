@@ -0,0 +1,19 @@
+'''Tests for the reward outbox and the transfer messages it sends.
+
+    python -m pytest test
+'''
+import sys
+import os.path
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from ledger import taggedMessage, transferKey, transferTag
+from outbox import DEFAULT_MESSAGE, MERGED_MESSAGE
+
+def test_default_messages_fit_next_to_the_tag():
+    key = transferKey(['a', 'b'])
+    tag = ' ' + transferTag(key)
+    for message in [DEFAULT_MESSAGE] + [MERGED_MESSAGE.format(n) for n in range(2, 10)]:
+        tagged = taggedMessage(message, key)
+        assert tagged == message + tag
+        assert len(tagged) <= 30
@@ -0,0 +1,64 @@
+'''Tests for the reward service, with a GriseBank on the fake bank in fakesbanken.py.
+
+    python -m pytest test
+'''
+import sys
+import os.path
+import configparser
+from decimal import Decimal
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import pytest
+
+from fakesbanken import FakeSbanken
+from bank import GriseBank
+from service import RewardService, RemoteBank, ServiceError, DEFAULT
+
+@pytest.fixture
+def fake():
+    fake = FakeSbanken({'97104133219': 1000, '97104133220': 0}).start()
+    yield fake
+    fake.stop()
+
+@pytest.fixture
+def bank(fake, tmp_path):
+    config = fake.config({'BASE': '97104133219', 'Kid': '97104133220'})
+    config.add_section('storage')
+    config.set('storage', 'dir', str(tmp_path))
+    bank = GriseBank(config)
+    yield bank
+    bank.client.close()
+
+@pytest.fixture
+def service(bank):
+    service = RewardService({DEFAULT: bank}, port=0)
+    yield service
+    if service._thread is not None:
+        service.stop()
+    else:
+        service.server.server_close()
+
+def test_reward_batch_is_all_or_nothing(service, bank):
+    with pytest.raises(ServiceError) as e:
+        service.reward(DEFAULT, [{'account': '97104133220', 'amount': 5, 'key': 'k2'},
+                                 {'account': '97104133220', 'amount': 0.5, 'key': 'k3'}])
+    assert e.value.status == 400
+    assert len(bank.outbox) == 0
+    assert service.reward(DEFAULT, [{'account': '97104133220', 'amount': 5, 'key': 'k2'}])['queued'] == ['k2']
+
+def test_remote_expected_balance_has_rewards_from_other_kiosks(service, tmp_path):
+    service.start()
+    service.reward(DEFAULT, [{'account': '97104133220', 'amount': 5, 'key': 'other kiosk'}])
+    config = configparser.RawConfigParser()
+    config.read_dict({'service': {'url': service.url}, 'storage': {'dir': str(tmp_path / 'kiosk')}})
+    kiosk = RemoteBank(config)
+    try:
+        assert kiosk.user('Kid').expectedBalance() == Decimal(5)
+        kiosk.outbox.put(kiosk.user('Kid'), Decimal(2), key='this kiosk')
+        assert kiosk.user('Kid').expectedBalance() == Decimal(7)
+        kiosk.outbox.flush()
+        assert kiosk.user('Kid').owed == Decimal(7)
+        assert kiosk.user('Kid').expectedBalance() == Decimal(7)
+    finally:
+        kiosk.close()